@@ -63,6 +63,9 @@ class ConfigValidator:
                 'port': int,
                 'chroot': str,
             }],
+            'zookeeper-encoding': v.Any('json', 'compact'),
+            'zookeeper-cache-snapshot': str,
+            'zookeeper-node-buckets': v.All(int, v.Range(min=0, max=100)),
             'providers': list,
             'labels': [label],
             'diskimages': [diskimage],
@@ -375,6 +375,8 @@ class NodePoolCmd(NodepoolApp):
                                  'request-list', 'info', 'erase'):
             self.zk = zk.ZooKeeper(enable_cache=False)
             self.zk.connect(list(config.zookeeper_servers.values()))
+            self.zk.setEncoding(config.zookeeper_encoding)
+            self.zk.setNodeBuckets(config.zookeeper_node_buckets)
 
         self.pool.setConfig(config)
         self.args.func()
@@ -38,6 +38,9 @@ class Config(ConfigValue):
         self.providers = {}
         self.provider_managers = {}
         self.zookeeper_servers = {}
+        self.zookeeper_encoding = None
+        self.zookeeper_cache_snapshot = None
+        self.zookeeper_node_buckets = None
         self.elementsdir = None
         self.imagesdir = None
         self.build_log_dir = None
@@ -52,6 +55,11 @@ class Config(ConfigValue):
                     self.providers == other.providers and
                     self.provider_managers == other.provider_managers and
                     self.zookeeper_servers == other.zookeeper_servers and
+                    self.zookeeper_encoding == other.zookeeper_encoding and
+                    (self.zookeeper_cache_snapshot ==
+                     other.zookeeper_cache_snapshot) and
+                    (self.zookeeper_node_buckets ==
+                     other.zookeeper_node_buckets) and
                     self.elementsdir == other.elementsdir and
                     self.imagesdir == other.imagesdir and
                     self.build_log_dir == other.build_log_dir and
@@ -85,6 +93,19 @@ class Config(ConfigValue):
             'listen_address': webapp_cfg.get('listen_address', '0.0.0.0')
         }
 
+    def setZooKeeperEncoding(self, value):
+        if value is None:
+            value = zk.JsonEncoding.name
+        self.zookeeper_encoding = value
+
+    def setZooKeeperCacheSnapshot(self, value):
+        self.zookeeper_cache_snapshot = value
+
+    def setZooKeeperNodeBuckets(self, value):
+        if value is None:
+            value = 0
+        self.zookeeper_node_buckets = value
+
     def setZooKeeperServers(self, zk_cfg):
         if not zk_cfg:
             return
@@ -254,6 +275,10 @@ def loadConfig(config_path):
     newconfig.setMaxHoldAge(config.get('max-hold-age'))
     newconfig.setWebApp(config.get('webapp'))
     newconfig.setZooKeeperServers(config.get('zookeeper-servers'))
+    newconfig.setZooKeeperEncoding(config.get('zookeeper-encoding'))
+    newconfig.setZooKeeperCacheSnapshot(
+        config.get('zookeeper-cache-snapshot'))
+    newconfig.setZooKeeperNodeBuckets(config.get('zookeeper-node-buckets'))
     newconfig.setDiskImages(config.get('diskimages'))
     newconfig.setLabels(config.get('labels'))
     newconfig.setProviders(config.get('providers'))
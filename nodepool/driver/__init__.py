@@ -22,10 +22,12 @@ import importlib
 import logging
 import math
 import os
+import threading
 import voluptuous as v
 
 from nodepool import zk
 from nodepool import exceptions
+from nodepool.driver.utils import LaunchCounter, LaunchExecutor
 
 
 class Drivers:
@@ -159,6 +161,9 @@ class Provider(ProviderNotifications, metaclass=abc.ABCMeta):
     The class or instance attribute **name** must be provided as a string.
 
     """
+
+    _launches_lock = threading.Lock()
+
     @abc.abstractmethod
     def start(self, zk_conn):
         """Start this provider
@@ -173,6 +178,59 @@ class Provider(ProviderNotifications, metaclass=abc.ABCMeta):
         """
         pass
 
+    @property
+    def launch_counter(self):
+        """The LaunchCounter of the node launches of this provider
+
+        It is created along with the first launch, and handed over to the
+        provider replacing this one on a reconfiguration.
+        """
+        with Provider._launches_lock:
+            if getattr(self, '_launch_counter', None) is None:
+                self._launch_counter = LaunchCounter(self.provider.name)
+            return self._launch_counter
+
+    def takeOverLaunches(self, old_provider):
+        """Take over the node launches of the provider this one replaces
+
+        Launches started by the old provider keep running after it was
+        stopped, so they keep being counted against the concurrency limit
+        of the provider.
+
+        :param Provider old_provider: The provider being replaced.
+        """
+        counter = old_provider.launch_counter
+        with Provider._launches_lock:
+            self._launch_counter = counter
+
+    @property
+    def launch_executor(self):
+        """The LaunchExecutor running the node launches of this provider
+
+        It is created along with the first launch, and shut down by
+        :py:meth:`~nodepool.driver.Provider.stopLaunches`.
+        """
+        with Provider._launches_lock:
+            if getattr(self, '_launch_executor', None) is None:
+                self._launch_executor = LaunchExecutor(
+                    self.provider.name, self.provider.launch_workers)
+            return self._launch_executor
+
+    def stopLaunches(self, wait=False):
+        """Shut down the launch executor of this provider
+
+        The launcher calls this along with
+        :py:meth:`~nodepool.driver.Provider.stop`, and with wait set
+        along with :py:meth:`~nodepool.driver.Provider.join`.  Launches
+        already submitted still run.
+
+        :param bool wait: Whether to wait for the submitted launches.
+        """
+        with Provider._launches_lock:
+            executor = getattr(self, '_launch_executor', None)
+        if executor:
+            executor.shutdown(wait)
+
     @abc.abstractmethod
     def stop(self):
         """Stop this provider
@@ -415,6 +473,9 @@ class NodeRequestHandler(NodeRequestHandlerNotifications,
         else:
             ready_nodes = []
 
+        # New nodes are launched together once the node set is filled as far
+        # as it can be for now.
+        new_nodes = []
         for ntype in needed_types:
             # First try to grab from the list of already available nodes.
             got_a_node = False
@@ -446,9 +507,16 @@ class NodeRequestHandler(NodeRequestHandlerNotifications,
                         self.log.debug(
                             "Locked existing node %s for request %s",
                             node.id, self.request.id)
-                        got_a_node = True
                         node.allocated_to = self.request.id
-                        self.zk.storeNode(node)
+                        try:
+                            self.zk.storeNode(node, check_version=True)
+                        except exceptions.ZKVersionException:
+                            # It was modified without the lock (e.g., by
+                            # modifyNode()) so skip it.
+                            self.zk.updateNode(node)
+                            self.zk.unlockNode(node)
+                            continue
+                        got_a_node = True
                         self.nodeset.append(node)
                         self._satisfied_types.add(ntype, node.id)
                         # Notify driver handler about node re-use
@@ -470,6 +538,7 @@ class NodeRequestHandler(NodeRequestHandlerNotifications,
                         self.log.debug(
                             "Declining node request %s because provider cannot"
                             " satisfy min-ready", self.request.id)
+                        self.launchBatch(new_nodes)
                         self.decline_request()
                         self._declinedHandlerCleanup()
                         return
@@ -484,6 +553,7 @@ class NodeRequestHandler(NodeRequestHandlerNotifications,
                     self.paused = True
                     self.zk.deleteOldestUnusedNode(self.provider.name,
                                                    self.pool.name)
+                    self.launchBatch(new_nodes)
                     return
 
                 if self.paused:
@@ -508,18 +578,33 @@ class NodeRequestHandler(NodeRequestHandlerNotifications,
                 # *after* it is stored since nodes in INIT state are not
                 # locked anywhere.
                 self.zk.storeNode(node)
-                self.zk.lockNode(node, blocking=False)
-                self.log.debug("Locked building node %s for request %s",
-                               node.id, self.request.id)
 
                 # Set state AFTER lock so that it isn't accidentally cleaned
-                # up (unlocked BUILDING nodes will be deleted).
+                # up (unlocked BUILDING nodes will be deleted). Both are
+                # done in one transaction.
                 node.state = zk.BUILDING
-                self.zk.storeNode(node)
+                txn = self.zk.transaction()
+                txn.lockNewNode(node)
+                txn.storeNode(node)
+                try:
+                    txn.commit()
+                except exceptions.ZKTransactionException:
+                    # Someone else attempted to lock the node in the
+                    # meantime, fall back to the regular lock.
+                    self.log.debug("Unable to lock new node %s in a "
+                                   "transaction", node.id)
+                    node.state = zk.INIT
+                    self.zk.lockNode(node, blocking=False)
+                    node.state = zk.BUILDING
+                    self.zk.storeNode(node)
+                self.log.debug("Locked building node %s for request %s",
+                               node.id, self.request.id)
 
                 self.nodeset.append(node)
                 self._satisfied_types.add(ntype, node.id)
-                self.launch(node)
+                new_nodes.append(node)
+
+        self.launchBatch(new_nodes)
 
     def _runHandler(self):
         '''
@@ -621,6 +706,11 @@ class NodeRequestHandler(NodeRequestHandlerNotifications,
         if self.launcher_id not in self.request.declined_by:
             self.request.declined_by.append(self.launcher_id)
         launchers = set([x.id for x in self.zk.getRegisteredLaunchers()])
+        if launchers.issubset(set(self.request.declined_by)):
+            # The cached launcher registry might not know about a launcher
+            # which just came up yet, so double check before failing.
+            launchers = set([x.id for x in
+                             self.zk.getRegisteredLaunchers(cached=False)])
         if launchers.issubset(set(self.request.declined_by)):
             # All launchers have declined it
             self.log.debug("Failing declined node request %s",
@@ -719,11 +809,39 @@ class NodeRequestHandler(NodeRequestHandlerNotifications,
                            self.request.id)
             self.request.state = zk.FULFILLED
 
-        self.unlockNodeSet()
-        self.zk.storeNodeRequest(self.request)
-        self.zk.unlockNodeRequest(self.request)
+        self._completeRequest()
         return True
 
+    def _completeRequest(self):
+        '''
+        Unlock the node set, then store and unlock the request.
+
+        This is committed as a single transaction so that the request is
+        never seen completed while its nodes are still locked. If the
+        transaction fails, the operations are retried one by one.
+        '''
+        locked_nodes = [n for n in self.nodeset if n.lock]
+        try:
+            txn = self.zk.transaction()
+            for node in locked_nodes:
+                txn.unlockNode(node)
+            txn.storeNodeRequest(self.request)
+            txn.unlockNodeRequest(self.request)
+            txn.commit()
+        except (exceptions.ZKTransactionException,
+                exceptions.ZKLockException):
+            self.log.debug("Unable to complete node request %s in a "
+                           "transaction", self.request.id)
+            self.unlockNodeSet()
+            self.zk.storeNodeRequest(self.request)
+            self.zk.unlockNodeRequest(self.request)
+            return
+
+        for node in locked_nodes:
+            self.log.debug("Unlocked node %s for request %s",
+                           node.id, self.request.id)
+        self.nodeset = []
+
     # ---------------------------------------------------------------
     # Driver Implementation
     # ---------------------------------------------------------------
@@ -764,6 +882,20 @@ class NodeRequestHandler(NodeRequestHandlerNotifications,
         '''
         pass
 
+    def launchBatch(self, nodes):
+        '''
+        Handler may implement this to launch several nodes at once, e.g. to
+        create their instances with a single request to the provider.
+
+        The nodes are the new ones added to the node set by one pass over
+        the requested node types. By default, every node is launched on its
+        own.
+
+        :param list nodes: The Node objects to launch, possibly none.
+        '''
+        for node in nodes:
+            self.launch(node)
+
     @property
     @abc.abstractmethod
     def alive_thread_count(self):
@@ -895,13 +1027,15 @@ class ProviderConfig(ConfigValue, metaclass=abc.ABCMeta):
         self.driver = DriverConfig()
         self.driver.name = provider.get('driver', 'openstack')
         self.max_concurrency = provider.get('max-concurrency', -1)
+        self.launch_workers = provider.get('launch-workers', 0)
 
     def __eq__(self, other):
         if isinstance(other, ProviderConfig):
             return (self.name == other.name and
                     self.provider == other.provider and
                     self.driver == other.driver and
-                    self.max_concurrency == other.max_concurrency)
+                    self.max_concurrency == other.max_concurrency and
+                    self.launch_workers == other.launch_workers)
         return False
 
     def __repr__(self):
@@ -912,7 +1046,8 @@ class ProviderConfig(ConfigValue, metaclass=abc.ABCMeta):
         return {
             v.Required('name'): str,
             'driver': str,
-            'max-concurrency': int
+            'max-concurrency': int,
+            'launch-workers': int,
         }
 
     @property
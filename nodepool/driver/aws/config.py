@@ -146,6 +146,8 @@ class AwsProviderConfig(ProviderConfig):
         self.region_name = None
         self.boot_timeout = None
         self.launch_retries = None
+        self.launch_batch_size = None
+        self.instance_list_ttl = None
         self.cloud_images = {}
         super().__init__(provider)
 
@@ -157,6 +159,8 @@ class AwsProviderConfig(ProviderConfig):
                     and other.pools == self.pools
                     and other.boot_timeout == self.boot_timeout
                     and other.launch_retries == self.launch_retries
+                    and other.launch_batch_size == self.launch_batch_size
+                    and other.instance_list_ttl == self.instance_list_ttl
                     and other.cloud_images == self.cloud_images)
         return False
 
@@ -177,6 +181,9 @@ class AwsProviderConfig(ProviderConfig):
         self.region_name = self.provider.get('region-name')
         self.boot_timeout = self.provider.get('boot-timeout', 60)
         self.launch_retries = self.provider.get('launch-retries', 3)
+        self.launch_batch_size = self.provider.get('launch-batch-size', 1)
+        self.instance_list_ttl = float(
+            self.provider.get('instance-list-ttl', 0))
 
         default_port_mapping = {
             'ssh': 22,
@@ -235,6 +242,8 @@ class AwsProviderConfig(ProviderConfig):
             'hostname-format': str,
             'boot-timeout': int,
             'launch-retries': int,
+            'launch-batch-size': int,
+            'instance-list-ttl': v.Coerce(float),
         })
         return v.Schema(provider)
 
@@ -18,9 +18,10 @@ import time
 
 from nodepool import exceptions
 from nodepool import zk
-from nodepool.driver.utils import NodeLauncher, QuotaInformation
+from nodepool.driver.utils import LaunchBatch, NodeLauncher
+from nodepool.driver.utils import QuotaInformation
 from nodepool.driver import NodeRequestHandler
-from nodepool.nodeutils import nodescan
+from nodepool.nodeutils import iterate_timeout, nodescan, POLL_MODERATE
 
 
 class AwsInstanceLauncher(NodeLauncher):
@@ -33,13 +34,20 @@ class AwsInstanceLauncher(NodeLauncher):
         self.zk = handler.zk
         self.boot_timeout = provider_config.boot_timeout
         self.label = provider_label
+        # The LaunchBatch this launch is part of, if any.
+        self.batch = None
 
     def launch(self):
         self.log.debug("Starting %s instance" % self.node.type)
         attempts = 1
         while attempts <= self.retries:
             try:
-                instance = self.handler.manager.createInstance(self.label)
+                instance = None
+                if self.batch:
+                    instance = self.batch.claim(self)
+                if instance is None:
+                    instance = self.handler.manager.createInstance(
+                        self.label)
                 break
             except Exception:
                 if attempts <= self.retries:
@@ -55,23 +63,18 @@ class AwsInstanceLauncher(NodeLauncher):
         self.node.external_id = instance_id
         self.zk.storeNode(self.node)
 
-        boot_start = time.monotonic()
-        while time.monotonic() - boot_start < self.boot_timeout:
+        for count in iterate_timeout(
+                self.boot_timeout, exceptions.LaunchStatusException,
+                "instance %s to start" % instance_id,
+                profile=POLL_MODERATE, name='aws.instance-boot'):
+            if count > 1:
+                instance.reload()
             state = instance.state.get('Name')
             self.log.debug("Instance %s is %s" % (instance_id, state))
             if state == 'running':
-                instance.create_tags(Tags=[{'Key': 'nodepool_id',
-                                            'Value': str(self.node.id)}])
-                instance.create_tags(Tags=[{'Key': 'nodepool_pool',
-                                            'Value': str(self.pool.name)}])
-                instance.create_tags(Tags=[{'Key': 'nodepool_provider',
-                                            'Value': str(self.provider_name)}])
+                self.handler.manager.tagInstance(
+                    instance, self.node.id, self.pool.name)
                 break
-            time.sleep(0.5)
-            instance.reload()
-        if state != 'running':
-            raise exceptions.LaunchStatusException(
-                "Instance %s failed to start: %s" % (instance_id, state))
 
         server_ip = instance.public_ip_address
         if not server_ip:
@@ -111,15 +114,11 @@ class AwsNodeRequestHandler(NodeRequestHandler):
 
     def __init__(self, pw, request):
         super().__init__(pw, request)
-        self._threads = []
+        self._futures = []
 
     @property
     def alive_thread_count(self):
-        count = 0
-        for t in self._threads:
-            if t.isAlive():
-                count += 1
-        return count
+        return len([f for f in self._futures if not f.done()])
 
     def imagesAvailable(self):
         '''
@@ -180,7 +179,7 @@ class AwsNodeRequestHandler(NodeRequestHandler):
         When all of the Node objects have reached a final state (READY or
         FAILED), we'll know all threads have finished the launch process.
         '''
-        if not self._threads:
+        if not self._futures:
             return True
 
         # Give the NodeLaunch threads time to finish.
@@ -198,6 +197,29 @@ class AwsNodeRequestHandler(NodeRequestHandler):
 
     def launch(self, node):
         label = self.pool.labels[node.type[0]]
-        thd = AwsInstanceLauncher(self, node, self.provider, label)
-        thd.start()
-        self._threads.append(thd)
+        launcher = AwsInstanceLauncher(self, node, self.provider, label)
+        self._futures.append(launcher.submit(self.manager))
+
+    def launchBatch(self, nodes):
+        '''
+        Launch the nodes, running the instances of a label together.
+
+        If the provider has a launch batch size, the instances of the nodes
+        sharing a label are run with a single request per batch of up to
+        that many nodes. Otherwise, every node is launched on its own.
+        '''
+        if self.provider.launch_batch_size <= 1:
+            return super().launchBatch(nodes)
+
+        launchers = [
+            AwsInstanceLauncher(self, node, self.provider,
+                                self.pool.labels[node.type[0]])
+            for node in nodes]
+        LaunchBatch.assign(launchers, self.provider.launch_batch_size,
+                           self._createInstances)
+        for launcher in launchers:
+            self._futures.append(launcher.submit(self.manager))
+
+    def _createInstances(self, launchers):
+        return self.manager.createInstances(launchers[0].label,
+                                            len(launchers))
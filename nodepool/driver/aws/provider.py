@@ -17,6 +17,7 @@ import boto3
 
 from nodepool.driver import Provider
 from nodepool.driver.aws.handler import AwsNodeRequestHandler
+from nodepool.driver.utils import InstanceListCache
 
 
 class AwsInstance:
@@ -46,6 +47,7 @@ class AwsProvider(Provider):
     def __init__(self, provider, *args):
         self.provider = provider
         self.ec2 = None
+        self._instance_list = None
 
     def getRequestHandler(self, poolworker, request):
         return AwsNodeRequestHandler(poolworker, request)
@@ -58,29 +60,39 @@ class AwsProvider(Provider):
             region_name=self.provider.region_name,
             profile_name=self.provider.profile_name)
         self.ec2 = self.aws.resource('ec2')
+        if self.provider.instance_list_ttl:
+            self._instance_list = InstanceListCache(
+                self.provider.name, self._listNodes,
+                self.provider.instance_list_ttl)
 
     def stop(self):
         self.log.debug("Stopping")
+        if self._instance_list:
+            self._instance_list.stop()
 
-    def listNodes(self):
+    def _listNodes(self):
         servers = []
 
-        for instance in self.ec2.instances.all():
+        # Let EC2 filter our instances rather than walking all of them
+        instances = self.ec2.instances.filter(Filters=[{
+            'Name': 'tag:nodepool_provider',
+            'Values': [self.provider.name]}])
+        for instance in instances:
             if instance.state["Name"].lower() == "terminated":
                 continue
-            ours = False
-            if instance.tags:
-                for tag in instance.tags:
-                    if (tag["Key"] == 'nodepool_provider'
-                        and tag["Value"] == self.provider.name):
-                        ours = True
-                        break
-            if not ours:
-                continue
             servers.append(AwsInstance(
                 instance.id, instance.tags, self.provider))
         return servers
 
+    def listNodes(self):
+        if self._instance_list:
+            return self._instance_list.get()
+        return self._listNodes()
+
+    def _invalidateInstanceList(self):
+        if self._instance_list:
+            self._instance_list.invalidate()
+
     def countNodes(self, pool=None):
         n = 0
         for instance in self.listNodes():
@@ -113,6 +125,8 @@ class AwsProvider(Provider):
         return True
 
     def join(self):
+        if self._instance_list:
+            self._instance_list.join()
         return True
 
     def cleanupLeakedResources(self):
@@ -123,18 +137,47 @@ class AwsProvider(Provider):
         if self.ec2 is None:
             return False
         instance = self.ec2.Instance(server_id)
-        instance.terminate()
+        try:
+            instance.terminate()
+        finally:
+            self._invalidateInstanceList()
 
     def waitForNodeCleanup(self, server_id):
         # TODO: track instance deletion
         return True
 
+    def tagInstance(self, instance, node_id, pool_name):
+        '''
+        Tag an instance with its node, which makes it part of the listing
+        of this provider.
+        '''
+        try:
+            instance.create_tags(Tags=[
+                {'Key': 'nodepool_id', 'Value': str(node_id)},
+                {'Key': 'nodepool_pool', 'Value': str(pool_name)},
+                {'Key': 'nodepool_provider', 'Value': str(self.provider.name)},
+            ])
+        finally:
+            self._invalidateInstanceList()
+
     def createInstance(self, label):
+        return self.createInstances(label, 1)[0]
+
+    def createInstances(self, label, count):
+        '''
+        Create several instances of a label with a single request.
+
+        :param label: The label of the instances.
+        :param int count: The number of instances to create. EC2 may create
+            fewer if there is not enough capacity for all of them.
+
+        :returns: A list of the instances created.
+        '''
         image_id = label.cloud_image.external_name
         args = dict(
             ImageId=image_id,
             MinCount=1,
-            MaxCount=1,
+            MaxCount=count,
             KeyName=label.key_name,
             InstanceType=label.instance_type,
             NetworkInterfaces=[{
@@ -170,5 +213,8 @@ class AwsProvider(Provider):
                     del mapping['Ebs']['Encrypted']
                 args['BlockDeviceMappings'] = [mapping]
 
-        instances = self.ec2.create_instances(**args)
-        return self.ec2.Instance(instances[0].id)
+        try:
+            instances = self.ec2.create_instances(**args)
+        finally:
+            self._invalidateInstanceList()
+        return [self.ec2.Instance(instance.id) for instance in instances]
@@ -51,17 +51,16 @@ class AzureInstanceLauncher(NodeLauncher):
 
         self.node.external_id = instance.id
 
-        boot_start = time.monotonic()
-        while time.monotonic() - boot_start < self.boot_timeout:
+        for count in utils.iterate_timeout(
+                self.boot_timeout, exceptions.LaunchStatusException,
+                "instance %s to start" % instance.id,
+                profile=utils.POLL_MODERATE, name='azure.instance-boot'):
+            if count > 1:
+                instance = self.handler.manager.getInstance(instance.id)
             state = instance.provisioning_state
             self.log.debug("Instance %s is %s" % (instance.id, state))
             if state == 'Succeeded':
                 break
-            time.sleep(0.5)
-            instance = self.handler.manager.getInstance(instance.id)
-        if state != 'Succeeded':
-            raise exceptions.LaunchStatusException(
-                "Instance %s failed to start: %s" % (instance.id, state))
 
         server_ip = self.handler.manager.getIpaddress(instance)
         if not server_ip:
@@ -93,15 +92,11 @@ class AzureNodeRequestHandler(NodeRequestHandler):
 
     def __init__(self, pw, request):
         super().__init__(pw, request)
-        self._threads = []
+        self._futures = []
 
     @property
     def alive_thread_count(self):
-        count = 0
-        for t in self._threads:
-            if t.isAlive():
-                count += 1
-        return count
+        return len([f for f in self._futures if not f.done()])
 
     def launchesComplete(self):
         '''
@@ -110,7 +105,7 @@ class AzureNodeRequestHandler(NodeRequestHandler):
         When all of the Node objects have reached a final state (READY or
         FAILED), we'll know all threads have finished the launch process.
         '''
-        if not self._threads:
+        if not self._futures:
             return True
 
         # Give the NodeLaunch threads time to finish.
@@ -128,9 +123,8 @@ class AzureNodeRequestHandler(NodeRequestHandler):
 
     def launch(self, node):
         label = self.pool.labels[node.type[0]]
-        thd = AzureInstanceLauncher(self, node, self.provider, label)
-        thd.start()
-        self._threads.append(thd)
+        launcher = AzureInstanceLauncher(self, node, self.provider, label)
+        self._futures.append(launcher.submit(self.manager))
 
     def imagesAvailable(self):
         return True
@@ -14,7 +14,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import logging
+import re
 import threading
 import time
 import uuid
@@ -69,6 +71,26 @@ class Dummy(object):
         setattr(self, key, value)
 
 
+class FakeCompute(object):
+    '''
+    The compute API proxy of the fake cloud. It is never cached.
+    '''
+
+    def __init__(self, cloud):
+        self._cloud = cloud
+
+    def servers(self, details=True, **query):
+        self._cloud.calls['compute.servers'] += 1
+        servers = list(self._cloud._server_list)
+        # Like nova, the name is matched as a regular expression
+        name = query.pop('name', None)
+        if name:
+            servers = [server for server in servers
+                       if re.search(name, server.name)]
+        return [server for server in servers
+                if all(server.get(k) == v for k, v in query.items())]
+
+
 class FakeOpenStackCloud(object):
     log = logging.getLogger("nodepool.FakeOpenStackCloud")
 
@@ -78,6 +100,9 @@ class FakeOpenStackCloud(object):
 
     def __init__(self, images=None, networks=None):
         self.pause_creates = False
+        # The number of API calls by method, to compare the cost of the
+        # ways of polling and looking up resources.
+        self.calls = collections.Counter()
         self._image_list = images
         if self._image_list is None:
             self._image_list = [
@@ -104,6 +129,7 @@ class FakeOpenStackCloud(object):
         ]
         self._azs = ['az1', 'az2']
         self._server_list = []
+        self.compute = FakeCompute(self)
         self.max_cores, self.max_instances, self.max_ram = FakeOpenStackCloud.\
             _get_quota()
         self._down_ports = [
@@ -242,6 +268,7 @@ class FakeOpenStackCloud(object):
             name=name, **metadata)
 
     def list_flavors(self, get_extra=False):
+        self.calls['list_flavors'] += 1
         return self._flavor_list
 
     def get_openstack_vars(self, server):
@@ -253,9 +280,32 @@ class FakeOpenStackCloud(object):
         return server
 
     def create_server(self, **kw):
-        return self._create(self._server_list, **kw)
+        self.calls['create_server'] += 1
+        min_count = kw.pop('min_count', 1)
+        max_count = kw.pop('max_count', 1)
+        # Like nova, a multiple create creates as many servers as the
+        # quota allows, but at least min_count of them, and numbers their
+        # names unless it creates a single one.
+        count = max_count
+        if self.max_instances > -1:
+            count = min(count, max(
+                self.max_instances - len(self._server_list), min_count))
+        if count == 1:
+            return self._create(self._server_list, **kw)
+        servers = []
+        for i in range(count):
+            args = dict(kw, name='%s-%d' % (kw['name'], i + 1),
+                        meta=dict(kw.get('meta', {})))
+            try:
+                servers.append(self._create(self._server_list, **args))
+            except openstack.exceptions.OpenStackCloudException:
+                for server in servers:
+                    self._delete(server.id, self._server_list)
+                raise
+        return servers[0]
 
     def get_server(self, name_or_id):
+        self.calls['get_server'] += 1
         result = self._get(name_or_id, self._server_list)
         return result
 
@@ -267,16 +317,25 @@ class FakeOpenStackCloud(object):
 
     def wait_for_server(self, server, **kwargs):
         while server.status == 'BUILD':
+            # Like openstacksdk, every poll costs a get_server call.
+            self.calls['get_server'] += 1
             time.sleep(0.1)
         auto_ip = kwargs.get('auto_ip')
         if not auto_ip:
             server = self._clean_floating_ip(server)
         return server
 
-    def list_servers(self):
-        return self._server_list
+    def list_servers(self, filters=None):
+        self.calls['list_servers'] += 1
+        servers = list(self._server_list)
+        if filters:
+            servers = [server for server in servers
+                       if all(server.get(k) == v
+                              for k, v in filters.items())]
+        return servers
 
     def delete_server(self, name_or_id, delete_ips=True):
+        self.calls['delete_server'] += 1
         self._delete(name_or_id, self._server_list)
 
     def list_availability_zone_names(self):
@@ -23,6 +23,7 @@ from openshift import config
 from nodepool import exceptions
 from nodepool.driver import Provider
 from nodepool.driver.kubernetes import handler
+from nodepool.nodeutils import iterate_timeout, POLL_MODERATE
 
 urllib3.disable_warnings()
 
@@ -272,16 +273,14 @@ class KubernetesProvider(Provider):
             'restartPolicy': 'Never',
         }
         self.k8s_client.create_namespaced_pod(namespace, pod_body)
-        for retry in range(300):
+        for count in iterate_timeout(
+                300, exceptions.LaunchNodepoolException,
+                "pod %s in %s to initialize" % (label.name, namespace),
+                profile=POLL_MODERATE, name='kubernetes.pod-start'):
             pod = self.k8s_client.read_namespaced_pod(label.name, namespace)
             if pod.status.phase == "Running":
                 break
             self.log.debug("%s: pod status is %s", namespace, pod.status.phase)
-            time.sleep(1)
-        if retry == 299:
-            raise exceptions.LaunchNodepoolException(
-                "%s: pod failed to initialize (%s)" % (
-                    namespace, pod.status.phase))
         resource["pod"] = label.name
         return resource
 
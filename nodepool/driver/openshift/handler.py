@@ -89,15 +89,11 @@ class OpenshiftNodeRequestHandler(NodeRequestHandler):
 
     def __init__(self, pw, request):
         super().__init__(pw, request)
-        self._threads = []
+        self._futures = []
 
     @property
     def alive_thread_count(self):
-        count = 0
-        for t in self._threads:
-            if t.isAlive():
-                count += 1
-        return count
+        return len([f for f in self._futures if not f.done()])
 
     def imagesAvailable(self):
         return True
@@ -109,7 +105,7 @@ class OpenshiftNodeRequestHandler(NodeRequestHandler):
         When all of the Node objects have reached a final state (READY or
         FAILED), we'll know all threads have finished the launch process.
         '''
-        if not self._threads:
+        if not self._futures:
             return True
 
         # Give the NodeLaunch threads time to finish.
@@ -133,6 +129,5 @@ class OpenshiftNodeRequestHandler(NodeRequestHandler):
 
     def launch(self, node):
         label = self.pool.labels[node.type[0]]
-        thd = OpenShiftLauncher(self, node, self.provider, label)
-        thd.start()
-        self._threads.append(thd)
+        launcher = OpenShiftLauncher(self, node, self.provider, label)
+        self._futures.append(launcher.submit(self.manager))
@@ -24,6 +24,7 @@ from openshift import config
 from nodepool import exceptions
 from nodepool.driver import Provider
 from nodepool.driver.openshift import handler
+from nodepool.nodeutils import iterate_timeout, POLL_MODERATE
 
 urllib3.disable_warnings()
 
@@ -222,16 +223,14 @@ class OpenshiftProvider(Provider):
             'restartPolicy': 'Never',
         }
         self.k8s_client.create_namespaced_pod(project, pod_body)
-        for retry in range(300):
+        for count in iterate_timeout(
+                300, exceptions.LaunchNodepoolException,
+                "pod %s in %s to initialize" % (label.name, project),
+                profile=POLL_MODERATE, name='openshift.pod-start'):
             pod = self.k8s_client.read_namespaced_pod(label.name, project)
             if pod.status.phase == "Running":
                 break
             self.log.debug("%s: pod status is %s", project, pod.status.phase)
-            time.sleep(1)
-        if retry == 299:
-            raise exceptions.LaunchNodepoolException(
-                "%s: pod failed to initialize (%s)" % (
-                    project, pod.status.phase))
 
     def getRequestHandler(self, poolworker, request):
         return handler.OpenshiftNodeRequestHandler(poolworker, request)
@@ -21,6 +21,12 @@ from nodepool.driver import ProviderConfig
 from nodepool.driver import ConfigValue
 from nodepool.driver import ConfigPool
 
+# The number of metadata items nova allows on a server by default, and
+# how many of them nodepool sets on a server of a launch batch besides an
+# item per node of the batch and the instance properties.
+MAX_SERVER_METADATA_ITEMS = 128
+BATCH_SERVER_METADATA_ITEMS = 5
+
 
 class ProviderDiskImage(ConfigValue):
     def __init__(self):
@@ -205,6 +211,16 @@ class ProviderPool(ConfigPool):
             pl.volume_size = label.get('volume-size', 50)
             pl.instance_properties = label.get('instance-properties',
                                                None)
+            if provider.launch_batch_size > 1:
+                meta_items = (provider.launch_batch_size +
+                              len(pl.instance_properties or {}) +
+                              BATCH_SERVER_METADATA_ITEMS)
+                if meta_items > MAX_SERVER_METADATA_ITEMS:
+                    raise ValueError(
+                        "launch-batch-size %s of provider %s exceeds the "
+                        "%s metadata items of a server with label %s" %
+                        (provider.launch_batch_size, provider.name,
+                         MAX_SERVER_METADATA_ITEMS, pl.name))
             pl.userdata = label.get('userdata', None)
 
             top_label = full_config.labels[pl.name]
@@ -220,6 +236,11 @@ class OpenStackProviderConfig(ProviderConfig):
         self.rate = None
         self.boot_timeout = None
         self.launch_timeout = None
+        self.launch_pipeline_workers = None
+        self.launch_batch_size = None
+        self.status_poll_interval = None
+        self.instance_list_ttl = None
+        self.lookup_cache_ttl = None
         self.clean_floating_ips = None
         self.diskimages = {}
         self.cloud_images = {}
@@ -236,6 +257,13 @@ class OpenStackProviderConfig(ProviderConfig):
                     other.rate == self.rate and
                     other.boot_timeout == self.boot_timeout and
                     other.launch_timeout == self.launch_timeout and
+                    (other.launch_pipeline_workers ==
+                     self.launch_pipeline_workers) and
+                    other.launch_batch_size == self.launch_batch_size and
+                    (other.status_poll_interval ==
+                     self.status_poll_interval) and
+                    other.instance_list_ttl == self.instance_list_ttl and
+                    other.lookup_cache_ttl == self.lookup_cache_ttl and
                     other.clean_floating_ips == self.clean_floating_ips and
                     other.diskimages == self.diskimages and
                     other.cloud_images == self.cloud_images)
@@ -267,6 +295,15 @@ class OpenStackProviderConfig(ProviderConfig):
         self.boot_timeout = self.provider.get('boot-timeout', 60)
         self.launch_timeout = self.provider.get('launch-timeout', 3600)
         self.launch_retries = self.provider.get('launch-retries', 3)
+        self.launch_pipeline_workers = self.provider.get(
+            'launch-pipeline-workers', 0)
+        self.launch_batch_size = self.provider.get('launch-batch-size', 1)
+        self.status_poll_interval = float(
+            self.provider.get('status-poll-interval', 0))
+        self.instance_list_ttl = float(
+            self.provider.get('instance-list-ttl', 0))
+        self.lookup_cache_ttl = float(
+            self.provider.get('lookup-cache-ttl', 3600))
         self.clean_floating_ips = self.provider.get('clean-floating-ips')
         self.hostname_format = self.provider.get(
             'hostname-format',
@@ -396,6 +433,11 @@ class OpenStackProviderConfig(ProviderConfig):
             'boot-timeout': int,
             'launch-timeout': int,
             'launch-retries': int,
+            'launch-pipeline-workers': int,
+            'launch-batch-size': int,
+            'status-poll-interval': v.Coerce(float),
+            'instance-list-ttl': v.Coerce(float),
+            'lookup-cache-ttl': v.Coerce(float),
             'nodepool-id': str,
             'rate': v.Coerce(float),
             'hostname-format': str,
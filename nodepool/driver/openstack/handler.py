@@ -13,9 +13,13 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import concurrent.futures
+import logging
 import math
 import pprint
 import random
+import threading
+import time
 
 from kazoo import exceptions as kze
 import openstack
@@ -23,7 +27,8 @@ import openstack
 from nodepool import exceptions
 from nodepool import nodeutils as utils
 from nodepool import zk
-from nodepool.driver.utils import NodeLauncher, QuotaInformation
+from nodepool.driver.utils import LaunchBatch, NodeLauncher
+from nodepool.driver.utils import QuotaInformation
 from nodepool.driver import NodeRequestHandler
 
 
@@ -48,6 +53,8 @@ class OpenStackNodeLauncher(NodeLauncher):
         self.pool = provider_label.pool
         self.handler = handler
         self.zk = handler.zk
+        # The LaunchBatch this launch is part of, if any.
+        self.batch = None
 
     def _logConsole(self, server_id, hostname):
         if not self.label.console_log:
@@ -58,7 +65,20 @@ class OpenStackNodeLauncher(NodeLauncher):
             for line in console.splitlines():
                 self.log.debug(line.rstrip())
 
-    def _launchNode(self):
+    @property
+    def hostname(self):
+        return self.provider_config.hostname_format.format(
+            label=self.label, provider=self.provider_config, node=self.node
+        )
+
+    def serverArgs(self):
+        '''
+        Collect the arguments to create the server of the node with.
+
+        :returns: A tuple of the keyword arguments of createServer() of the
+            provider, besides the name of the server, and a dict of the
+            attributes of the node which depend on its image.
+        '''
         if self.label.diskimage:
             diskimage = self.provider_config.diskimages[
                 self.label.diskimage.name]
@@ -108,68 +128,95 @@ class OpenStackNodeLauncher(NodeLauncher):
             connection_type = self.label.cloud_image.connection_type
             connection_port = self.label.cloud_image.connection_port
 
-        hostname = self.provider_config.hostname_format.format(
-            label=self.label, provider=self.provider_config, node=self.node
-        )
-
-        self.log.info("Creating server with hostname %s in %s from image %s "
-                      "for node id: %s" % (hostname,
-                                           self.provider_config.name,
-                                           image_name,
-                                           self.node.id))
-
         # NOTE: We store the node ID in the server metadata to use for leaked
         # instance detection. We cannot use the external server ID for this
         # because that isn't available in ZooKeeper until after the server is
         # active, which could cause a race in leak detection.
+        args = dict(image=image_external,
+                    min_ram=self.label.min_ram,
+                    flavor_name=self.label.flavor_name,
+                    key_name=self.label.key_name,
+                    az=self.node.az,
+                    config_drive=config_drive,
+                    nodepool_node_id=self.node.id,
+                    nodepool_node_label=self.node.type[0],
+                    nodepool_image_name=image_name,
+                    networks=self.pool.networks,
+                    security_groups=self.pool.security_groups,
+                    boot_from_volume=self.label.boot_from_volume,
+                    volume_size=self.label.volume_size,
+                    instance_properties=self.label.instance_properties,
+                    userdata=self.label.userdata)
+        attributes = dict(image_id=image_id,
+                          username=username,
+                          connection_type=connection_type,
+                          connection_port=connection_port)
+        return args, attributes
+
+    def createServer(self):
+        '''
+        Create the server of the node.
 
-        try:
-            server = self.handler.manager.createServer(
-                hostname,
-                image=image_external,
-                min_ram=self.label.min_ram,
-                flavor_name=self.label.flavor_name,
-                key_name=self.label.key_name,
-                az=self.node.az,
-                config_drive=config_drive,
-                nodepool_node_id=self.node.id,
-                nodepool_node_label=self.node.type[0],
-                nodepool_image_name=image_name,
-                networks=self.pool.networks,
-                security_groups=self.pool.security_groups,
-                boot_from_volume=self.label.boot_from_volume,
-                volume_size=self.label.volume_size,
-                instance_properties=self.label.instance_properties,
-                userdata=self.label.userdata)
-        except openstack.cloud.exc.OpenStackCloudCreateException as e:
-            if e.resource_id:
-                self.node.external_id = e.resource_id
-                # The outer exception handler will handle storing the
-                # node immediately after this.
-            raise
+        This is the first stage of a launch. The node is checkpointed once
+        the server was created. If the launch is part of a batch, the server
+        created for it by the batch is used instead.
+
+        :returns: The server which was created.
+        '''
+        args, attributes = self.serverArgs()
+        hostname = self.hostname
+
+        server = None
+        if self.batch:
+            server = self.batch.claim(self)
+        if server is not None:
+            # The server is named after the batch, the node keeps its own
+            # hostname.
+            self.log.info("Using server %s named %s created in a batch "
+                          "for node id: %s" % (server.id, server.name,
+                                               self.node.id))
+        else:
+            self.log.info("Creating server with hostname %s in %s from "
+                          "image %s for node id: %s" % (
+                              hostname,
+                              self.provider_config.name,
+                              args['nodepool_image_name'],
+                              self.node.id))
+            try:
+                server = self.handler.manager.createServer(hostname, **args)
+            except openstack.cloud.exc.OpenStackCloudCreateException as e:
+                if e.resource_id:
+                    self.node.external_id = e.resource_id
+                    # The outer exception handler will handle storing the
+                    # node immediately after this.
+                raise
 
         self.node.external_id = server.id
         self.node.hostname = hostname
-        self.node.image_id = image_id
+        self.node.image_id = attributes['image_id']
 
         pool = self.handler.provider.pools.get(self.node.pool)
         resources = self.handler.manager.quotaNeededByNodeType(
             self.node.type[0], pool)
         self.node.resources = resources.quota['compute']
-        if username:
-            self.node.username = username
-        self.node.connection_type = connection_type
-        self.node.connection_port = connection_port
+        if attributes['username']:
+            self.node.username = attributes['username']
+        self.node.connection_type = attributes['connection_type']
+        self.node.connection_port = attributes['connection_port']
 
         # Checkpoint save the updated node info
         self.zk.storeNode(self.node)
+        return server
 
-        self.log.debug("Waiting for server %s for node id: %s" %
-                       (server.id, self.node.id))
-        server = self.handler.manager.waitForServer(
-            server, self.provider_config.launch_timeout,
-            auto_ip=self.pool.auto_floating_ip)
+    def serverActive(self, server):
+        '''
+        Record the addresses of the server once it finished building.
 
+        This is the second stage of a launch. The node is checkpointed with
+        its addresses.
+
+        :param server: The server as returned by waitForServer().
+        '''
         if server.status != 'ACTIVE':
             raise exceptions.LaunchStatusException("Server %s for node id: %s "
                                                    "status: %s" %
@@ -211,32 +258,113 @@ class OpenStackNodeLauncher(NodeLauncher):
              self.node.interface_ip, self.node.public_ipv4,
              self.node.public_ipv6, self.node.host_id))
 
+    @property
+    def gather_host_keys(self):
+        # only gather host keys if the connection type is ssh or
+        # network_cli
+        return (self.node.connection_type == 'ssh' or
+                self.node.connection_type == 'network_cli')
+
+    def scanNode(self):
+        '''
+        Start scanning the node for its host keys.
+
+        This is the last stage of a launch if host key checking is enabled.
+
+        :returns: A Future of the host keys.
+        '''
+        self.log.debug("Gathering host keys for node %s", self.node.id)
+        return utils.KeyscanService.get().scan(
+            self.node.interface_ip,
+            timeout=self.provider_config.boot_timeout,
+            gather_hostkeys=self.gather_host_keys,
+            port=self.node.connection_port)
+
+    def nodeScanned(self, scan):
+        '''
+        Record the host keys of the node once it was scanned.
+
+        :param Future scan: The Future returned by scanNode().
+        '''
+        try:
+            host_keys = scan.result()
+        except exceptions.ConnectionTimeoutException:
+            self._logConsole(self.node.external_id, self.node.hostname)
+            raise
+
+        if self.gather_host_keys and not host_keys:
+            raise exceptions.LaunchKeyscanException(
+                "Unable to gather host keys")
+        self.node.host_keys = host_keys
+        self.zk.storeNode(self.node)
+
+    def _launchNode(self):
+        server = self.createServer()
+
+        self.log.debug("Waiting for server %s for node id: %s" %
+                       (server.id, self.node.id))
+        server = self.handler.manager.waitForServer(
+            server, self.provider_config.launch_timeout,
+            auto_ip=self.pool.auto_floating_ip)
+
+        self.serverActive(server)
+
         # wait and scan the new node and record in ZooKeeper
-        host_keys = []
         if self.pool.host_key_checking:
-            try:
-                self.log.debug(
-                    "Gathering host keys for node %s", self.node.id)
-                # only gather host keys if the connection type is ssh or
-                # network_cli
-                gather_host_keys = (
-                    connection_type == 'ssh' or
-                    connection_type == 'network_cli')
-                host_keys = utils.nodescan(
-                    interface_ip,
-                    timeout=self.provider_config.boot_timeout,
-                    gather_hostkeys=gather_host_keys,
-                    port=connection_port)
-
-                if gather_host_keys and not host_keys:
-                    raise exceptions.LaunchKeyscanException(
-                        "Unable to gather host keys")
-            except exceptions.ConnectionTimeoutException:
-                self._logConsole(self.node.external_id, self.node.hostname)
-                raise
+            self.nodeScanned(self.scanNode())
+        else:
+            self.node.host_keys = []
+            self.zk.storeNode(self.node)
 
-        self.node.host_keys = host_keys
+    def launchAttemptFailed(self, e, attempts):
+        '''
+        Clean up after a failed launch attempt.
+
+        The server of the attempt, if any, is scheduled for deletion. This
+        must be called while handling the exception of the attempt, which
+        is re-raised if the launch is not to be retried.
+
+        :param Exception e: The exception the attempt failed with.
+        :param int attempts: The number of the attempt.
+        '''
+        if attempts <= self._retries:
+            self.log.exception(
+                "Request %s: Launch attempt %d/%d failed for node %s:",
+                self.handler.request.id, attempts,
+                self._retries, self.node.id)
+        # If we created an instance, delete it.
+        if self.node.external_id:
+            deleting_node = zk.Node()
+            deleting_node.provider = self.node.provider
+            deleting_node.pool = self.node.pool
+            deleting_node.type = self.node.type
+            deleting_node.external_id = self.node.external_id
+            deleting_node.state = zk.DELETING
+            self.zk.storeNode(deleting_node)
+            self.log.info(
+                "Request %s: Node %s scheduled for cleanup",
+                self.handler.request.id, deleting_node.external_id)
+            self.node.external_id = None
+            self.node.public_ipv4 = None
+            self.node.public_ipv6 = None
+            self.node.interface_ip = None
+            self.zk.storeNode(self.node)
+        if attempts == self._retries:
+            raise
+        if 'quota exceeded' in str(e).lower():
+            # A quota exception is not directly recoverable so bail
+            # out immediately with a specific exception.
+            self.log.info("Quota exceeded, invalidating quota cache")
+            self.handler.manager.invalidateQuotaCache()
+            raise exceptions.QuotaException("Quota exceeded")
+
+    def launchSucceeded(self):
+        '''
+        Mark the node as ready.
+        '''
+        self.node.state = zk.READY
         self.zk.storeNode(self.node)
+        self.log.info("Node id %s is ready", self.node.id)
 
     def launch(self):
         attempts = 1
@@ -249,41 +377,266 @@ class OpenStackNodeLauncher(NodeLauncher):
                 # so there's no need to continue.
                 raise
             except Exception as e:
-                if attempts <= self._retries:
-                    self.log.exception(
-                        "Request %s: Launch attempt %d/%d failed for node %s:",
-                        self.handler.request.id, attempts,
-                        self._retries, self.node.id)
-                # If we created an instance, delete it.
-                if self.node.external_id:
-                    deleting_node = zk.Node()
-                    deleting_node.provider = self.node.provider
-                    deleting_node.pool = self.node.pool
-                    deleting_node.type = self.node.type
-                    deleting_node.external_id = self.node.external_id
-                    deleting_node.state = zk.DELETING
-                    self.zk.storeNode(deleting_node)
-                    self.log.info(
-                        "Request %s: Node %s scheduled for cleanup",
-                        self.handler.request.id, deleting_node.external_id)
-                    self.node.external_id = None
-                    self.node.public_ipv4 = None
-                    self.node.public_ipv6 = None
-                    self.node.interface_ip = None
-                    self.zk.storeNode(self.node)
-                if attempts == self._retries:
-                    raise
-                if 'quota exceeded' in str(e).lower():
-                    # A quota exception is not directly recoverable so bail
-                    # out immediately with a specific exception.
-                    self.log.info("Quota exceeded, invalidating quota cache")
-                    self.handler.manager.invalidateQuotaCache()
-                    raise exceptions.QuotaException("Quota exceeded")
+                self.launchAttemptFailed(e, attempts)
                 attempts += 1
 
-        self.node.state = zk.READY
-        self.zk.storeNode(self.node)
-        self.log.info("Node id %s is ready", self.node.id)
+        self.launchSucceeded()
+
+
+class PipelineLaunch(object):
+    '''
+    The state of a node launch in a LaunchPipeline.
+    '''
+
+    def __init__(self, launcher):
+        self.launcher = launcher
+        self.future = concurrent.futures.Future()
+        self.stage = LaunchPipeline.CREATE
+        self.attempts = 1
+        self.start_time = time.monotonic()
+        # Whether a worker is currently advancing the launch.
+        self.busy = False
+        self.server = None
+        # The monotonic time the server has to be active by.
+        self.deadline = None
+        # The Future of the keyscan of the node.
+        self.scan = None
+
+
+class LaunchPipeline(object):
+    '''
+    Advance the node launches of a provider through their stages.
+
+    Rather than holding a thread for the whole lifetime of a launch, every
+    launch is a small state machine which is advanced by a few workers:
+    the server is created, then awaited until it is active, then its
+    addresses are collected, and finally the node is scanned for its host
+    keys. The servers of all the launches waiting for one are checked with
+    a single listing, and keyscans are left to the KeyscanService until
+    they completed, so no worker ever sleeps on behalf of a launch. Only
+    collecting the addresses of a server, which may assign it a floating
+    IP, blocks a worker, and only for that one launch.
+
+    The node checkpoints and the retries of the launches are the same as
+    if they ran in a thread of their own.
+    '''
+
+    log = logging.getLogger("nodepool.driver.openstack.LaunchPipeline")
+
+    CREATE = 'create'
+    WAIT = 'wait'
+    ADDRESS = 'address'
+    KEYSCAN = 'keyscan'
+    DONE = 'done'
+
+    # How long to sleep between checks of the servers being built
+    interval = 1
+
+    def __init__(self, provider_name, workers):
+        '''
+        :param str provider_name: The name of the provider.
+        :param int workers: The number of threads advancing the launches.
+        '''
+        self.provider_name = provider_name
+        self.workers = workers
+        self._launches = []
+        self._lock = threading.Lock()
+        self._wake_event = threading.Event()
+        self._stopped = False
+        self._last_check = 0
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix='LaunchPipelineWorker-%s' % provider_name)
+        # Started along with the first launch.
+        self._thread = None
+
+    def stop(self):
+        '''
+        Stop the pipeline once the launches in it completed.
+
+        Launches submitted afterwards are handed to the launch executor
+        of the provider.
+        '''
+        with self._lock:
+            self._stopped = True
+        self._wake_event.set()
+
+    def join(self):
+        if self._thread:
+            self._thread.join()
+
+    def submit(self, launcher, statsd=None):
+        '''
+        Submit a node launch.
+
+        :param OpenStackNodeLauncher launcher: The launch to advance. Its
+            thread is never started.
+        :param statsd: An optional statsd client, used if the launch has
+            to be handed to the launch executor.
+
+        :returns: A Future of the launch.
+        '''
+        with self._lock:
+            if self._stopped:
+                launch = None
+            else:
+                launch = PipelineLaunch(launcher)
+                launch.future.set_running_or_notify_cancel()
+                self._launches.append(launch)
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._run,
+                        name='LaunchPipeline-%s' % self.provider_name)
+                    self._thread.start()
+        if launch is None:
+            return launcher.handler.manager.launch_executor.submit(
+                launcher, statsd)
+        self._wake_event.set()
+        return launch.future
+
+    def _run(self):
+        while True:
+            # Anything happening from now on is either seen by this pass
+            # or wakes us up for the next one.
+            self._wake_event.clear()
+            with self._lock:
+                if self._stopped and not self._launches:
+                    break
+                launches = [launch for launch in self._launches
+                            if not launch.busy]
+
+            now = time.monotonic()
+            check_servers = now - self._last_check >= self.interval
+            waiting = []
+            for launch in launches:
+                if launch.stage == self.WAIT:
+                    if check_servers:
+                        waiting.append(launch)
+                elif launch.stage == self.CREATE:
+                    self._schedule([launch], self._create)
+                elif launch.stage == self.ADDRESS:
+                    self._schedule([launch], self._address)
+                elif launch.stage == self.KEYSCAN:
+                    if launch.scan.done():
+                        self._schedule([launch], self._keyscan)
+            if waiting:
+                # The servers of the waiting launches are checked together
+                self._last_check = now
+                for launch in waiting:
+                    launch.busy = True
+                self._executor.submit(self._checkServers, waiting)
+
+            self._wake_event.wait(self.interval)
+
+        self._executor.shutdown(wait=True)
+
+    def _schedule(self, launches, stage):
+        for launch in launches:
+            launch.busy = True
+        self._executor.submit(self._advance, launches, stage)
+
+    def _advance(self, launches, stage):
+        for launch in launches:
+            try:
+                self._step(launch, stage)
+            except Exception:
+                self.log.exception("Exception advancing launch of node %s:",
+                                   launch.launcher.node.id)
+            with self._lock:
+                launch.busy = False
+        self._wake_event.set()
+
+    def _step(self, launch, stage):
+        launcher = launch.launcher
+        try:
+            try:
+                stage(launch)
+            except kze.SessionExpiredError:
+                # If we lost our ZooKeeper session, we've lost our node lock
+                # so there's no need to continue.
+                raise
+            except Exception as e:
+                launcher.launchAttemptFailed(e, launch.attempts)
+                launch.attempts += 1
+                launch.stage = self.CREATE
+                return
+            if launch.stage == self.DONE:
+                launcher.launchSucceeded()
+        except Exception as e:
+            launch.stage = self.DONE
+            try:
+                launcher.finishLaunch(launch.start_time, e)
+            finally:
+                self._complete(launch)
+            return
+        if launch.stage == self.DONE:
+            try:
+                launcher.finishLaunch(launch.start_time)
+            finally:
+                self._complete(launch)
+
+    def _complete(self, launch):
+        with self._lock:
+            self._launches.remove(launch)
+        launch.future.set_result(None)
+
+    def _create(self, launch):
+        launcher = launch.launcher
+        launch.server = launcher.createServer()
+        launch.deadline = (time.monotonic() +
+                           launcher.provider_config.launch_timeout)
+        launch.stage = self.WAIT
+        launcher.log.debug("Waiting for server %s for node id: %s" %
+                           (launch.server.id, launcher.node.id))
+
+    def _checkServers(self, launches):
+        # The launches of a pipeline all share the provider manager.
+        manager = launches[0].launcher.handler.manager
+        try:
+            servers = manager.checkServers(
+                [launch.server.id for launch in launches])
+        except Exception as e:
+            error = e
+        else:
+            error = None
+
+        def wait(launch):
+            if error:
+                raise error
+            self._wait(launch, servers.get(launch.server.id))
+        self._advance(launches, wait)
+
+    def _wait(self, launch, server):
+        if server is None:
+            if time.monotonic() >= launch.deadline:
+                raise exceptions.TimeoutException(
+                    "Timeout waiting for server %s to come up" %
+                    launch.server.id)
+            return
+        launch.server = server
+        launch.stage = self.ADDRESS
+
+    def _address(self, launch):
+        launcher = launch.launcher
+        remaining = launch.deadline - time.monotonic()
+        server = launcher.handler.manager.waitForServerAddresses(
+            launch.server, timeout=max(remaining, 1),
+            auto_ip=launcher.pool.auto_floating_ip)
+
+        launcher.serverActive(server)
+        if not launcher.pool.host_key_checking:
+            launcher.node.host_keys = []
+            launcher.zk.storeNode(launcher.node)
+            launch.stage = self.DONE
+            return
+
+        launch.scan = launcher.scanNode()
+        launch.scan.add_done_callback(lambda f: self._wake_event.set())
+        launch.stage = self.KEYSCAN
+
+    def _keyscan(self, launch):
+        launch.launcher.nodeScanned(launch.scan)
+        launch.stage = self.DONE
 
 
 class OpenStackNodeRequestHandler(NodeRequestHandler):
@@ -291,15 +644,11 @@ class OpenStackNodeRequestHandler(NodeRequestHandler):
     def __init__(self, pw, request):
         super().__init__(pw, request)
         self.chosen_az = None
-        self._threads = []
+        self._futures = []
 
     @property
     def alive_thread_count(self):
-        count = 0
-        for t in self._threads:
-            if t.isAlive():
-                count += 1
-        return count
+        return len([f for f in self._futures if not f.done()])
 
     def imagesAvailable(self):
         '''
@@ -416,7 +765,7 @@ class OpenStackNodeRequestHandler(NodeRequestHandler):
         When all of the Node objects have reached a final state (READY, FAILED
         or ABORTED), we'll know all threads have finished the launch process.
         '''
-        if not self._threads:
+        if not self._futures:
             return True
 
         # Give the NodeLaunch threads time to finish.
@@ -435,6 +784,35 @@ class OpenStackNodeRequestHandler(NodeRequestHandler):
 
     def launch(self, node):
         label = self.pool.labels[node.type[0]]
-        thd = OpenStackNodeLauncher(self, node, self.provider, label)
-        thd.start()
-        self._threads.append(thd)
+        launcher = OpenStackNodeLauncher(self, node, self.provider, label)
+        self._futures.append(launcher.submit(
+            self.manager, self.manager.launch_pipeline))
+
+    def launchBatch(self, nodes):
+        '''
+        Launch the nodes, creating the servers of a label together.
+
+        If the provider has a launch batch size, the servers of the nodes
+        sharing a label are created with a single request per batch of up to
+        that many nodes. Otherwise, every node is launched on its own.
+        '''
+        if self.provider.launch_batch_size <= 1:
+            return super().launchBatch(nodes)
+
+        launchers = [
+            OpenStackNodeLauncher(self, node, self.provider,
+                                  self.pool.labels[node.type[0]])
+            for node in nodes]
+        LaunchBatch.assign(launchers, self.provider.launch_batch_size,
+                           self._createServers)
+        for launcher in launchers:
+            self._futures.append(launcher.submit(
+                self.manager, self.manager.launch_pipeline))
+
+    def _createServers(self, launchers):
+        args = launchers[0].serverArgs()[0]
+        del args['nodepool_node_id']
+        return self.manager.createServers(
+            '%s-%s' % (launchers[0].label.name, self.provider.name),
+            [launcher.node.id for launcher in launchers],
+            **args)
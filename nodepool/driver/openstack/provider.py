@@ -18,14 +18,18 @@ import copy
 import logging
 import operator
 import os
+import re
+import threading
 import time
+import uuid
 
 import openstack
 
 from nodepool import exceptions
 from nodepool.driver import Provider
+from nodepool.driver.utils import InstanceListCache, LookupCache
 from nodepool.driver.utils import QuotaInformation
-from nodepool.nodeutils import iterate_timeout
+from nodepool.nodeutils import iterate_timeout, POLL_MODERATE
 from nodepool import stats
 from nodepool import version
 from nodepool import zk
@@ -33,47 +37,200 @@ from nodepool import zk
 # Import entire module to avoid partial-loading, circular import
 from nodepool.driver.openstack import handler
 
+# How long at most to remember that a flavor, image or network does not
+# exist, in seconds.
+LOOKUP_NEGATIVE_TTL = 60
+
 
 IPS_LIST_AGE = 5      # How long to keep a cached copy of the ip list
 MAX_QUOTA_AGE = 5 * 60  # How long to keep the quota information cached
 
 
+class ServerStatusPoller(object):
+    '''
+    Poll the status of the servers of a provider with a single listing.
+
+    Rather than every launch and deletion polling its own server, the
+    servers are listed at most once per interval, and every waiter is woken
+    up with the result of each listing. The poller only lists the servers
+    while somebody waits on them.
+    '''
+
+    log = logging.getLogger("nodepool.driver.openstack.ServerStatusPoller")
+
+    def __init__(self, provider_name, list_servers, interval):
+        '''
+        :param str provider_name: The name of the provider.
+        :param list_servers: A callable listing the servers of the provider.
+        :param float interval: The minimum time between listings.
+        '''
+        self.provider_name = provider_name
+        self.interval = interval
+        self._list_servers = list_servers
+        self._condition = threading.Condition()
+        self._list_lock = threading.Lock()
+        self._servers = {}
+        self._listed = None
+        # Incremented with every listing, so waiters can tell whether
+        # they saw it already.
+        self._generation = 0
+        self._waiters = 0
+        self._stopped = False
+        # Started along with the first wait.
+        self._thread = None
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+    def join(self):
+        if self._thread:
+            self._thread.join()
+
+    def _list(self):
+        try:
+            servers = {server.id: server for server in self._list_servers()}
+        except Exception:
+            self.log.exception("Unable to list the servers of %s:",
+                               self.provider_name)
+            return
+        with self._condition:
+            self._servers = servers
+            self._listed = time.monotonic()
+            self._generation += 1
+            self._condition.notify_all()
+
+    def listServers(self):
+        '''
+        Get the servers of the provider.
+
+        The servers are only listed if the last listing is older than the
+        interval.
+
+        :returns: A dict of the servers by their id.
+        '''
+        with self._list_lock:
+            if (self._listed is None or
+                    time.monotonic() - self._listed >= self.interval):
+                self._list()
+            return self._servers
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not (self._waiters or self._stopped):
+                    self._condition.wait()
+                if self._stopped:
+                    return
+            self.listServers()
+            with self._condition:
+                self._condition.wait_for(lambda: self._stopped,
+                                         self.interval)
+
+    def waitFor(self, server_id, predicate, timeout, exc, purpose):
+        '''
+        Wait until a server as listed matches a predicate.
+
+        Only the listings made after the wait started are considered.
+
+        :param str server_id: The id of the server.
+        :param predicate: A callable which is passed the server as listed,
+            or None if it is not listed, and returns whether to stop
+            waiting.
+        :param float timeout: How long to wait for.
+        :param exc: The exception class to raise on timeout.
+        :param str purpose: What is waited for, for the timeout message.
+
+        :returns: The server as listed, or None if it is not listed.
+        '''
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run,
+                    name='ServerStatusPoller-%s' % self.provider_name)
+                self._thread.start()
+            self._waiters += 1
+            self._condition.notify_all()
+            try:
+                generation = self._generation
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise exc("Timeout waiting for %s" % purpose)
+                    self._condition.wait(remaining)
+                    if self._generation == generation:
+                        continue
+                    generation = self._generation
+                    server = self._servers.get(server_id)
+                    if predicate(server):
+                        return server
+            finally:
+                self._waiters -= 1
+
+
 class OpenStackProvider(Provider):
     log = logging.getLogger("nodepool.driver.openstack.OpenStackProvider")
 
     def __init__(self, provider):
         self.provider = provider
-        self._images = {}
-        self._networks = {}
-        self.__flavors = {}  # TODO(gtema): caching
-        self.__azs = None
+        ttl = provider.lookup_cache_ttl
+        negative_ttl = min(ttl, LOOKUP_NEGATIVE_TTL)
+        self._images = LookupCache(
+            lambda name: self._client.get_image(name), ttl, negative_ttl)
+        self._networks = LookupCache(
+            lambda name: self._client.get_network(name), ttl, negative_ttl)
+        # The flavors sorted by ram, and the flavor found by findFlavor()
+        # by flavor name and min ram.
+        self._flavors = LookupCache(lambda key: self._getFlavors(), ttl)
+        self._found_flavors = LookupCache(
+            self._lookupFlavor, ttl, negative_ttl)
+        self._azs = LookupCache(lambda key: self._getAZs(), ttl)
         self._current_nodepool_quota = None
         self._zk = None
         self._down_ports = set()
         self._last_port_cleanup = None
         self._port_cleanup_interval_secs = 180
         self._statsd = stats.get_client()
+        self.launch_pipeline = None
+        self._status_poller = None
+        self._server_list = None
 
     def start(self, zk_conn):
         self.resetClient()
         self._zk = zk_conn
+        if self.provider.launch_pipeline_workers:
+            self.launch_pipeline = handler.LaunchPipeline(
+                self.provider.name, self.provider.launch_pipeline_workers)
+        if self.provider.status_poll_interval:
+            self._status_poller = ServerStatusPoller(
+                self.provider.name, lambda: self._client.list_servers(),
+                self.provider.status_poll_interval)
+        if self.provider.instance_list_ttl:
+            self._server_list = InstanceListCache(
+                self.provider.name, lambda: self._client.list_servers(),
+                self.provider.instance_list_ttl)
 
     def stop(self):
-        pass
+        if self.launch_pipeline:
+            self.launch_pipeline.stop()
+        if self._status_poller:
+            self._status_poller.stop()
+        if self._server_list:
+            self._server_list.stop()
 
     def join(self):
-        pass
+        if self.launch_pipeline:
+            self.launch_pipeline.join()
+        if self._status_poller:
+            self._status_poller.join()
+        if self._server_list:
+            self._server_list.join()
 
     def getRequestHandler(self, poolworker, request):
         return handler.OpenStackNodeRequestHandler(poolworker, request)
 
-    # TODO(gtema): caching
-    @property
-    def _flavors(self):
-        if not self.__flavors:
-            self.__flavors = self._getFlavors()
-        return self.__flavors
-
     def _getClient(self):
         rate_limit = None
         # nodepool tracks rate limit in time between requests.
@@ -151,32 +308,30 @@ class OpenStackProvider(Provider):
         '''
         used_quota = QuotaInformation()
 
-        for node in self._zk.nodeIterator():
-            if node.provider == self.provider.name:
-                try:
-                    if pool and not node.pool == pool.name:
-                        continue
-                    provider_pool = self.provider.pools.get(node.pool)
-                    if not provider_pool:
-                        self.log.warning(
-                            "Cannot find provider pool for node %s" % node)
-                        # This node is in a funny state we log it for debugging
-                        # but move on and don't account it as we can't properly
-                        # calculate its cost without pool info.
-                        continue
-                    if node.type[0] not in provider_pool.labels:
-                        self.log.warning("Node type is not in provider pool "
-                                         "for node %s" % node)
-                        # This node is also in a funny state; the config
-                        # may have changed under it.  It should settle out
-                        # eventually when it's deleted.
-                        continue
-                    node_resources = self.quotaNeededByNodeType(
-                        node.type[0], provider_pool)
-                    used_quota.add(node_resources)
-                except Exception:
-                    self.log.exception("Couldn't consider invalid node %s "
-                                       "for quota:" % node)
+        pool_name = pool.name if pool else None
+        for node in self._zk.getProviderNodes(self.provider.name, pool_name):
+            try:
+                provider_pool = self.provider.pools.get(node.pool)
+                if not provider_pool:
+                    self.log.warning(
+                        "Cannot find provider pool for node %s" % node)
+                    # This node is in a funny state we log it for debugging
+                    # but move on and don't account it as we can't properly
+                    # calculate its cost without pool info.
+                    continue
+                if node.type[0] not in provider_pool.labels:
+                    self.log.warning("Node type is not in provider pool "
+                                     "for node %s" % node)
+                    # This node is also in a funny state; the config
+                    # may have changed under it.  It should settle out
+                    # eventually when it's deleted.
+                    continue
+                node_resources = self.quotaNeededByNodeType(
+                    node.type[0], provider_pool)
+                used_quota.add(node_resources)
+            except Exception:
+                self.log.exception("Couldn't consider invalid node %s "
+                                   "for quota:" % node)
         return used_quota
 
     def unmanagedQuotaUsed(self):
@@ -199,7 +354,7 @@ class OpenStackProvider(Provider):
                 # This provider (regardless of the launcher) owns this
                 # server so it must not be accounted for unmanaged
                 # quota; unless it has leaked.
-                nodepool_node_id = meta.get('nodepool_node_id')
+                nodepool_node_id = self.serverNodeId(server)
                 # FIXME(tobiash): Add a test case for this
                 if nodepool_node_id and nodepool_node_id in node_ids:
                     # It has not leaked.
@@ -222,17 +377,32 @@ class OpenStackProvider(Provider):
     #              openstacksdk, caching is not enabled there by default
     #              Remove it when caching is default
     def _findFlavorByName(self, flavor_name):
-        for f in self._flavors:
+        for f in self._flavors.get(None):
             if flavor_name in (f['name'], f['id']):
                 return f
-        raise Exception("Unable to find flavor: %s" % flavor_name)
+        return None
 
     def _findFlavorByRam(self, min_ram, flavor_name):
-        for f in self._flavors:
+        for f in self._flavors.get(None):
             if (f['ram'] >= min_ram
                     and (not flavor_name or flavor_name in f['name'])):
                 return f
-        raise Exception("Unable to find flavor with min ram: %s" % min_ram)
+        return None
+
+    def _lookupFlavor(self, key):
+        flavor_name, min_ram = key
+        # A flavor missing from the listing may have been added since it
+        # was made, so list the flavors again before giving up.
+        for listed in (False, True):
+            if listed:
+                self._flavors.invalidate()
+            if min_ram:
+                flavor = self._findFlavorByRam(min_ram, flavor_name)
+            else:
+                flavor = self._findFlavorByName(flavor_name)
+            if flavor is not None:
+                return flavor
+        return None
 
     def findFlavor(self, flavor_name, min_ram):
         # Note: this will throw an error if the provider is offline
@@ -248,41 +418,41 @@ class OpenStackProvider(Provider):
         # else:
         #     return self._client.get_flavor(flavor_name, get_extra=False)
 
-        if min_ram:
-            return self._findFlavorByRam(min_ram, flavor_name)
-        else:
-            return self._findFlavorByName(flavor_name)
+        flavor = self._found_flavors.get((flavor_name, min_ram))
+        if flavor is None:
+            if min_ram:
+                raise Exception(
+                    "Unable to find flavor with min ram: %s" % min_ram)
+            raise Exception("Unable to find flavor: %s" % flavor_name)
+        return flavor
 
-    def findImage(self, name):
-        if name in self._images:
-            return self._images[name]
+    def invalidateFlavors(self):
+        '''
+        Forget the flavors, so they are listed again when next needed.
+        '''
+        self._flavors.invalidate()
+        self._found_flavors.invalidate()
 
-        image = self._client.get_image(name)
-        self._images[name] = image
-        return image
+    def findImage(self, name):
+        return self._images.get(name)
 
     def findNetwork(self, name):
-        if name in self._networks:
-            return self._networks[name]
-
-        network = self._client.get_network(name)
-        self._networks[name] = network
-        return network
+        return self._networks.get(name)
 
     def deleteImage(self, name):
-        if name in self._images:
-            del self._images[name]
-
-        return self._client.delete_image(name)
-
-    def createServer(self, name, image,
-                     flavor_name=None, min_ram=None,
-                     az=None, key_name=None, config_drive=True,
-                     nodepool_node_id=None, nodepool_node_label=None,
-                     nodepool_image_name=None,
-                     networks=None, security_groups=None,
-                     boot_from_volume=False, volume_size=50,
-                     instance_properties=None, userdata=None):
+        try:
+            return self._client.delete_image(name)
+        finally:
+            self._images.invalidate(name)
+
+    def _getServerCreateArgs(self, name, image,
+                             flavor_name=None, min_ram=None,
+                             az=None, key_name=None, config_drive=True,
+                             nodepool_node_id=None, nodepool_node_label=None,
+                             nodepool_image_name=None,
+                             networks=None, security_groups=None,
+                             boot_from_volume=False, volume_size=50,
+                             instance_properties=None, userdata=None):
         if not networks:
             networks = []
         if not isinstance(image, dict):
@@ -339,7 +509,9 @@ class OpenStackProvider(Provider):
         if nodepool_node_label:
             meta['nodepool_node_label'] = nodepool_node_label
         create_args['meta'] = meta
+        return create_args
 
+    def _createServer(self, create_args):
         try:
             return self._client.create_server(wait=False, **create_args)
         except openstack.exceptions.BadRequestException:
@@ -348,13 +520,95 @@ class OpenStackProvider(Provider):
             # became functionally and systemically broken, is stale az, image
             # or flavor cache. Log a message, invalidate the caches so that
             # next time we get new caches.
-            self._images = {}
-            self.__azs = None
-            self.__flavors = {}  # TODO(gtema): caching
+            self._images.invalidate()
+            self._azs.invalidate()
+            self.invalidateFlavors()
             self.log.info(
                 "Clearing az, flavor and image caches due to 400 error "
                 "from nova")
             raise
+        finally:
+            # Even a failed request may have created a server
+            self._invalidateServerList()
+
+    def createServer(self, name, image, **kwargs):
+        create_args = self._getServerCreateArgs(name, image, **kwargs)
+        return self._createServer(create_args)
+
+    def createServers(self, name, nodepool_node_ids, image, **kwargs):
+        '''
+        Create several servers of the same kind with a single request.
+
+        Nova is asked for a server per node, but may create fewer if there
+        is not enough quota for all of them. The servers are named after
+        the batch, followed by their index in the request unless nova
+        created a single one, and the metadata of the servers maps each
+        index to its node, see serverNodeId().
+
+        :param str name: The prefix of the names of the servers.
+        :param list nodepool_node_ids: The ids of the nodes to create
+            servers for.
+        :param image: The image of the servers.
+
+        The other arguments are those of createServer().
+
+        :returns: A list of the servers created, in the order of the node
+            ids, with None for the nodes nova did not create a server for.
+        '''
+        batch_id = uuid.uuid4().hex
+        batch_name = '%s-%s' % (name, batch_id)
+        create_args = self._getServerCreateArgs(batch_name, image, **kwargs)
+        meta = create_args['meta']
+        meta['nodepool_batch_id'] = batch_id
+        for index, node_id in enumerate(nodepool_node_ids, 1):
+            meta['nodepool_node_id_%d' % index] = node_id
+        create_args['min_count'] = 1
+        create_args['max_count'] = len(nodepool_node_ids)
+        self._createServer(create_args)
+
+        # Nova does not return the servers of a multiple create. They are
+        # looked up by name from the compute API directly, since a cached
+        # listing may not contain them yet.
+        servers = [None] * len(nodepool_node_ids)
+        for server in self._client.compute.servers(
+                details=True, name='^%s(-[0-9]+)?$' % re.escape(batch_name)):
+            if server.get('metadata', {}).get(
+                    'nodepool_batch_id') != batch_id:
+                continue
+            node_id = self.serverNodeId(server)
+            if node_id in nodepool_node_ids:
+                servers[nodepool_node_ids.index(node_id)] = server
+                continue
+            # Nova is configured to name the servers differently, which
+            # leaves this one without a node.
+            self.log.warning("Deleting server %s of unknown index", server.id)
+            try:
+                self.deleteServer(server.id)
+            except Exception:
+                self.log.exception("Unable to delete server %s:", server.id)
+        return servers
+
+    def serverNodeId(self, server):
+        '''
+        Get the id of the node of a server.
+
+        The servers of a multiple create share their metadata, the node of
+        each of them is found by the index nova appends to its name.
+
+        :param server: The server.
+
+        :returns: The node id, or None if the server has none.
+        '''
+        meta = server.get('metadata', {})
+        batch_id = meta.get('nodepool_batch_id')
+        if batch_id is None:
+            return meta.get('nodepool_node_id')
+        if server.name.endswith(batch_id):
+            # Nova does not number the name of a single server
+            index = '1'
+        else:
+            index = server.name.rsplit('-', 1)[-1]
+        return meta.get('nodepool_node_id_%s' % index)
 
     def getServer(self, server_id):
         return self._client.get_server(server_id)
@@ -366,14 +620,65 @@ class OpenStackProvider(Provider):
             return None
 
     def waitForServer(self, server, timeout=3600, auto_ip=True):
+        if self._status_poller:
+            start = time.monotonic()
+            self._status_poller.waitFor(
+                server.id,
+                lambda s: s is not None and s.status != 'BUILD',
+                timeout, exceptions.TimeoutException,
+                "server %s to come up" % server.id)
+            timeout = max(timeout - (time.monotonic() - start), 1)
+        return self._client.wait_for_server(
+            server=server, auto_ip=auto_ip,
+            reuse=False, timeout=timeout)
+
+    def checkServers(self, server_ids):
+        '''
+        Check which servers finished building, without waiting for them.
+
+        All the servers are checked with a single listing.
+
+        :param list server_ids: The ids of the servers to check.
+
+        :returns: A dict of the servers which are no longer building, as
+            listed, by their id. Servers which are not listed are left out.
+        '''
+        if self._status_poller:
+            servers = self._status_poller.listServers()
+        else:
+            servers = {server.id: server
+                       for server in self._client.list_servers()}
+        return {server_id: servers[server_id] for server_id in server_ids
+                if server_id in servers and
+                servers[server_id].status != 'BUILD'}
+
+    def waitForServerAddresses(self, server, timeout=3600, auto_ip=True):
+        '''
+        Wait for the addresses of a server which finished building.
+
+        A floating IP is assigned to the server if needed.
+
+        :param server: The server, as returned by checkServers().
+        :param int timeout: The time to wait for the addresses.
+        :param bool auto_ip: Whether to assign a floating IP to the server.
+
+        :returns: The server, as returned by waitForServer().
+        '''
         return self._client.wait_for_server(
             server=server, auto_ip=auto_ip,
             reuse=False, timeout=timeout)
 
     def waitForNodeCleanup(self, server_id, timeout=600):
+        if self._status_poller:
+            self._status_poller.waitFor(
+                server_id, lambda s: s is None,
+                timeout, exceptions.ServerDeleteException,
+                "server %s deletion" % server_id)
+            return
         for count in iterate_timeout(
                 timeout, exceptions.ServerDeleteException,
-                "server %s deletion" % server_id):
+                "server %s deletion" % server_id,
+                profile=POLL_MODERATE, name='openstack.server-delete'):
             if not self.getServer(server_id):
                 return
 
@@ -430,6 +735,8 @@ class OpenStackProvider(Provider):
             md5=md5,
             sha256=sha256,
             **meta)
+        # The image may have been looked up while it did not exist yet
+        self._images.invalidate(image_name)
         return image.id
 
     def listPorts(self, status=None):
@@ -460,11 +767,19 @@ class OpenStackProvider(Provider):
         return flavors
 
     def listNodes(self):
-        # list_servers carries the nodepool server list caching logic
+        if self._server_list:
+            return self._server_list.get()
         return self._client.list_servers()
 
+    def _invalidateServerList(self):
+        if self._server_list:
+            self._server_list.invalidate()
+
     def deleteServer(self, server_id):
-        return self._client.delete_server(server_id, delete_ips=True)
+        try:
+            return self._client.delete_server(server_id, delete_ips=True)
+        finally:
+            self._invalidateServerList()
 
     def cleanupNode(self, server_id):
         server = self.getServer(server_id)
@@ -508,12 +823,12 @@ class OpenStackProvider(Provider):
                 # Already deleting this node
                 continue
 
-            if not self._zk.getNode(meta['nodepool_node_id']):
+            node_id = self.serverNodeId(server)
+            if not node_id or not self._zk.getNode(node_id):
                 self.log.warning(
                     "Marking for delete leaked instance %s (%s) in %s "
                     "(unknown node id %s)",
-                    server.name, server.id, self.provider.name,
-                    meta['nodepool_node_id']
+                    server.name, server.id, self.provider.name, node_id
                 )
                 # Create an artifical node to use for deleting the server.
                 node = zk.Node()
@@ -582,13 +897,15 @@ class OpenStackProvider(Provider):
         if self.provider.clean_floating_ips:
             self._client.delete_unattached_floating_ips()
 
+    def _getAZs(self):
+        azs = self._client.list_availability_zone_names()
+        if not azs:
+            # If there are no zones, return a list containing None so that
+            # random.choice can pick None and pass that to Nova. If this
+            # feels dirty, please direct your ire to policy.json and the
+            # ability to turn off random portions of the OpenStack API.
+            azs = [None]
+        return azs
+
     def getAZs(self):
-        if self.__azs is None:
-            self.__azs = self._client.list_availability_zone_names()
-            if not self.__azs:
-                # If there are no zones, return a list containing None so that
-                # random.choice can pick None and pass that to Nova. If this
-                # feels dirty, please direct your ire to policy.json and the
-                # ability to turn off random portions of the OpenStack API.
-                self.__azs = [None]
-        return self.__azs
+        return self._azs.get(None)
@@ -15,6 +15,8 @@
 # limitations under the License.
 
 import abc
+import collections
+import concurrent.futures
 import logging
 import math
 import threading
@@ -34,6 +36,441 @@ class NodeLogAdapter(logging.LoggerAdapter):
         return msg, kwargs
 
 
+class LaunchCounter(object):
+    '''
+    Count the node launches which are in progress for a provider.
+
+    The counter is owned by the provider manager, see
+    :py:attr:`~nodepool.driver.Provider.launch_counter`, and shared by all
+    of its pools. Launches register themselves when they are submitted and
+    deregister when they finish, so reading the count is a constant-time
+    operation.
+    '''
+
+    def __init__(self, provider_name):
+        self.provider_name = provider_name
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def _update(self, delta, statsd):
+        with self._lock:
+            self.count += delta
+            if statsd:
+                # nodepool.provider.PROVIDER.active_launches
+                statsd.gauge('nodepool.provider.%s.active_launches' %
+                             self.provider_name, self.count)
+
+    def increment(self, statsd=None):
+        '''
+        Register a launch.
+
+        :param statsd: An optional statsd client to report the count to.
+        '''
+        self._update(1, statsd)
+
+    def decrement(self, statsd=None):
+        '''
+        Deregister a launch.
+
+        :param statsd: An optional statsd client to report the count to.
+        '''
+        self._update(-1, statsd)
+
+
+class LaunchExecutor(object):
+    '''
+    Run the node launches of a provider.
+
+    If the provider is configured with a number of launch workers, the
+    launches are queued and run by that many threads. Otherwise every
+    launch runs in a thread of its own.
+
+    The executor is owned by the provider manager, see
+    :py:attr:`~nodepool.driver.Provider.launch_executor`, and shut down
+    along with it. Launches submitted once it was shut down run in a thread
+    of their own.
+    '''
+
+    log = logging.getLogger("nodepool.LaunchExecutor")
+
+    def __init__(self, provider_name, workers):
+        self.provider_name = provider_name
+        self.workers = workers
+        self.queued = 0
+        self._lock = threading.Lock()
+        self._shutdown = False
+        if workers:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers,
+                thread_name_prefix='LaunchWorker-%s' % provider_name)
+        else:
+            self._executor = None
+
+    def shutdown(self, wait=False):
+        '''
+        Stop the worker threads once the submitted launches completed.
+
+        :param bool wait: Whether to wait for the submitted launches.
+        '''
+        with self._lock:
+            self._shutdown = True
+        if self._executor:
+            self._executor.shutdown(wait=wait)
+
+    def _run(self, launcher, submitted, statsd):
+        with self._lock:
+            self.queued -= 1
+            queued = self.queued
+        if statsd:
+            key = 'nodepool.provider.%s' % self.provider_name
+            pipeline = statsd.pipeline()
+            pipeline.gauge('%s.launch_queue' % key, queued)
+            pipeline.timing('%s.launch_wait' % key,
+                            int((time.monotonic() - submitted) * 1000))
+            pipeline.send()
+        launcher.run()
+
+    def submit(self, launcher, statsd=None):
+        '''
+        Submit a node launch.
+
+        :param NodeLauncher launcher: The launch to run. Its run() method
+            is called, the thread itself is never started.
+        :param statsd: An optional statsd client to report the queue depth
+            and the time launches waited for a worker to.
+
+        :returns: A Future of the launch.
+        '''
+        submitted = time.monotonic()
+        with self._lock:
+            queue = self._executor and not self._shutdown
+            if queue:
+                self.queued += 1
+                queued = self.queued
+                future = self._executor.submit(self._run, launcher,
+                                               submitted, statsd)
+        if queue:
+            if statsd:
+                statsd.gauge('nodepool.provider.%s.launch_queue' %
+                             self.provider_name, queued)
+            return future
+
+        future = concurrent.futures.Future()
+
+        def run():
+            future.set_running_or_notify_cancel()
+            try:
+                future.set_result(launcher.run())
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, name=launcher.name).start()
+        return future
+
+
+class LaunchBatch(object):
+    '''
+    Create the instances of several node launches with a single request.
+
+    The launchers of a batch claim their instance when they would create
+    it. The first claim creates the instances of the whole batch, the
+    other claims wait for it. A launcher left without an instance, because
+    the request failed or the provider created fewer instances than asked
+    for, creates its own as if there was no batch. So do the retries of
+    the launches.
+    '''
+
+    log = logging.getLogger("nodepool.LaunchBatch")
+
+    def __init__(self, launchers, create):
+        '''
+        :param list launchers: The NodeLaunchers of the batch.
+        :param create: A callable creating the instances of the batch. It
+            is passed the launchers and returns a list of instances in the
+            same order, None or missing for the launchers without one.
+        '''
+        self.launchers = launchers
+        self._create = create
+        self._lock = threading.Lock()
+        # Resolves to the created instances by node id.
+        self._created = None
+
+    @classmethod
+    def assign(cls, launchers, size, create):
+        '''
+        Put the launchers of nodes of the same label into batches.
+
+        :param list launchers: The NodeLaunchers to put into batches. The
+            ``batch`` attribute of those in a batch is set, launchers which
+            would be alone in their batch are left out.
+        :param int size: The maximum number of launchers in a batch.
+        :param create: The callable creating the instances of a batch.
+        '''
+        launchers_by_label = collections.OrderedDict()
+        for launcher in launchers:
+            launchers_by_label.setdefault(
+                launcher.node.type[0], []).append(launcher)
+        for label_launchers in launchers_by_label.values():
+            for i in range(0, len(label_launchers), size):
+                batch_launchers = label_launchers[i:i + size]
+                if len(batch_launchers) > 1:
+                    batch = cls(batch_launchers, create)
+                    for launcher in batch_launchers:
+                        launcher.batch = batch
+
+    def claim(self, launcher):
+        '''
+        Claim the instance created for a launcher.
+
+        :param NodeLauncher launcher: A launcher of the batch.
+
+        :returns: The instance, or None if the launcher has to create its
+            own.
+        '''
+        with self._lock:
+            owner = self._created is None
+            if owner:
+                self._created = concurrent.futures.Future()
+        if owner:
+            # The other launchers of the batch wait for the future rather
+            # than the lock while the instances are created.
+            self._created.set_result(self._createInstances())
+        instances = self._created.result()
+        with self._lock:
+            return instances.pop(launcher.node.id, None)
+
+    def _createInstances(self):
+        node_ids = [x.node.id for x in self.launchers]
+        try:
+            created = self._create(self.launchers)
+        except Exception:
+            self.log.exception(
+                "Unable to create the instances of nodes %s at once:",
+                node_ids)
+            return {}
+        instances = {}
+        for node_id, instance in zip(node_ids, created):
+            if instance is not None:
+                instances[node_id] = instance
+        self.log.debug("Created %d instances for nodes %s at once",
+                       len(instances), node_ids)
+        return instances
+
+
+class InstanceListCache(object):
+    '''
+    Share the listing of the instances of a provider.
+
+    The cleanup of leaked instances and the quota calculations each need
+    the list of all the instances of the provider. Rather than listing
+    them every time, a listing is shared for a number of seconds, and
+    concurrent readers of an expired listing wait for the same new one.
+    While the listing is being read, it is refreshed in the background
+    before it expires. Creating or deleting an instance invalidates it.
+    '''
+
+    log = logging.getLogger("nodepool.InstanceListCache")
+
+    def __init__(self, provider_name, list_instances, ttl):
+        '''
+        :param str provider_name: The name of the provider.
+        :param list_instances: A callable listing the instances of the
+            provider.
+        :param float ttl: How long a listing is shared, in seconds.
+        '''
+        self.provider_name = provider_name
+        self.ttl = ttl
+        self._list_instances = list_instances
+        self._statsd = stats.get_client()
+        self._cond = threading.Condition()
+        self._instances = None
+        # The monotonic time the cached listing was started at.
+        self._listed = 0
+        # Bumped by invalidations, so a listing started before one is not
+        # cached.
+        self._generation = 0
+        self._listing = False
+        # Whether the listing was read since it was last refreshed.
+        self._read = False
+        self._stopped = False
+        # Started along with the first read.
+        self._thread = None
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def join(self):
+        if self._thread:
+            self._thread.join()
+
+    def invalidate(self):
+        '''
+        Discard the listing, the next read lists the instances again.
+        '''
+        with self._cond:
+            self._generation += 1
+            self._instances = None
+
+    def _fresh(self, max_age):
+        return (self._instances is not None and
+                time.monotonic() - self._listed < max_age)
+
+    def _report(self, result):
+        if self._statsd:
+            # nodepool.provider.PROVIDER.instance_list.hits/misses
+            self._statsd.incr('nodepool.provider.%s.instance_list.%s' %
+                              (self.provider_name, result))
+
+    def get(self):
+        '''
+        Get the instances of the provider.
+
+        :returns: A list of the instances as returned by the listing
+            callable.
+        '''
+        with self._cond:
+            if self._thread is None and not self._stopped:
+                self._thread = threading.Thread(
+                    target=self._run,
+                    name='InstanceListCache-%s' % self.provider_name)
+                self._thread.start()
+            self._read = True
+            # Share a listing in progress rather than starting another one
+            while self._listing and not self._fresh(self.ttl):
+                self._cond.wait()
+            if self._fresh(self.ttl):
+                self._report('hits')
+                return list(self._instances)
+            self._listing = True
+        self._report('misses')
+        return self._refresh()
+
+    def _refresh(self):
+        with self._cond:
+            generation = self._generation
+        started = time.monotonic()
+        instances = None
+        try:
+            instances = list(self._list_instances())
+        finally:
+            with self._cond:
+                self._listing = False
+                if instances is not None and generation == self._generation:
+                    self._instances = instances
+                    self._listed = started
+                    self._read = False
+                self._cond.notify_all()
+        return instances
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._stopped:
+                    return
+                # Refresh listings which are read once they are half way
+                # to their expiry.
+                refresh = (self._read and not self._listing and
+                           not self._fresh(self.ttl / 2))
+                if refresh:
+                    self._listing = True
+                else:
+                    self._cond.wait(self.ttl / 4)
+                    continue
+            try:
+                self._refresh()
+            except Exception:
+                self.log.exception("Unable to list the instances of %s:",
+                                   self.provider_name)
+                # Readers list the instances themselves until they are
+                # listed again.
+                with self._cond:
+                    self._read = False
+
+
+class LookupCache(object):
+    '''
+    Cache the results of lookups of cloud resources by key.
+
+    A result is kept for a TTL. Lookups which found nothing are kept for
+    the negative TTL, so a missing resource is not looked up for every
+    use, but shows up soon once it exists. Concurrent lookups of the same
+    key wait for a single lookup. Failed lookups are not cached.
+    '''
+
+    def __init__(self, lookup, ttl, negative_ttl=None):
+        '''
+        :param lookup: A callable looking up a key. It returns None if
+            there is nothing for the key.
+        :param float ttl: How long a result is kept, in seconds.
+        :param float negative_ttl: How long a result of None is kept, in
+            seconds. The TTL by default.
+        '''
+        self._lookup = lookup
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self._lock = threading.Lock()
+        # The results and their monotonic expiry time by key.
+        self._results = {}
+        # The Futures of the lookups in progress by key.
+        self._lookups = {}
+        # Bumped by invalidations, so a lookup started before one is not
+        # cached.
+        self._generation = 0
+
+    def get(self, key):
+        '''
+        Get the result of the lookup of a key.
+
+        :param key: The key to look up.
+
+        :returns: The result of the lookup callable.
+        '''
+        with self._lock:
+            result, expiry = self._results.get(key, (None, 0))
+            if time.monotonic() < expiry:
+                return result
+            future = self._lookups.get(key)
+            # The first reader of an expired key owns its lookup, the
+            # others wait for it.
+            owner = future is None
+            if owner:
+                future = concurrent.futures.Future()
+                self._lookups[key] = future
+                generation = self._generation
+        if not owner:
+            return future.result()
+
+        try:
+            result = self._lookup(key)
+        except Exception as e:
+            with self._lock:
+                del self._lookups[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._lookups[key]
+            if generation == self._generation:
+                ttl = self.ttl if result is not None else self.negative_ttl
+                self._results[key] = (result, time.monotonic() + ttl)
+        future.set_result(result)
+        return result
+
+    def invalidate(self, key=None):
+        '''
+        Discard the result of a key, so it is looked up again.
+
+        :param key: The key to discard. All of them by default.
+        '''
+        with self._lock:
+            self._generation += 1
+            if key is None:
+                self._results.clear()
+            else:
+                self._results.pop(key, None)
+
+
 class NodeLauncher(threading.Thread,
                    stats.StatsReporter,
                    metaclass=abc.ABCMeta):
@@ -57,18 +494,67 @@ class NodeLauncher(threading.Thread,
         self.zk = zk_conn
         self.node = node
         self.provider_config = provider_config
+        # The LaunchCounter the launch is registered in once submitted.
+        self._counter = None
 
     @abc.abstractmethod
     def launch(self):
         pass
 
+    def submit(self, provider, executor=None):
+        '''
+        Run the launch on an executor instead of starting this thread.
+
+        The launch is counted against the provider until it finishes, so
+        the concurrency limit of the provider holds.
+
+        :param Provider provider: The provider manager of the launch.
+        :param executor: The executor to submit the launch to, the launch
+            executor of the provider by default.
+
+        :returns: A Future of the launch.
+        '''
+        if executor is None:
+            executor = provider.launch_executor
+        self._counter = provider.launch_counter
+        self._counter.increment(self._statsd)
+        try:
+            return executor.submit(self, self._statsd)
+        except Exception:
+            self._counter.decrement(self._statsd)
+            raise
+
     def run(self):
         start_time = time.monotonic()
-        statsd_key = 'ready'
-
         try:
             self.launch()
-        except kze.SessionExpiredError:
+        except Exception as e:
+            self.finishLaunch(start_time, e)
+        else:
+            self.finishLaunch(start_time)
+
+    def finishLaunch(self, start_time, exc=None):
+        '''
+        Record the outcome of the launch.
+
+        If the launch failed, the node is set to its final state. The launch
+        stats are reported and the launch is deregistered from the counter
+        of the provider. This must be called while handling the exception
+        of a failed launch.
+
+        :param float start_time: The monotonic time the launch started at.
+        :param Exception exc: The exception the launch failed with, if any.
+        '''
+        try:
+            self._finishLaunch(start_time, exc)
+        finally:
+            if self._counter:
+                self._counter.decrement(self._statsd)
+
+    def _finishLaunch(self, start_time, exc):
+        statsd_key = 'ready'
+
+        if isinstance(exc, kze.SessionExpiredError):
             # Our node lock is gone, leaving the node state as BUILDING.
             # This will get cleaned up in ZooKeeper automatically, but we
             # must still set our cached node state to FAILED for the
@@ -78,7 +564,7 @@ class NodeLauncher(threading.Thread,
                 self.node.id)
             self.node.state = zk.FAILED
             statsd_key = 'error.zksession'
-        except exceptions.QuotaException:
+        elif isinstance(exc, exceptions.QuotaException):
             # We encountered a quota error when trying to launch a
             # node. In this case we need to abort the launch. The upper
             # layers will take care of this and reschedule a new node once
@@ -88,14 +574,14 @@ class NodeLauncher(threading.Thread,
             self.node.state = zk.ABORTED
             self.zk.storeNode(self.node)
             statsd_key = 'error.quota'
-        except Exception as e:
+        elif exc is not None:
             self.log.exception(
                 "Launch failed for node %s:", self.node.hostname)
             self.node.state = zk.FAILED
             self.zk.storeNode(self.node)
 
-            if hasattr(e, 'statsd_key'):
-                statsd_key = e.statsd_key
+            if hasattr(exc, 'statsd_key'):
+                statsd_key = exc.statsd_key
             else:
                 statsd_key = 'error.unknown'
 
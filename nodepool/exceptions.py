@@ -75,3 +75,11 @@ class ZKException(Exception):
 
 class ZKLockException(ZKException):
     pass
+
+
+class ZKTransactionException(ZKException):
+    pass
+
+
+class ZKVersionException(ZKException):
+    pass
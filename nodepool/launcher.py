@@ -134,7 +134,8 @@ class PoolWorker(threading.Thread, stats.StatsReporter):
         self.provider_name = provider_name
         self.pool_name = pool_name
         self.running = False
-        self.stop_event = threading.Event()
+        # Set whenever something happened which may let us make progress
+        self.wake_event = threading.Event()
         self.paused_handler = None
         self.request_handlers = []
         self.watermark_sleep = nodepool.watermark_sleep
@@ -175,15 +176,10 @@ class PoolWorker(threading.Thread, stats.StatsReporter):
         # which express a preference for a specific provider.
         launchers = self.zk.getRegisteredLaunchers()
 
-        # Sort requests by queue priority, then, for all requests at
-        # the same priority, use the relative_priority field to
-        # further sort, then finally, the submission order.
-        requests = list(self.zk.nodeRequestIterator())
-        requests.sort(key=lambda r: (r.id.split('-')[0],
-                                     r.relative_priority,
-                                     r.id.split('-')[1]))
-
-        for req in requests:
+        # Requests are yielded by queue priority, then, for all requests
+        # at the same priority, by the relative_priority field, then
+        # finally, by the submission order.
+        for req in self.zk.nodeRequestQueueIterator():
             if not self.running:
                 return True
 
@@ -192,22 +188,19 @@ class PoolWorker(threading.Thread, stats.StatsReporter):
                 return True
 
             # Get active threads for all pools for this provider
-            active_threads = sum([
-                w.activeThreads() for
-                w in self.nodepool.getPoolWorkers(self.provider_name)
-            ])
+            active_threads = self.getProviderManager().launch_counter.count
 
             # Short-circuit for limited request handling
             if (provider.max_concurrency > 0 and
                     active_threads >= provider.max_concurrency):
-                self.log.debug("Request handling limited: %s active threads ",
+                self.log.debug("Request handling limited: %s active threads "
                                "with max concurrency of %s",
                                active_threads, provider.max_concurrency)
                 return True
 
-            req = self.zk.getNodeRequest(req.id)
-            if not req:
-                continue
+            # Work on a copy of the cached request since it gets locked and
+            # modified by the request handler.
+            req = zk.NodeRequest.fromDict(req.toDict(), req.id)
 
             # Only interested in unhandled requests
             if req.state != zk.REQUESTED:
@@ -246,6 +239,11 @@ class PoolWorker(threading.Thread, stats.StatsReporter):
                 self.log.debug("Request %s is in state %s", req.id, req.state)
                 continue
 
+            # The cached data might not have caught up with our own decline
+            if self.launcher_id in req.declined_by:
+                self.zk.unlockNodeRequest(req)
+                continue
+
             # Got a lock, so assign it
             self.log.info("Assigning node request %s" % req)
 
@@ -261,6 +259,19 @@ class PoolWorker(threading.Thread, stats.StatsReporter):
                 return False
         return True
 
+    def _wakeListener(self, obj):
+        '''
+        Wake up the worker for cache changes which may be of interest.
+
+        This is called from the ZooKeeper cache threads.
+        '''
+        if isinstance(obj, zk.NodeRequest):
+            if self.launcher_id not in obj.declined_by:
+                self.wake_event.set()
+        elif (obj.provider == self.provider_name and
+              obj.pool == self.pool_name):
+            self.wake_event.set()
+
     def _removeCompletedHandlers(self):
         '''
         Poll handlers to see which have completed.
@@ -325,8 +336,13 @@ class PoolWorker(threading.Thread, stats.StatsReporter):
 
     def run(self):
         self.running = True
+        self.zk.addWakeListener(self._wakeListener)
 
         while self.running:
+            # Anything happening from now on is either seen by this pass
+            # or wakes us up for the next one.
+            self.wake_event.clear()
+
             # Don't do work if we've lost communication with the ZK cluster
             did_suspend = False
             while self.zk and (self.zk.suspended or self.zk.lost):
@@ -366,9 +382,13 @@ class PoolWorker(threading.Thread, stats.StatsReporter):
                 self._removeCompletedHandlers()
             except Exception:
                 self.log.exception("Error in PoolWorker:")
-            self.stop_event.wait(self.watermark_sleep)
+
+            # New requests and node changes wake us up right away, but
+            # still poll in case we missed anything.
+            self.wake_event.wait(self.watermark_sleep)
 
         # Cleanup on exit
+        self.zk.removeWakeListener(self._wakeListener)
         if self.paused_handler:
             self.paused_handler.unlockNodeSet(clear_allocation=True)
 
@@ -382,7 +402,7 @@ class PoolWorker(threading.Thread, stats.StatsReporter):
         '''
         self.log.info("%s received stop" % self.name)
         self.running = False
-        self.stop_event.set()
+        self.wake_event.set()
 
 
 class BaseCleanupWorker(threading.Thread):
@@ -448,7 +468,7 @@ class CleanupWorker(BaseCleanupWorker):
         if req.state != zk.PENDING:
             return
 
-        for node in zk_conn.nodeIterator():
+        for node in zk_conn.nodeIterator(cached_ids=True):
             if node.allocated_to == req.id:
                 try:
                     zk_conn.lockNode(node)
@@ -485,7 +505,7 @@ class CleanupWorker(BaseCleanupWorker):
         the request state to REQUESTED so it will be processed again.
         '''
         zk_conn = self._nodepool.getZK()
-        for req in zk_conn.nodeRequestIterator():
+        for req in zk_conn.nodeRequestIterator(cached_ids=True):
             if req.state == zk.PENDING:
                 try:
                     zk_conn.lockNodeRequest(req, blocking=False)
@@ -594,7 +614,8 @@ class CleanupWorker(BaseCleanupWorker):
         self.log.debug('Cleaning up held nodes...')
 
         zk_conn = self._nodepool.getZK()
-        held_nodes = [n for n in zk_conn.nodeIterator() if n.state == zk.HOLD]
+        held_nodes = [n for n in zk_conn.nodeIterator(cached_ids=True)
+                      if n.state == zk.HOLD]
         for node in held_nodes:
             # Can't do anything if we aren't configured for this provider.
             if node.provider not in self._nodepool.config.providers:
@@ -708,7 +729,7 @@ class DeletedNodeWorker(BaseCleanupWorker):
                           zk.DELETING, zk.DELETED, zk.ABORTED)
 
         zk_conn = self._nodepool.getZK()
-        for node in zk_conn.nodeIterator():
+        for node in zk_conn.nodeIterator(cached_ids=True):
             # If a ready node has been allocated to a request, but that
             # request is now missing, deallocate it.
             if (node.state == zk.READY and node.allocated_to
@@ -720,16 +741,17 @@ class DeletedNodeWorker(BaseCleanupWorker):
                 else:
                     # Double check node conditions after lock
                     if node.state == zk.READY and node.allocated_to:
+                        request_id = node.allocated_to
                         node.allocated_to = None
                         try:
                             zk_conn.storeNode(node)
                             self.log.debug(
                                 "Deallocated node %s with missing request %s",
-                                node.id, node.allocated_to)
+                                node.id, request_id)
                         except Exception:
                             self.log.exception(
                                 "Failed to deallocate node %s for missing "
-                                "request %s:", node.id, node.allocated_to)
+                                "request %s:", node.id, request_id)
 
                     zk_conn.unlockNode(node)
 
@@ -911,6 +933,12 @@ class NodePool(threading.Thread):
             thd.join()
 
         if self.zk:
+            if self.config and self.config.zookeeper_cache_snapshot:
+                try:
+                    self.zk.saveCacheSnapshot(
+                        self.config.zookeeper_cache_snapshot)
+                except Exception:
+                    self.log.exception("Unable to save cache snapshot:")
             self.zk.disconnect()
         self.log.debug("Finished stopping")
 
@@ -927,16 +955,20 @@ class NodePool(threading.Thread):
             running = None
 
         configured = list(config.zookeeper_servers.values())
-        if running == configured:
-            return
+        if running != configured:
+            if not self.zk and configured:
+                self.log.debug("Connecting to ZooKeeper servers")
+                self.zk = zk.ZooKeeper(enable_image_cache=True)
+                if config.zookeeper_cache_snapshot:
+                    self.zk.loadCacheSnapshot(config.zookeeper_cache_snapshot)
+                self.zk.connect(configured)
+            else:
+                self.log.debug("Detected ZooKeeper server changes")
+                self.zk.resetHosts(configured)
 
-        if not self.zk and configured:
-            self.log.debug("Connecting to ZooKeeper servers")
-            self.zk = zk.ZooKeeper()
-            self.zk.connect(configured)
-        else:
-            self.log.debug("Detected ZooKeeper server changes")
-            self.zk.resetHosts(configured)
+        if self.zk:
+            self.zk.setEncoding(config.zookeeper_encoding)
+            self.zk.setNodeBuckets(config.zookeeper_node_buckets)
 
     def setConfig(self, config):
         self.config = config
@@ -1101,6 +1133,9 @@ class NodePool(threading.Thread):
                 if did_suspend:
                     self.log.info("ZooKeeper available. Resuming")
 
+                if self.statsd:
+                    self.zk.stats.reportStats(self.statsd)
+
                 self.createMinReady()
 
                 if not self._cleanup_thread:
@@ -1117,6 +1152,14 @@ class NodePool(threading.Thread):
                     self._stats_thread = StatsWorker(self, self.stats_interval)
                     self._stats_thread.start()
 
+                # Don't start handling requests before the caches are in
+                # sync, otherwise every cached read becomes a live one.
+                if not self.zk.waitForCacheInitialization(
+                        self.watermark_sleep):
+                    self.log.info("Waiting for the ZooKeeper caches to "
+                                  "initialize")
+                    continue
+
                 # Stop any PoolWorker threads if the pool was removed
                 # from the config.
                 pool_keys = set()
@@ -1167,6 +1210,29 @@ class StandaloneLauncher:
         reuse = True
         id = "standalone"
 
+    class Transaction:
+        def __init__(self, launcher):
+            self.launcher = launcher
+
+        def storeNode(self, node, check_version=False):
+            self.launcher.storeNode(node)
+
+        def lockNewNode(self, node):
+            # No need to lock standalone node
+            pass
+
+        def unlockNode(self, node):
+            pass
+
+        def storeNodeRequest(self, request, check_version=False):
+            self.launcher.storeNodeRequest(request)
+
+        def unlockNodeRequest(self, request):
+            pass
+
+        def commit(self):
+            pass
+
     def __init__(self, config):
         Drivers.load()
         self.config = config
@@ -1196,7 +1262,7 @@ class StandaloneLauncher:
     def getZK(self):
         return self
 
-    def getRegisteredLaunchers(self):
+    def getRegisteredLaunchers(self, cached=True):
         return [self]
 
     def getProviderManager(self):
@@ -1236,10 +1302,13 @@ class StandaloneLauncher:
                 if node.provider == name:
                     provider.waitForNodeCleanup(node.external_id)
 
-    def storeNodeRequest(self, request):
+    def transaction(self):
+        return StandaloneLauncher.Transaction(self)
+
+    def storeNodeRequest(self, request, priority="100", check_version=False):
         self.req = request
 
-    def storeNode(self, node):
+    def storeNode(self, node, check_version=False):
         self.nodes[node.id] = node
 
     def getReadyNodesOfTypes(self, types):
@@ -16,14 +16,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import concurrent.futures
 import errno
+import random
 import time
 import socket
 import logging
+import threading
 
 import paramiko
 
 from nodepool import exceptions
+from nodepool import stats
 
 log = logging.getLogger("nodepool.utils")
 
@@ -31,14 +36,103 @@ log = logging.getLogger("nodepool.utils")
 ITERATE_INTERVAL = 2
 
 
-def iterate_timeout(max_seconds, exc, purpose):
+class PollProfile(object):
+    '''
+    How long to sleep between the iterations of a polling loop.
+
+    The interval starts at the floor and is multiplied by the factor after
+    every iteration, up to the ceiling. A random jitter of up to the given
+    fraction of the interval is applied, so that loops which started
+    together spread out, but the interval always stays between the floor
+    and the ceiling.
+    '''
+
+    def __init__(self, floor, ceiling=None, factor=1, jitter=0):
+        '''
+        :param float floor: The first and shortest interval, in seconds.
+        :param float ceiling: The longest interval, in seconds. Defaults to
+            the floor.
+        :param float factor: The factor the interval grows by.
+        :param float jitter: The fraction of the interval to randomize.
+        '''
+        self.floor = floor
+        self.ceiling = floor if ceiling is None else ceiling
+        self.factor = factor
+        self.jitter = jitter
+
+    def __repr__(self):
+        return ('<PollProfile floor=%s ceiling=%s factor=%s jitter=%s>' %
+                (self.floor, self.ceiling, self.factor, self.jitter))
+
+    def intervals(self):
+        '''
+        Generate the intervals to sleep for between the iterations.
+        '''
+        interval = self.floor
+        while True:
+            jittered = interval * (
+                1 + random.uniform(-self.jitter, self.jitter))
+            yield max(self.floor, min(self.ceiling, jittered))
+            interval = min(interval * self.factor, self.ceiling)
+
+
+# For things expected to be done within seconds, like a node accepting SSH
+# connections once its server is active.
+POLL_QUICK = PollProfile(0.1, ceiling=ITERATE_INTERVAL, factor=2, jitter=0.1)
+# For things taking from seconds to minutes, like instances booting or
+# servers being deleted.
+POLL_MODERATE = PollProfile(0.5, ceiling=10, factor=1.5, jitter=0.1)
+
+
+def report_polls(name, polls, timed_out=False):
+    '''
+    Report the iterations of a polling loop to statsd.
+
+    :param str name: The name of the polling loop.
+    :param int polls: The number of iterations.
+    :param bool timed_out: Whether the loop timed out.
+    '''
+    statsd = stats.get_client()
+    if not statsd:
+        return
+    key = 'nodepool.poll.%s' % name
+    pipeline = statsd.pipeline()
+    pipeline.incr('%s.waits' % key)
+    pipeline.incr('%s.polls' % key, polls)
+    if timed_out:
+        pipeline.incr('%s.timeouts' % key)
+    pipeline.send()
+
+
+def iterate_timeout(max_seconds, exc, purpose, profile=None, name=None):
+    '''
+    Iterate until the timeout expires, sleeping between the iterations.
+
+    :param float max_seconds: The timeout, in seconds.
+    :param exc: The exception class to raise on timeout.
+    :param str purpose: What is waited for, for the timeout message.
+    :param PollProfile profile: How long to sleep between the iterations.
+        Defaults to ITERATE_INTERVAL.
+    :param str name: If given, the number of iterations is reported to
+        statsd under this name once the loop ends.
+    '''
+    if profile is None:
+        profile = PollProfile(ITERATE_INTERVAL)
+    intervals = profile.intervals()
     start = time.time()
     count = 0
-    while (time.time() < start + max_seconds):
-        count += 1
-        yield count
-        time.sleep(ITERATE_INTERVAL)
-    raise exc("Timeout waiting for %s" % purpose)
+    timed_out = False
+    try:
+        while (time.time() < start + max_seconds):
+            count += 1
+            yield count
+            remaining = start + max_seconds - time.time()
+            time.sleep(max(min(next(intervals), remaining), 0))
+        timed_out = True
+        raise exc("Timeout waiting for %s" % purpose)
+    finally:
+        if name:
+            report_polls(name, count, timed_out)
 
 
 def set_node_ip(node):
@@ -57,59 +151,226 @@ def set_node_ip(node):
             "Unable to find public IP of server")
 
 
-def nodescan(ip, port=22, timeout=60, gather_hostkeys=True):
+def _gather_host_keys(sock, timeout):
     '''
-    Scan the IP address for public SSH keys.
+    Gather the public SSH keys of a host over a connected socket.
 
-    Keys are returned formatted as: "<type> <base64_string>"
+    The socket is closed afterwards.
+
+    :returns: The list of keys, or None if the SSH handshake failed.
     '''
-    if 'fake' in ip:
-        if gather_hostkeys:
-            return ['ssh-rsa FAKEKEY']
-        else:
-            return []
-
-    addrinfo = socket.getaddrinfo(ip, port)[0]
-    family = addrinfo[0]
-    sockaddr = addrinfo[4]
-
-    keys = []
-    key = None
-    for count in iterate_timeout(
-            timeout, exceptions.ConnectionTimeoutException,
-            "connection to %s on port %s" % (ip, port)):
-        sock = None
-        t = None
+    t = None
+    try:
+        t = paramiko.transport.Transport(sock)
+        t.start_client(timeout=timeout)
+        key = t.get_remote_server_key()
+        # Paramiko, at this time, seems to return only the ssh-rsa key, so
+        # only the single key is placed into the list.
+        if key:
+            return ["%s %s" % (key.get_name(), key.get_base64())]
+        return []
+    except Exception as e:
+        log.exception("ssh-keyscan failure: %s", e)
+    finally:
+        try:
+            if t:
+                t.close()
+        except Exception as e:
+            log.exception('Exception closing paramiko: %s', e)
         try:
-            sock = socket.socket(family, socket.SOCK_STREAM)
-            sock.settimeout(10)
-            sock.connect(sockaddr)
+            sock.close()
+        except Exception as e:
+            log.exception('Exception closing socket: %s', e)
+    return None
+
+
+class KeyscanService(object):
+    '''
+    Scan hosts for their public SSH keys concurrently.
+
+    The connection attempts of all the scans are made by a single asyncio
+    event loop. Attempts are retried following POLL_QUICK, a short backoff
+    which grows while the host is unreachable. Only the SSH handshake with
+    a host which accepted the connection is run by a thread of its own,
+    since paramiko is blocking. A host stalling the handshake thereby holds
+    up no other scan, and there are never more of these threads than scans
+    in progress, which the launch concurrency bounds.
+
+    There is a single service per process, shared by all the scans.
+    '''
+
+    log = logging.getLogger("nodepool.utils.KeyscanService")
+
+    poll_profile = POLL_QUICK
+    # How long a single connection attempt may take
+    connect_timeout = 10
+
+    _service = None
+    _service_lock = threading.Lock()
+
+    def __init__(self):
+        self._loop = asyncio.new_event_loop()
+        # The threads of the handshakes in progress
+        self._handshakes = set()
+        self._handshakes_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._loop.run_forever,
+                                        name='KeyscanService', daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def get(cls):
+        '''
+        Get the keyscan service, starting it if needed.
+        '''
+        with cls._service_lock:
+            if cls._service is None:
+                cls._service = cls()
+            return cls._service
+
+    @classmethod
+    def shutdown(cls):
+        '''
+        Stop the keyscan service, if it was started.
+
+        Scans still in progress are cancelled. The next scan starts a new
+        service.
+        '''
+        with cls._service_lock:
+            service, cls._service = cls._service, None
+        if service:
+            service._stop()
+
+    async def _cancelScans(self):
+        scans = [task for task in asyncio.all_tasks(self._loop)
+                 if task is not asyncio.current_task()]
+        for scan in scans:
+            scan.cancel()
+        await asyncio.gather(*scans, return_exceptions=True)
+
+    def _stop(self):
+        asyncio.run_coroutine_threadsafe(
+            self._cancelScans(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        # The handshakes end by their deadline at the latest, and must not
+        # outlive the loop they report to.
+        with self._handshakes_lock:
+            handshakes = list(self._handshakes)
+        for thread in handshakes:
+            thread.join()
+        self._loop.close()
+
+    def scan(self, ip, port=22, timeout=60, gather_hostkeys=True):
+        '''
+        Scan the IP address for public SSH keys.
+
+        Keys are returned formatted as: "<type> <base64_string>"
+
+        :returns: A Future of the list of keys, which is empty if host keys
+            are not to be gathered. It fails with ConnectionTimeoutException
+            if no connection could be made before the timeout.
+        '''
+        if 'fake' in ip:
+            future = concurrent.futures.Future()
             if gather_hostkeys:
-                t = paramiko.transport.Transport(sock)
-                t.start_client(timeout=timeout)
-                key = t.get_remote_server_key()
-            break
-        except socket.error as e:
-            if e.errno not in [errno.ECONNREFUSED, errno.EHOSTUNREACH, None]:
-                log.exception(
+                future.set_result(['ssh-rsa FAKEKEY'])
+            else:
+                future.set_result([])
+            return future
+
+        addrinfo = socket.getaddrinfo(ip, port)[0]
+        return asyncio.run_coroutine_threadsafe(
+            self._scan(ip, port, addrinfo[0], addrinfo[4], timeout,
+                       gather_hostkeys),
+            self._loop)
+
+    async def _connect(self, ip, port, family, sockaddr, timeout):
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            await asyncio.wait_for(
+                self._loop.sock_connect(sock, sockaddr), timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            sock.close()
+            if (not isinstance(e, asyncio.TimeoutError) and
+                    e.errno not in [errno.ECONNREFUSED, errno.EHOSTUNREACH,
+                                    None]):
+                self.log.exception(
                     'Exception connecting to %s on port %s:' % (ip, port))
-        except Exception as e:
-            log.exception("ssh-keyscan failure: %s", e)
-        finally:
-            try:
-                if t:
-                    t.close()
-            except Exception as e:
-                log.exception('Exception closing paramiko: %s', e)
-            try:
+            return None
+        return sock
+
+    def _handshake(self, sock, timeout):
+        '''
+        Gather the host keys over a connected socket in a new thread.
+
+        :param float timeout: How long the handshake may take, in seconds.
+
+        :returns: An asyncio Future of the keys, or of None if the
+            handshake failed.
+        '''
+        future = self._loop.create_future()
+        timeout = max(timeout, 0.1)
+        sock.setblocking(True)
+        sock.settimeout(min(10, timeout))
+
+        def resolve(keys):
+            # The scan may have been cancelled meanwhile
+            if not future.done():
+                future.set_result(keys)
+
+        def run():
+            keys = _gather_host_keys(sock, timeout)
+            self._loop.call_soon_threadsafe(resolve, keys)
+            with self._handshakes_lock:
+                self._handshakes.discard(thread)
+
+        thread = threading.Thread(target=run, name='KeyscanHandshake',
+                                  daemon=True)
+        with self._handshakes_lock:
+            self._handshakes.add(thread)
+        thread.start()
+        return future
+
+    async def _scan(self, ip, port, family, sockaddr, timeout,
+                    gather_hostkeys):
+        deadline = self._loop.time() + timeout
+        intervals = self.poll_profile.intervals()
+        attempts = 0
+        timed_out = False
+        try:
+            while True:
+                attempts += 1
+                remaining = deadline - self._loop.time()
+                sock = await self._connect(
+                    ip, port, family, sockaddr,
+                    max(min(self.connect_timeout, remaining), 0.1))
                 if sock:
-                    sock.close()
-            except Exception as e:
-                log.exception('Exception closing socket: %s', e)
+                    if not gather_hostkeys:
+                        sock.close()
+                        return []
+                    keys = await self._handshake(
+                        sock, deadline - self._loop.time())
+                    if keys is not None:
+                        return keys
 
-    # Paramiko, at this time, seems to return only the ssh-rsa key, so
-    # only the single key is placed into the list.
-    if key:
-        keys.append("%s %s" % (key.get_name(), key.get_base64()))
+                remaining = deadline - self._loop.time()
+                if remaining <= 0:
+                    timed_out = True
+                    raise exceptions.ConnectionTimeoutException(
+                        "Timeout waiting for connection to %s on port %s" %
+                        (ip, port))
+                await asyncio.sleep(min(next(intervals), remaining))
+        finally:
+            report_polls('keyscan', attempts, timed_out)
+
+
+def nodescan(ip, port=22, timeout=60, gather_hostkeys=True):
+    '''
+    Scan the IP address for public SSH keys.
 
-    return keys
+    Keys are returned formatted as: "<type> <base64_string>"
+    '''
+    return KeyscanService.get().scan(
+        ip, port=port, timeout=timeout,
+        gather_hostkeys=gather_hostkeys).result()
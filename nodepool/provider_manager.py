@@ -51,8 +51,10 @@ class ProviderManager(object):
             oldmanager = None
             if old_config:
                 oldmanager = old_config.provider_managers.get(p.name)
+            replaced = None
             if oldmanager and p != oldmanager.provider:
                 stop_managers.append(oldmanager)
+                replaced = oldmanager
                 oldmanager = None
             if oldmanager:
                 new_config.provider_managers[p.name] = oldmanager
@@ -60,13 +62,26 @@ class ProviderManager(object):
                 ProviderManager.log.debug("Creating new ProviderManager object"
                                           " for %s" % p.name)
                 new_config.provider_managers[p.name] = get_provider(p)
+                if replaced:
+                    new_config.provider_managers[p.name].takeOverLaunches(
+                        replaced)
                 new_config.provider_managers[p.name].start()
 
+        # Also stop the managers of the providers which were removed
+        if old_config:
+            for name, oldmanager in old_config.provider_managers.items():
+                if name not in new_config.provider_managers:
+                    stop_managers.append(oldmanager)
+
         for stop_manager in stop_managers:
             stop_manager.stop()
+            stop_manager.stopLaunches()
 
     @staticmethod
     def stopProviders(config):
         for m in config.provider_managers.values():
             m.stop()
+            m.stopLaunches()
+        for m in config.provider_managers.values():
             m.join()
+            m.stopLaunches(wait=True)
@@ -131,15 +131,7 @@ def node_list(zk, node_id=None):
     ]
     headers_table = OrderedDict(headers_table)
 
-    def _get_node_values(node):
-        locked = "unlocked"
-        try:
-            zk.lockNode(node, blocking=False)
-        except Exception:
-            locked = "locked"
-        else:
-            zk.unlockNode(node)
-
+    def _get_node_values(node, locked):
         values = [
             node.id,
             node.provider,
@@ -149,7 +141,7 @@ def node_list(zk, node_id=None):
             node.public_ipv6,
             node.state,
             age(node.state_time),
-            locked,
+            "locked" if locked else "unlocked",
             node.pool,
             node.hostname,
             node.private_ipv4,
@@ -162,19 +154,18 @@ def node_list(zk, node_id=None):
         ]
         return values
 
-    objs = []
     if node_id:
         node = zk.getNode(node_id)
-        if node:
-            values = _get_node_values(node)
-            objs.append(dict(zip(headers_table.keys(),
-                                 values)))
+        nodes = [node] if node else []
     else:
-        for node in zk.nodeIterator():
-            values = _get_node_values(node)
+        nodes = list(zk.nodeIterator())
+    locks = zk.getNodeLockStates([node.id for node in nodes])
 
-            objs.append(dict(zip(headers_table.keys(),
-                                 values)))
+    objs = []
+    for node in nodes:
+        values = _get_node_values(node, locks[node.id])
+        objs.append(dict(zip(headers_table.keys(),
+                             values)))
 
     return (objs, headers_table)
 
@@ -189,9 +180,10 @@ def dib_image_list(zk):
         ("age", "Age")])
     objs = []
     for image_name in zk.getImageNames():
-        for build_no in zk.getBuildNumbers(image_name):
-            build = zk.getBuild(image_name, build_no)
-            objs.append({'id': '-'.join([image_name, build_no]),
+        for build in zk.getBuilds(image_name):
+            if build is None:
+                continue
+            objs.append({'id': '-'.join([image_name, build.id]),
                          'image': image_name,
                          'builder': build.builder,
                          'formats': build.formats,
@@ -212,20 +204,15 @@ def image_list(zk):
         ("state", "State"),
         ("age", "Age")])
     objs = []
-    for image_name in zk.getImageNames():
-        for build_no in zk.getBuildNumbers(image_name):
-            for provider in zk.getBuildProviders(image_name, build_no):
-                for upload_no in zk.getImageUploadNumbers(
-                        image_name, build_no, provider):
-                    upload = zk.getImageUpload(image_name, build_no,
-                                               provider, upload_no)
-                    values = [build_no, upload_no, provider, image_name,
-                              upload.external_name,
-                              upload.external_id,
-                              upload.state,
-                              int(upload.state_time)]
-                    objs.append(dict(zip(headers_table.keys(),
-                                         values)))
+    for upload in zk.getAllImageUploads():
+        values = [upload.build_id, upload.id, upload.provider_name,
+                  upload.image_name,
+                  upload.external_name,
+                  upload.external_id,
+                  upload.state,
+                  int(upload.state_time)]
+        objs.append(dict(zip(headers_table.keys(),
+                             values)))
     return (objs, headers_table)
 
 
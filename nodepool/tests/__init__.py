@@ -34,6 +34,7 @@ import testtools
 
 from nodepool import builder
 from nodepool import launcher
+from nodepool import nodeutils
 from nodepool import webapp
 from nodepool import zk
 from nodepool.cmd.config_validator import ConfigValidator
@@ -137,8 +138,16 @@ class StatsdFixture(fixtures.Fixture):
 
 
 class BaseTestCase(testtools.TestCase):
+    # The threads of the provider managers and of the keyscan service.
+    # They run as long as their owner, so they must be gone once the test
+    # stopped it.
+    service_threads = ('LaunchWorker', 'LaunchPipeline', 'ServerStatusPoller',
+                       'InstanceListCache', 'Keyscan')
+
     def setUp(self):
         super(BaseTestCase, self).setUp()
+        # Registered first, so it runs once everything else is cleaned up
+        self.addCleanup(self.assertNoLeakedThreads)
         test_timeout = os.environ.get('OS_TEST_TIMEOUT', 60)
         try:
             test_timeout = int(test_timeout)
@@ -230,12 +239,27 @@ class BaseTestCase(testtools.TestCase):
                     continue
                 if t.name.startswith("PoolWorker"):
                     continue
+                if t.name.startswith(self.service_threads):
+                    # Checked by assertNoLeakedThreads()
+                    continue
                 if t.name not in whitelist:
                     done = False
             if done:
                 return
             time.sleep(0.1)
 
+    def assertNoLeakedThreads(self):
+        nodeutils.KeyscanService.shutdown()
+        # Threads of providers which were stopped without being joined
+        # finish on their own.
+        for x in range(100):
+            leaked = [t.name for t in threading.enumerate()
+                      if t.name.startswith(self.service_threads)]
+            if not leaked:
+                return
+            time.sleep(0.1)
+        self.fail("Leaked threads: %s" % leaked)
+
     def assertReportedStat(self, key, value=None, kind=None):
         """Check statsd output
 
@@ -326,6 +350,9 @@ class DBTestCase(BaseTestCase):
     def setUp(self):
         super(DBTestCase, self).setUp()
         self.log = logging.getLogger("tests")
+        # Cross-check all node index lookups of the launchers under test
+        self.useFixture(fixtures.MonkeyPatch(
+            'nodepool.zk.ZooKeeper.verify_node_index', True))
         self.setupZK()
 
     def setup_config(self, filename, images_dir=None, context_name=None):
@@ -526,9 +553,15 @@ class DBTestCase(BaseTestCase):
         pool = launcher.NodePool(*args, **kwargs)
         pool.cleanup_interval = .5
         pool.delete_interval = .5
+        # Checked once the launcher stopped using its node index
+        self.addCleanup(self.assertNodeIndexVerified, pool)
         self.addCleanup(pool.stop)
         return pool
 
+    def assertNodeIndexVerified(self, pool):
+        if pool.zk is not None:
+            self.assertEqual(0, pool.zk.node_index_mismatches)
+
     def useWebApp(self, *args, **kwargs):
         app = webapp.WebApp(*args, **kwargs)
         self.addCleanup(app.stop)
@@ -556,6 +589,8 @@ class DBTestCase(BaseTestCase):
         )
         self.zk.connect([host])
         self.addCleanup(self.zk.disconnect)
+        self.addCleanup(
+            lambda: self.assertEqual(0, self.zk.node_index_mismatches))
 
     def printZKTree(self, node):
         def join(a, b):
@@ -12,10 +12,28 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import concurrent.futures
+import fixtures
+import mock
 import os
+import testtools
+import threading
+import time
 
+from nodepool import exceptions
 from nodepool import tests
+from nodepool import zk
 from nodepool.driver import Drivers
+from nodepool.driver.fake.provider import Dummy, FakeProvider
+from nodepool.driver.openstack.config import ProviderPool
+from nodepool.driver.openstack.handler import LaunchPipeline
+from nodepool.driver.openstack.provider import ServerStatusPoller
+from nodepool.driver.test.provider import TestProvider
+from nodepool.driver.utils import InstanceListCache, LaunchBatch
+from nodepool.driver.utils import LookupCache
+from nodepool.driver.utils import LaunchCounter
+from nodepool.driver.utils import NodeLauncher
+from nodepool.nodeutils import iterate_timeout, PollProfile
 
 
 class TestDrivers(tests.DBTestCase):
@@ -37,3 +55,685 @@ class TestDrivers(tests.DBTestCase):
         configfile = self.setup_config('multi_drivers.yaml')
         self.useBuilder(configfile)
         self.waitForImage('fake-provider', 'fake-image')
+
+
+class TestLaunchCounter(tests.BaseTestCase):
+
+    class Launcher(NodeLauncher):
+        def __init__(self, provider_config, fail=False):
+            super().__init__(mock.Mock(), zk.Node('0000000001'),
+                             provider_config)
+            self._statsd = None
+            self.proceed = threading.Event()
+            self.fail = fail
+
+        def launch(self):
+            self.proceed.wait()
+            if self.fail:
+                raise Exception("Launch failed")
+
+    def test_launch_counter(self):
+        provider_config = mock.Mock()
+        provider_config.name = 'counter-provider'
+        provider_config.launch_workers = 0
+        provider = TestProvider(provider_config)
+        counter = provider.launch_counter
+        self.assertIs(counter, provider.launch_counter)
+        self.assertEqual(0, counter.count)
+
+        launchers = [self.Launcher(provider_config),
+                     self.Launcher(provider_config, fail=True)]
+        futures = [t.submit(provider) for t in launchers]
+        self.assertEqual(2, counter.count)
+        # Other providers are counted separately
+        other_config = mock.Mock()
+        other_config.name = 'other-provider'
+        self.assertEqual(0, TestProvider(other_config).launch_counter.count)
+
+        # The provider replacing this one on a reconfiguration keeps
+        # counting the launches still running.
+        replacement = TestProvider(provider_config)
+        replacement.takeOverLaunches(provider)
+        self.assertIs(counter, replacement.launch_counter)
+
+        for t in launchers:
+            t.proceed.set()
+        concurrent.futures.wait(futures)
+        self.assertEqual(0, counter.count)
+
+    def test_launch_executor(self):
+        provider_config = mock.Mock()
+        provider_config.name = 'executor-provider'
+        provider_config.launch_workers = 1
+        provider = TestProvider(provider_config)
+        statsd = mock.Mock()
+        executor = provider.launch_executor
+        self.assertIs(executor, provider.launch_executor)
+
+        launchers = [self.Launcher(provider_config),
+                     self.Launcher(provider_config)]
+        futures = [executor.submit(launchers[0], statsd)]
+        for _ in iterate_timeout(10, Exception, "launch to start"):
+            if futures[0].running() and not executor.queued:
+                break
+        # The second launch waits for the only worker
+        futures.append(executor.submit(launchers[1], statsd))
+        self.assertEqual(1, executor.queued)
+        statsd.gauge.assert_called_with(
+            'nodepool.provider.executor-provider.launch_queue', 1)
+        for t in launchers:
+            t.proceed.set()
+        concurrent.futures.wait(futures)
+        self.assertEqual(0, executor.queued)
+        self.assertTrue(all(f.exception() is None for f in futures))
+        self.assertEqual(2, statsd.pipeline.return_value.timing.call_count)
+
+        # The workers are gone once the provider stopped, and launches
+        # submitted afterwards run in a thread of their own.
+        provider.stopLaunches(wait=True)
+        self.assertEqual([], [t for t in threading.enumerate()
+                              if t.name.startswith('LaunchWorker-')])
+        launcher = self.Launcher(provider_config)
+        launcher.proceed.set()
+        launcher.submit(provider).result()
+        self.assertEqual(0, executor.queued)
+
+    def test_launch_counter_gauge(self):
+        statsd = mock.Mock()
+        counter = LaunchCounter('gauge-provider')
+        counter.increment(statsd)
+        counter.increment(statsd)
+        counter.decrement(statsd)
+        self.assertEqual(1, counter.count)
+        self.assertEqual(
+            [mock.call('nodepool.provider.gauge-provider.active_launches', x)
+             for x in (1, 2, 1)],
+            statsd.gauge.call_args_list)
+
+
+class TestLaunchPipeline(tests.BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.server = mock.Mock(id='fake-server')
+        self.manager = mock.Mock()
+        self.manager.checkServers.side_effect = self._checkServers
+        self.manager.waitForServerAddresses.side_effect = (
+            lambda server, timeout, auto_ip: server)
+        self.building = 0
+        self.pipeline = LaunchPipeline('pipeline-provider', 2)
+        self.pipeline.interval = 0.01
+        self.addCleanup(self.pipeline.join)
+        self.addCleanup(self.pipeline.stop)
+
+    def _launcher(self, server=None):
+        launcher = mock.Mock()
+        launcher.provider_config.launch_timeout = 60
+        launcher.provider_config.boot_timeout = 60
+        launcher.handler.manager = self.manager
+        launcher.createServer.return_value = server or self.server
+        launcher.scanNode.side_effect = self._scan
+        return launcher
+
+    def _checkServers(self, server_ids):
+        # The servers are reported as building for the first few checks
+        if self.building:
+            self.building -= 1
+            return {}
+        return {server_id: mock.Mock(id=server_id)
+                for server_id in server_ids}
+
+    def _scan(self):
+        # The node takes a while to be reachable
+        scan = concurrent.futures.Future()
+        threading.Timer(0.05, scan.set_result, [['ssh-rsa KEY']]).start()
+        return scan
+
+    def _submit(self, launcher):
+        future = self.pipeline.submit(launcher)
+        return future.result(timeout=10)
+
+    def test_launch_pipeline(self):
+        # The servers are checked together until all of them are built
+        self.building = 3
+        launchers = [self._launcher(mock.Mock(id='server-%s' % x))
+                     for x in range(10)]
+        futures = [self.pipeline.submit(launcher) for launcher in launchers]
+        concurrent.futures.wait(futures, timeout=10)
+        checked = [call[0][0] for call in
+                   self.manager.checkServers.call_args_list]
+        self.assertIn(sorted('server-%s' % x for x in range(10)),
+                      [sorted(ids) for ids in checked])
+        for future, launcher in zip(futures, launchers):
+            self.assertTrue(future.done())
+            server_id = launcher.createServer.return_value.id
+            self.assertEqual(
+                server_id, launcher.serverActive.call_args[0][0].id)
+            launcher.scanNode.assert_called_once_with()
+            scan = launcher.nodeScanned.call_args[0][0]
+            self.assertEqual(['ssh-rsa KEY'], scan.result())
+            launcher.launchSucceeded.assert_called_once_with()
+            launcher.finishLaunch.assert_called_once_with(mock.ANY)
+        # No launch waited on a thread of its own
+        self.assertEqual([], [t for t in threading.enumerate()
+                              if t.name.startswith('NodeLauncher-')])
+
+    def test_launch_pipeline_slow_address(self):
+        # Collecting the addresses of a server only holds up its own launch
+        proceed = threading.Event()
+
+        def waitForServerAddresses(server, timeout, auto_ip):
+            if server.id == 'slow-server':
+                proceed.wait(10)
+            return server
+        self.manager.waitForServerAddresses.side_effect = (
+            waitForServerAddresses)
+        slow = self.pipeline.submit(
+            self._launcher(mock.Mock(id='slow-server')))
+        for _ in iterate_timeout(10, Exception, "slow address",
+                                 profile=PollProfile(0.01)):
+            if self.manager.waitForServerAddresses.called:
+                break
+        other = self.pipeline.submit(self._launcher())
+        other.result(timeout=10)
+        self.assertFalse(slow.done())
+        proceed.set()
+        slow.result(timeout=10)
+
+    def test_launch_pipeline_retry(self):
+        launcher = self._launcher()
+        launcher.pool.host_key_checking = False
+        launcher.createServer.side_effect = [Exception("Create failed"),
+                                             self.server]
+        self._submit(launcher)
+        launcher.launchAttemptFailed.assert_called_once_with(mock.ANY, 1)
+        self.assertEqual(2, launcher.createServer.call_count)
+        launcher.scanNode.assert_not_called()
+        self.assertEqual([], launcher.node.host_keys)
+        launcher.finishLaunch.assert_called_once_with(mock.ANY)
+
+    def test_launch_pipeline_failure(self):
+        self.manager.checkServers.side_effect = Exception("Server error")
+        launcher = self._launcher()
+        error = Exception("Out of retries")
+        launcher.launchAttemptFailed.side_effect = error
+        self._submit(launcher)
+        launcher.launchSucceeded.assert_not_called()
+        launcher.finishLaunch.assert_called_once_with(mock.ANY, error)
+
+    def test_launch_pipeline_stopped(self):
+        self.pipeline.stop()
+        launcher = self._launcher()
+        self.pipeline.submit(launcher)
+        # The launch was handed to the launch executor of the provider
+        self.manager.launch_executor.submit.assert_called_once_with(
+            launcher, None)
+        launcher.createServer.assert_not_called()
+
+
+class TestServerStatusPoller(tests.BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.servers = []
+        self.listings = 0
+        self.poller = ServerStatusPoller('poller-provider', self._list, 0.1)
+        self.addCleanup(self.poller.join)
+        self.addCleanup(self.poller.stop)
+
+    def _list(self):
+        self.listings += 1
+        return list(self.servers)
+
+    def _built(self, server):
+        return server is not None and server.status != 'BUILD'
+
+    def test_server_status_poller(self):
+        self.servers = [mock.Mock(id='server%s' % x, status='BUILD')
+                        for x in range(20)]
+        results = {}
+
+        def wait(server_id):
+            results[server_id] = self.poller.waitFor(
+                server_id, self._built, 10, exceptions.TimeoutException,
+                "server %s" % server_id)
+
+        threads = [threading.Thread(target=wait, args=(server.id,))
+                   for server in self.servers]
+        for t in threads:
+            t.start()
+        # Let the waiters see a few listings of the servers building
+        while self.listings < 3:
+            time.sleep(0.01)
+        for server in self.servers:
+            server.status = 'ACTIVE'
+        for t in threads:
+            t.join()
+
+        self.assertEqual({server.id: server for server in self.servers},
+                         results)
+        # The waiters shared the listings rather than polling every server
+        self.assertLess(self.listings, len(self.servers))
+
+    def test_server_status_poller_delete(self):
+        server = mock.Mock(id='server', status='ACTIVE')
+        self.servers = [server]
+        with testtools.ExpectedException(exceptions.ServerDeleteException):
+            self.poller.waitFor('server', lambda s: s is None, 0.1,
+                                exceptions.ServerDeleteException,
+                                "server deletion")
+        self.servers = []
+        self.assertIsNone(self.poller.waitFor(
+            'server', lambda s: s is None, 10,
+            exceptions.ServerDeleteException, "server deletion"))
+
+    def test_server_status_poller_interval(self):
+        self.poller.interval = 60
+        self.servers = [mock.Mock(id='server', status='BUILD')]
+        self.assertEqual(['server'], list(self.poller.listServers()))
+        self.servers = []
+        # The servers are listed at most once per interval
+        self.assertEqual(['server'], list(self.poller.listServers()))
+        self.assertEqual(1, self.listings)
+
+
+class TestLaunchBatch(tests.BaseTestCase):
+
+    def _launchers(self, *labels):
+        launchers = []
+        for i, label in enumerate(labels):
+            launcher = mock.Mock(batch=None)
+            launcher.node.id = '%04d' % i
+            launcher.node.type = [label]
+            launchers.append(launcher)
+        return launchers
+
+    def test_launch_batch(self):
+        create = mock.Mock(return_value=['instance0', 'instance1'])
+        launchers = self._launchers('label', 'label', 'label')
+        batch = LaunchBatch(launchers, create)
+
+        results = {}
+
+        def claim(launcher):
+            results[launcher.node.id] = batch.claim(launcher)
+
+        threads = [threading.Thread(target=claim, args=(launcher,))
+                   for launcher in launchers]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # The instances were created once for the whole batch, the launcher
+        # left without one creates its own.
+        create.assert_called_once_with(launchers)
+        self.assertEqual({'0000': 'instance0', '0001': 'instance1',
+                          '0002': None}, results)
+        # Retries create their own instance
+        self.assertIsNone(batch.claim(launchers[0]))
+
+    def test_launch_batch_failure(self):
+        create = mock.Mock(side_effect=Exception("Create failed"))
+        launchers = self._launchers('label', 'label')
+        batch = LaunchBatch(launchers, create)
+        self.assertIsNone(batch.claim(launchers[0]))
+        self.assertIsNone(batch.claim(launchers[1]))
+        create.assert_called_once_with(launchers)
+
+    def test_launch_batch_assign(self):
+        launchers = self._launchers('a', 'b', 'a', 'a', 'b', 'c')
+        LaunchBatch.assign(launchers, 2, mock.Mock())
+        batches = [launcher.batch for launcher in launchers]
+        # Launchers of a label are put into batches of up to two
+        self.assertIs(batches[0], batches[2])
+        self.assertEqual([launchers[0], launchers[2]], batches[0].launchers)
+        self.assertEqual([launchers[1], launchers[4]], batches[1].launchers)
+        self.assertIsNot(batches[0], batches[1])
+        # Launchers which would be alone are left out
+        self.assertIsNone(batches[3])
+        self.assertIsNone(batches[5])
+
+    def test_launch_batch_create_unlocked(self):
+        creating = threading.Event()
+        created = threading.Event()
+
+        def create(launchers):
+            creating.set()
+            created.wait()
+            return ['instance0', 'instance1']
+
+        launchers = self._launchers('label', 'label', 'label')
+        batch = LaunchBatch(launchers, create)
+        results = {}
+        thread = threading.Thread(target=lambda: results.setdefault(
+            '0000', batch.claim(launchers[0])))
+        thread.start()
+        creating.wait()
+        # The lock of the batch is not held while the instances are
+        # created, the other launchers wait for the creation instead.
+        self.assertFalse(batch._lock.locked())
+        waiter = threading.Thread(target=lambda: results.setdefault(
+            '0001', batch.claim(launchers[1])))
+        waiter.start()
+        created.set()
+        thread.join()
+        waiter.join()
+        self.assertEqual({'0000': 'instance0', '0001': 'instance1'}, results)
+
+    def test_launch_batch_size_metadata(self):
+        provider = mock.Mock(launch_batch_size=122)
+        provider.name = 'fake-provider'
+        full_config = mock.Mock()
+        full_config.labels = {'fake-label': mock.Mock(pools=[])}
+        pool_config = {'name': 'main', 'labels': [
+            {'name': 'fake-label', 'min-ram': 8192,
+             'instance-properties': {'prop': 'value'}}]}
+        ProviderPool().load(pool_config, full_config, provider)
+        # A server of a batch has a metadata item per node of the batch
+        provider.launch_batch_size = 123
+        self.assertRaises(ValueError, ProviderPool().load,
+                          pool_config, full_config, provider)
+
+    def _fakeProvider(self):
+        provider_config = mock.Mock()
+        provider_config.name = 'fake-provider'
+        provider_config.lookup_cache_ttl = 3600
+        provider = FakeProvider(provider_config)
+        provider.resetClient()
+        return provider
+
+    def test_create_servers(self):
+        provider = self._fakeProvider()
+        client = provider._getClient()
+        client.create_server(name='host-other')
+        client.calls.clear()
+
+        servers = provider.createServers(
+            'host', ['0001', '0002', '0003'],
+            image=dict(id='fake-image-id'), flavor_name='Fake Flavor')
+
+        # The servers were created and looked up with a request each, and
+        # are assigned to their node by the index nova named them after.
+        self.assertEqual({'list_flavors': 1, 'create_server': 1,
+                          'compute.servers': 1}, dict(client.calls))
+        batch_id = servers[0].metadata['nodepool_batch_id']
+        self.assertEqual(['host-%s-%d' % (batch_id, i) for i in (1, 2, 3)],
+                         [server.name for server in servers])
+        self.assertEqual(['0001', '0002', '0003'],
+                         [provider.serverNodeId(server)
+                          for server in servers])
+        self.assertEqual(3, len(set(server.id for server in servers)))
+        self.assertEqual(4, len(client._server_list))
+
+    def test_create_servers_quota(self):
+        provider = self._fakeProvider()
+        client = provider._getClient()
+        client.max_instances = 2
+
+        # The cloud creates as many servers as the quota allows
+        servers = provider.createServers(
+            'host', ['0001', '0002', '0003'],
+            image=dict(id='fake-image-id'), flavor_name='Fake Flavor')
+        self.assertEqual({'list_flavors': 1, 'create_server': 1,
+                          'compute.servers': 1}, dict(client.calls))
+        self.assertEqual(['0001', '0002'],
+                         [provider.serverNodeId(server)
+                          for server in servers[:2]])
+        self.assertIsNone(servers[2])
+        self.assertEqual(2, len(client._server_list))
+
+    def test_create_servers_single(self):
+        provider = self._fakeProvider()
+        client = provider._getClient()
+        client.max_instances = 1
+
+        # Nova does not number the name of a single server
+        servers = provider.createServers(
+            'host', ['0001', '0002', '0003'],
+            image=dict(id='fake-image-id'), flavor_name='Fake Flavor')
+        batch_id = servers[0].metadata['nodepool_batch_id']
+        self.assertEqual('host-%s' % batch_id, servers[0].name)
+        self.assertEqual('0001', provider.serverNodeId(servers[0]))
+        self.assertEqual([None, None], servers[1:])
+        self.assertEqual(1, len(client._server_list))
+
+    def test_server_node_id(self):
+        provider = self._fakeProvider()
+        server = Dummy(Dummy.INSTANCE, name='host',
+                       metadata={'nodepool_node_id': '0001'})
+        self.assertEqual('0001', provider.serverNodeId(server))
+        meta = {'nodepool_batch_id': 'batch',
+                'nodepool_node_id_1': '0001',
+                'nodepool_node_id_2': '0002'}
+        server = Dummy(Dummy.INSTANCE, name='host-batch-2', metadata=meta)
+        self.assertEqual('0002', provider.serverNodeId(server))
+        server = Dummy(Dummy.INSTANCE, name='host-batch', metadata=meta)
+        self.assertEqual('0001', provider.serverNodeId(server))
+        # A server named otherwise has no node
+        server = Dummy(Dummy.INSTANCE, name='host-batch-3', metadata=meta)
+        self.assertIsNone(provider.serverNodeId(server))
+
+
+class TestInstanceListCache(tests.BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.instances = ['instance0']
+        self.listings = 0
+        self.listed = threading.Event()
+        self.statsd = mock.Mock()
+        self.useFixture(fixtures.MockPatch(
+            'nodepool.stats.get_client', return_value=self.statsd))
+        self.cache = InstanceListCache('cache-provider', self._list, 60)
+        self.addCleanup(self.cache.join)
+        self.addCleanup(self.cache.stop)
+
+    def _list(self):
+        self.listings += 1
+        self.listed.wait()
+        return list(self.instances)
+
+    def test_instance_list_cache(self):
+        self.listed.set()
+        self.assertEqual(['instance0'], self.cache.get())
+        self.instances.append('instance1')
+        # The listing is shared until it expires or is invalidated
+        self.assertEqual(['instance0'], self.cache.get())
+        self.assertEqual(1, self.listings)
+        self.cache.invalidate()
+        self.assertEqual(['instance0', 'instance1'], self.cache.get())
+        self.assertEqual(2, self.listings)
+        self.assertEqual(
+            [mock.call('nodepool.provider.cache-provider.'
+                       'instance_list.%s' % x)
+             for x in ('misses', 'hits', 'misses')],
+            self.statsd.incr.call_args_list)
+
+    def test_instance_list_cache_concurrent(self):
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(self.cache.get()))
+            for x in range(10)]
+        for t in threads:
+            t.start()
+        # Only one of the readers lists the instances, the others wait for
+        # its listing.
+        while self.listings < 1:
+            time.sleep(0.01)
+        self.listed.set()
+        for t in threads:
+            t.join()
+        self.assertEqual([['instance0']] * 10, results)
+        self.assertEqual(1, self.listings)
+
+    def test_instance_list_cache_invalidated_listing(self):
+        result = []
+        t = threading.Thread(target=lambda: result.append(self.cache.get()))
+        t.start()
+        while self.listings < 1:
+            time.sleep(0.01)
+        # An instance is created while the instances are being listed
+        self.instances.append('instance1')
+        self.cache.invalidate()
+        self.listed.set()
+        t.join()
+        self.assertEqual([['instance0', 'instance1']], result)
+        # The listing which may have missed it is not shared
+        self.cache.get()
+        self.assertEqual(2, self.listings)
+
+    def test_instance_list_cache_refresh(self):
+        self.listed.set()
+        self.cache.ttl = 0.2
+        self.cache.get()
+        # The listing is refreshed in the background while it is read
+        for x in range(10):
+            self.assertEqual(['instance0'], self.cache.get())
+            time.sleep(0.05)
+        self.assertGreater(self.listings, 1)
+        self.assertEqual(1, self.statsd.incr.call_args_list.count(
+            mock.call('nodepool.provider.cache-provider.'
+                      'instance_list.misses')))
+
+
+class TestLookupCache(tests.BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.resources = {'flavor': 'Fake Flavor'}
+        self.lookups = []
+        self.looked_up = threading.Event()
+        self.looked_up.set()
+        self.cache = LookupCache(self._lookup, 60, negative_ttl=0.1)
+
+    def _lookup(self, key):
+        self.lookups.append(key)
+        self.looked_up.wait()
+        if key == 'error':
+            raise Exception("Lookup failed")
+        return self.resources.get(key)
+
+    def test_lookup_cache(self):
+        self.assertEqual('Fake Flavor', self.cache.get('flavor'))
+        self.resources['flavor'] = 'Unreal Flavor'
+        self.assertEqual('Fake Flavor', self.cache.get('flavor'))
+        self.assertEqual(['flavor'], self.lookups)
+
+    def test_lookup_cache_expiry(self):
+        self.cache = LookupCache(self._lookup, 0.1)
+        self.assertEqual('Fake Flavor', self.cache.get('flavor'))
+        self.resources['flavor'] = 'Unreal Flavor'
+        time.sleep(0.1)
+        self.assertEqual('Unreal Flavor', self.cache.get('flavor'))
+        self.assertEqual(['flavor'] * 2, self.lookups)
+
+    def test_lookup_cache_negative(self):
+        self.assertIsNone(self.cache.get('image'))
+        self.assertIsNone(self.cache.get('image'))
+        self.assertEqual(['image'], self.lookups)
+        # A missing resource is looked up again after the negative TTL
+        self.resources['image'] = 'Fake Image'
+        time.sleep(0.1)
+        self.assertEqual('Fake Image', self.cache.get('image'))
+        self.assertEqual(['image'] * 2, self.lookups)
+
+    def test_lookup_cache_invalidate(self):
+        self.cache.get('flavor')
+        self.cache.get('network')
+        self.cache.invalidate('flavor')
+        self.cache.get('flavor')
+        self.cache.get('network')
+        self.assertEqual(['flavor', 'network', 'flavor'], self.lookups)
+        self.cache.invalidate()
+        self.cache.get('flavor')
+        self.cache.get('network')
+        self.assertEqual(['flavor', 'network', 'flavor',
+                          'flavor', 'network'], self.lookups)
+
+    def test_lookup_cache_failure(self):
+        for x in range(2):
+            with testtools.ExpectedException(Exception, "Lookup failed"):
+                self.cache.get('error')
+        # Failures are not cached
+        self.assertEqual(['error'] * 2, self.lookups)
+
+    def test_lookup_cache_concurrent(self):
+        self.looked_up.clear()
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(self.cache.get('flavor')))
+            for x in range(10)]
+        for t in threads:
+            t.start()
+        # Only one of the readers looks the key up, the others wait for its
+        # result.
+        while not self.lookups:
+            time.sleep(0.01)
+        self.looked_up.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(['Fake Flavor'] * 10, results)
+        self.assertEqual(['flavor'], self.lookups)
+
+    def test_lookup_cache_invalidated_lookup(self):
+        self.looked_up.clear()
+        t = threading.Thread(target=self.cache.get, args=('flavor',))
+        t.start()
+        while not self.lookups:
+            time.sleep(0.01)
+        # The flavor is invalidated while it is being looked up
+        self.cache.invalidate('flavor')
+        self.looked_up.set()
+        t.join()
+        self.cache.get('flavor')
+        self.assertEqual(['flavor'] * 2, self.lookups)
+
+    def test_find_flavor(self):
+        provider_config = mock.Mock()
+        provider_config.name = 'fake-provider'
+        provider_config.lookup_cache_ttl = 3600
+        provider = FakeProvider(provider_config)
+        provider.resetClient()
+        client = provider._getClient()
+
+        # The flavors are listed once and the flavor found for every
+        # flavor name and min ram is kept.
+        for x in range(3):
+            self.assertEqual('f1', provider.findFlavor('Fake', 8192).id)
+            self.assertEqual(
+                'f2', provider.findFlavor('Unreal Flavor', None).id)
+        self.assertEqual(1, client.calls['list_flavors'])
+        with testtools.ExpectedException(
+                Exception, "Unable to find flavor: Missing Flavor"):
+            provider.findFlavor('Missing Flavor', None)
+        # A missing flavor is looked for in a new listing
+        self.assertEqual(2, client.calls['list_flavors'])
+
+        provider.invalidateFlavors()
+        self.assertEqual('f1', provider.findFlavor('Fake', 8192).id)
+        self.assertEqual(3, client.calls['list_flavors'])
+
+    def test_find_flavor_added(self):
+        self.useFixture(fixtures.MockPatch(
+            'nodepool.driver.openstack.provider.LOOKUP_NEGATIVE_TTL', 0.1))
+        provider_config = mock.Mock()
+        provider_config.name = 'fake-provider'
+        provider_config.lookup_cache_ttl = 3600
+        provider = FakeProvider(provider_config)
+        provider.resetClient()
+        client = provider._getClient()
+
+        self.assertEqual('f1', provider.findFlavor('Fake', 8192).id)
+        with testtools.ExpectedException(
+                Exception, "Unable to find flavor: New Flavor"):
+            provider.findFlavor('New Flavor', None)
+        client._flavor_list = client._flavor_list + [
+            Dummy(Dummy.FLAVOR, id='f3', ram=8192, name='New Flavor',
+                  vcpus=4)]
+        # A flavor added to the cloud is found once the negative TTL
+        # expired, although the listing is kept much longer.
+        time.sleep(0.1)
+        self.assertEqual('f3', provider.findFlavor('New Flavor', None).id)
+        self.assertEqual('f1', provider.findFlavor('Fake', 8192).id)
+        self.assertEqual(3, client.calls['list_flavors'])
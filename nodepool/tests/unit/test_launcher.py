@@ -15,6 +15,7 @@
 
 import logging
 import math
+import threading
 import time
 import fixtures
 import mock
@@ -114,6 +115,204 @@ class TestLauncher(tests.DBTestCase):
         self.assertReportedStat('nodepool.label.fake-label2.nodes.aborted',
                                 value='0', kind='g')
 
+    def test_node_assignment_wakeup(self):
+        '''
+        Node requests should be handled as soon as they are submitted
+        instead of when the pool worker polls again.
+        '''
+        configfile = self.setup_config('node_no_min_ready.yaml')
+        self.useBuilder(configfile)
+        self.waitForImage('fake-provider', 'fake-image')
+
+        pool = self.useNodepool(configfile, watermark_sleep=300)
+        pool.start()
+        for _ in iterate_timeout(30, Exception, "pool worker to start"):
+            workers = pool.getPoolWorkers('fake-provider')
+            if workers and workers[0].running:
+                break
+        # Let the pool worker finish its first pass and go to sleep
+        time.sleep(1)
+
+        start = time.monotonic()
+        req = zk.NodeRequest()
+        req.state = zk.REQUESTED
+        req.node_types.append('fake-label')
+        self.zk.storeNodeRequest(req)
+
+        req = self.waitForNodeRequest(req)
+        self.assertEqual(req.state, zk.FULFILLED)
+        self.assertLess(time.monotonic() - start, 60)
+
+    def test_node_assignment_wakeup_during_pass(self):
+        '''
+        A wakeup while the pool worker is busy should not be lost.
+        '''
+        configfile = self.setup_config('node_no_min_ready.yaml')
+        self.useBuilder(configfile)
+        self.waitForImage('fake-provider', 'fake-image')
+
+        pool = self.useNodepool(configfile, watermark_sleep=300)
+        pool.start()
+        for _ in iterate_timeout(30, Exception, "pool worker to start"):
+            workers = pool.getPoolWorkers('fake-provider')
+            if workers and workers[0].running:
+                break
+        worker = workers[0]
+        # Let the pool worker finish its first pass and go to sleep
+        time.sleep(1)
+
+        passes = []
+
+        def assign_handlers(timeout=15):
+            passes.append(time.monotonic())
+            if len(passes) == 1:
+                # Something happens while the pass is running
+                worker.wake_event.set()
+            return True
+
+        with mock.patch.object(worker, '_assignHandlers',
+                               side_effect=assign_handlers):
+            worker.wake_event.set()
+            for _ in iterate_timeout(60, Exception, "second pass"):
+                if len(passes) >= 2:
+                    break
+
+    def test_node_assignment_launch_workers(self):
+        '''
+        Launches should be queued for a bounded number of launch workers.
+        '''
+        configfile = self.setup_config('node_launch_workers.yaml')
+        self.useBuilder(configfile)
+        self.waitForImage('fake-provider', 'fake-image')
+
+        pool = self.useNodepool(configfile, watermark_sleep=1)
+        pool.start()
+
+        req = zk.NodeRequest()
+        req.state = zk.REQUESTED
+        req.node_types.extend(['fake-label', 'fake-label'])
+        self.zk.storeNodeRequest(req)
+
+        req = self.waitForNodeRequest(req)
+        self.assertEqual(req.state, zk.FULFILLED)
+        self.assertEqual(2, len(req.nodes))
+        for node_id in req.nodes:
+            self.assertEqual(zk.READY, self.zk.getNode(node_id).state)
+        workers = [t for t in threading.enumerate()
+                   if t.name.startswith('LaunchWorker-fake-provider')]
+        self.assertEqual(1, len(workers))
+
+    def test_node_assignment_launch_pipeline(self):
+        '''
+        Launches should be advanced through their stages by the pipeline.
+        '''
+        configfile = self.setup_config('node_launch_pipeline.yaml')
+        self.useBuilder(configfile)
+        self.waitForImage('fake-provider', 'fake-image')
+
+        pool = self.useNodepool(configfile, watermark_sleep=1)
+        pool.start()
+        self.wait_for_config(pool)
+        manager = pool.getProviderManager('fake-provider')
+        # The first create call fails and is retried by the pipeline
+        manager.createServer_fails = 1
+
+        req = zk.NodeRequest()
+        req.state = zk.REQUESTED
+        req.node_types.extend(['fake-label'] * 4)
+        self.zk.storeNodeRequest(req)
+
+        req = self.waitForNodeRequest(req)
+        self.assertEqual(req.state, zk.FULFILLED)
+        self.assertEqual(0, manager.createServer_fails)
+        self.assertEqual(4, len(req.nodes))
+        for node_id in req.nodes:
+            node = self.zk.getNode(node_id)
+            self.assertEqual(zk.READY, node.state)
+            self.assertEqual(['ssh-rsa FAKEKEY'], node.host_keys)
+            self.assertEqual('fake', node.interface_ip)
+
+        # No thread was dedicated to any of the launches
+        self.assertEqual([], [t for t in threading.enumerate()
+                              if t.name.startswith('NodeLauncher-')])
+
+    def test_node_assignment_status_poll(self):
+        '''
+        Servers should be awaited by listing them all rather than one by one.
+        '''
+        configfile = self.setup_config('node_status_poll.yaml')
+        self.useBuilder(configfile)
+        self.waitForImage('fake-provider', 'fake-image')
+
+        pool = self.useNodepool(configfile, watermark_sleep=1)
+        pool.start()
+        self.wait_for_config(pool)
+        client = pool.getProviderManager('fake-provider')._getClient()
+
+        req = zk.NodeRequest()
+        req.state = zk.REQUESTED
+        req.node_types.extend(['fake-label'] * 4)
+        self.zk.storeNodeRequest(req)
+
+        req = self.waitForNodeRequest(req)
+        self.assertEqual(req.state, zk.FULFILLED)
+        self.assertEqual(4, len(req.nodes))
+        self.assertEqual(0, client.calls['get_server'])
+        self.assertGreater(client.calls['list_servers'], 0)
+
+        # Deletions are awaited by the poller as well
+        node = self.zk.getNode(req.nodes[0])
+        self.zk.lockNode(node, blocking=False)
+        node.state = zk.USED
+        self.zk.storeNode(node)
+        self.zk.unlockNode(node)
+        self.waitForNodeDeletion(node)
+        self.assertEqual(3, len(client._server_list))
+
+    def test_node_assignment_launch_batch(self):
+        '''
+        The servers of a label should be created in batches.
+        '''
+        configfile = self.setup_config('node_launch_batch.yaml')
+        self.useBuilder(configfile)
+        self.waitForImage('fake-provider', 'fake-image')
+
+        pool = self.useNodepool(configfile, watermark_sleep=1)
+        pool.start()
+        self.wait_for_config(pool)
+        manager = pool.getProviderManager('fake-provider')
+        client = manager._getClient()
+
+        req = zk.NodeRequest()
+        req.state = zk.REQUESTED
+        req.node_types.extend(['fake-label'] * 4 + ['fake-label2'])
+        self.zk.storeNodeRequest(req)
+
+        req = self.waitForNodeRequest(req)
+        self.assertEqual(req.state, zk.FULFILLED)
+        self.assertEqual(5, len(req.nodes))
+        # A batch of three and one of one server for fake-label, one
+        # server for fake-label2
+        self.assertEqual(3, client.calls['create_server'])
+        # The servers of the batch were looked up once
+        self.assertEqual(1, client.calls['compute.servers'])
+
+        # Every server was assigned to its node by its name, without
+        # changing the server afterwards, and every node has its own
+        # hostname.
+        servers = {server.id: server for server in client._server_list}
+        batched = 0
+        for node_id in req.nodes:
+            node = self.zk.getNode(node_id)
+            self.assertEqual(node.state, zk.READY)
+            server = servers[node.external_id]
+            self.assertEqual(node.id, manager.serverNodeId(server))
+            self.assertEqual('%s-fake-provider-%s' % (node.type[0], node.id),
+                             node.hostname)
+            if 'nodepool_batch_id' in server.metadata:
+                batched += 1
+        self.assertEqual(3, batched)
+
     def test_node_assignment_order(self):
         """Test that nodes are assigned in the order requested"""
         configfile = self.setup_config('node_many_labels.yaml')
@@ -982,6 +1181,61 @@ class TestLauncher(tests.DBTestCase):
         servers = manager.listNodes()
         self.assertEqual(len(servers), 1)
 
+    def test_leaked_node_buckets(self):
+        """Test that nodes from before node buckets keep their instance"""
+        configfile = self.setup_config('leaked_node.yaml')
+        pool = self.useNodepool(configfile, watermark_sleep=1)
+        self.useBuilder(configfile)
+        pool.start()
+        self.waitForImage('fake-provider', 'fake-image')
+        nodes = self.waitForNodes('fake-label')
+        self.assertEqual(len(nodes), 1)
+        self.assertIsNone(self.zk._nodeBucket(nodes[0].id))
+
+        # Enable node buckets while the node exists
+        self.replace_config(configfile, 'leaked_node_buckets.yaml')
+        for _ in iterate_timeout(60, Exception, "node buckets enabled"):
+            if pool.config.zookeeper_node_buckets == 2:
+                break
+
+        # The node keeps its ID, so its instance is not mistaken for a
+        # leaked one.
+        manager = pool.getProviderManager('fake-provider')
+        manager.cleanupLeakedResources()
+        node = self.zk.getNode(nodes[0].id)
+        self.assertEqual(zk.READY, node.state)
+        self.assertEqual([node.external_id],
+                         [server.id for server in manager.listNodes()])
+
+    def test_leaked_node_instance_list(self):
+        """Test that a leaked node is deleted with a shared server listing"""
+        configfile = self.setup_config('leaked_node_instance_list.yaml')
+        pool = self.useNodepool(configfile, watermark_sleep=1)
+        self.useBuilder(configfile)
+        pool.start()
+        self.waitForImage('fake-provider', 'fake-image')
+        nodes = self.waitForNodes('fake-label')
+        self.assertEqual(len(nodes), 1)
+        manager = pool.getProviderManager('fake-provider')
+        client = manager._getClient()
+
+        # The listing is shared by the readers
+        listings = client.calls['list_servers']
+        for x in range(5):
+            self.assertEqual(1, len(manager.listNodes()))
+        self.assertLessEqual(client.calls['list_servers'] - listings, 1)
+
+        # Delete the node from ZooKeeper, but leave the instance
+        # so it is leaked.
+        self.zk.deleteNode(nodes[0])
+
+        # Wait for nodepool to replace it and clean up the instance
+        new_nodes = self.waitForNodes('fake-label')
+        self.assertEqual(len(new_nodes), 1)
+        self.waitForInstanceDeletion(manager, nodes[0].external_id)
+        servers = manager.listNodes()
+        self.assertEqual(len(servers), 1)
+
     def test_max_ready_age(self):
         """Test a node with exceeded max-ready-age is deleted"""
         configfile = self.setup_config('node_max_ready_age.yaml')
@@ -0,0 +1,228 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import concurrent.futures
+import socket
+import threading
+import time
+
+import fixtures
+import mock
+import paramiko
+import testtools
+
+from nodepool import exceptions
+from nodepool import nodeutils
+from nodepool import tests
+
+
+class TestIterateTimeout(tests.BaseTestCase):
+
+    def test_poll_profile(self):
+        profile = nodeutils.PollProfile(0.5, ceiling=4, factor=2)
+        intervals = profile.intervals()
+        self.assertEqual([0.5, 1, 2, 4, 4],
+                         [next(intervals) for x in range(5)])
+
+        # The jitter never takes the intervals beyond the floor and ceiling
+        profile = nodeutils.PollProfile(0.5, ceiling=4, factor=2, jitter=0.5)
+        intervals = [i for i, x in zip(profile.intervals(), range(100))]
+        self.assertTrue(all(0.5 <= i <= 4 for i in intervals))
+        self.assertNotEqual(1, len(set(intervals[10:])))
+
+    def test_iterate_timeout_profile(self):
+        sleep = self.useFixture(fixtures.MockPatch('time.sleep')).mock
+        profile = nodeutils.PollProfile(0.1, ceiling=0.4, factor=2)
+        for count in nodeutils.iterate_timeout(
+                60, Exception, "test", profile=profile):
+            if count == 5:
+                break
+        self.assertEqual([mock.call(x) for x in (0.1, 0.2, 0.4, 0.4)],
+                         sleep.call_args_list)
+
+    def test_iterate_timeout_default(self):
+        sleep = self.useFixture(fixtures.MockPatch('time.sleep')).mock
+        for count in nodeutils.iterate_timeout(60, Exception, "test"):
+            if count == 3:
+                break
+        self.assertEqual([mock.call(nodeutils.ITERATE_INTERVAL)] * 2,
+                         sleep.call_args_list)
+
+    def test_iterate_timeout_stats(self):
+        statsd = mock.Mock()
+        self.useFixture(fixtures.MockPatch(
+            'nodepool.stats.get_client', return_value=statsd))
+        profile = nodeutils.PollProfile(0.01)
+        for count in nodeutils.iterate_timeout(
+                60, Exception, "test", profile=profile, name='test-site'):
+            if count == 3:
+                break
+        pipeline = statsd.pipeline.return_value
+        self.assertEqual([mock.call('nodepool.poll.test-site.waits'),
+                          mock.call('nodepool.poll.test-site.polls', 3)],
+                         pipeline.incr.call_args_list)
+
+        pipeline.reset_mock()
+        with testtools.ExpectedException(exceptions.TimeoutException):
+            for count in nodeutils.iterate_timeout(
+                    0.05, exceptions.TimeoutException, "test",
+                    profile=profile, name='test-site'):
+                pass
+        pipeline.incr.assert_called_with('nodepool.poll.test-site.timeouts')
+
+
+class FakeSSHServer(object):
+    '''
+    A local SSH server which only goes as far as the key exchange.
+    '''
+
+    def __init__(self):
+        self.key = paramiko.RSAKey.generate(2048)
+        self.host_key = "%s %s" % (self.key.get_name(),
+                                   self.key.get_base64())
+        self.connections = 0
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.bind(('127.0.0.1', 0))
+        self.port = self._sock.getsockname()[1]
+        self._sock.settimeout(0.1)
+        self._transports = []
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        # Connections are refused until the socket listens
+        self._sock.listen(16)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        if self._thread:
+            self._thread.join()
+        self._sock.close()
+        for t in self._transports:
+            t.close()
+
+    def _run(self):
+        while not self._stopped:
+            try:
+                conn, addr = self._sock.accept()
+            except socket.timeout:
+                continue
+            conn.settimeout(None)
+            self.connections += 1
+            t = paramiko.Transport(conn)
+            t.add_server_key(self.key)
+            t.start_server(event=threading.Event(),
+                           server=paramiko.ServerInterface())
+            self._transports.append(t)
+
+
+class TestKeyscanService(tests.BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.server = FakeSSHServer()
+        self.addCleanup(self.server.stop)
+        self.service = nodeutils.KeyscanService.get()
+
+    def test_keyscan(self):
+        self.server.start()
+        scan = self.service.scan('127.0.0.1', port=self.server.port,
+                                 timeout=10)
+        self.assertEqual([self.server.host_key], scan.result())
+
+    def test_keyscan_many_hosts(self):
+        self.server.start()
+        scans = [self.service.scan('127.0.0.1', port=self.server.port,
+                                   timeout=10)
+                 for x in range(20)]
+        concurrent.futures.wait(scans, timeout=30)
+        for scan in scans:
+            self.assertEqual([self.server.host_key], scan.result())
+        self.assertEqual(20, self.server.connections)
+
+    def test_keyscan_no_host_keys(self):
+        self.server.start()
+        scan = self.service.scan('127.0.0.1', port=self.server.port,
+                                 timeout=10, gather_hostkeys=False)
+        self.assertEqual([], scan.result())
+
+    def test_keyscan_host_booting(self):
+        scan = self.service.scan('127.0.0.1', port=self.server.port,
+                                 timeout=10)
+        # The scan keeps trying while the connections are refused
+        time.sleep(0.5)
+        self.assertFalse(scan.done())
+        self.server.start()
+        self.assertEqual([self.server.host_key], scan.result())
+
+    def test_keyscan_timeout(self):
+        scan = self.service.scan('127.0.0.1', port=self.server.port,
+                                 timeout=0.5)
+        with testtools.ExpectedException(
+                exceptions.ConnectionTimeoutException):
+            scan.result()
+
+    def _stallingHost(self):
+        # A host which accepts connections but never sends its SSH banner
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(64)
+        self.addCleanup(sock.close)
+        return sock.getsockname()[1]
+
+    def test_keyscan_stalled_hosts(self):
+        port = self._stallingHost()
+        self.server.start()
+        stalled = [self.service.scan('127.0.0.1', port=port, timeout=3)
+                   for x in range(20)]
+        time.sleep(0.5)
+        # Hosts stalling the handshake do not hold up other scans
+        start = time.monotonic()
+        scan = self.service.scan('127.0.0.1', port=self.server.port,
+                                 timeout=10)
+        self.assertEqual([self.server.host_key], scan.result())
+        self.assertLess(time.monotonic() - start, 2)
+        for scan in stalled:
+            self.assertRaises(exceptions.ConnectionTimeoutException,
+                              scan.result)
+
+    def test_keyscan_stalled_host_timeout(self):
+        port = self._stallingHost()
+        start = time.monotonic()
+        scan = self.service.scan('127.0.0.1', port=port, timeout=1)
+        # The handshake is bounded by the timeout of the scan
+        self.assertRaises(exceptions.ConnectionTimeoutException,
+                          scan.result)
+        self.assertLess(time.monotonic() - start, 3)
+
+    def test_keyscan_shutdown(self):
+        scan = self.service.scan('127.0.0.1', port=self.server.port,
+                                 timeout=10)
+        nodeutils.KeyscanService.shutdown()
+        # The scans in progress are cancelled and the threads are gone
+        self.assertTrue(scan.cancelled())
+        self.assertEqual([], [t for t in threading.enumerate()
+                              if t.name.startswith('Keyscan')])
+        # The next scan starts a new service
+        self.assertIsNot(self.service, nodeutils.KeyscanService.get())
+
+    def test_nodescan(self):
+        self.server.start()
+        self.assertEqual(
+            [self.server.host_key],
+            nodeutils.nodescan('127.0.0.1', port=self.server.port,
+                               timeout=10))
+        self.assertEqual(['ssh-rsa FAKEKEY'], nodeutils.nodescan('fake'))
@@ -11,9 +11,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import fixtures
+import json
+import mock
+import os
 import testtools
 import time
 
+from kazoo import exceptions as kze
+from kazoo.protocol.states import ZnodeStat
+from kazoo.recipe.cache import NodeData, TreeEvent
+
 from nodepool import exceptions as npe
 from nodepool import tests
 from nodepool import zk
@@ -312,6 +320,72 @@ class TestZooKeeper(tests.DBTestCase):
         d = self.zk.getMostRecentImageUpload(image, provider, zk.READY)
         self.assertEqual(upload2.state_time, d.state_time)
 
+    def test_getMostRecentImageUpload_cached(self):
+        image = "ubuntu-trusty"
+        provider = "rax"
+
+        cached_zk = zk.ZooKeeper(enable_cache=False, enable_image_cache=True)
+        host = zk.ZooKeeperConnectionConfig(
+            self.zookeeper_host, self.zookeeper_port, self.zookeeper_chroot
+        )
+        cached_zk.connect([host])
+        self.addCleanup(cached_zk.disconnect)
+
+        build = zk.ImageBuild()
+        build.state = zk.READY
+        bnum = self.zk.storeBuild(image, build)
+        upload1 = zk.ImageUpload()
+        upload1.state = zk.READY
+        upload2 = zk.ImageUpload()
+        upload2.state = zk.READY
+        upload2.state_time = upload1.state_time + 10
+        self.zk.storeImageUpload(image, bnum, provider, upload1)
+        unum2 = self.zk.storeImageUpload(image, bnum, provider, upload2)
+
+        for _ in iterate_timeout(10, Exception, "image cache updated"):
+            d = cached_zk._latest_image_uploads.get((image, provider,
+                                                     zk.READY))
+            if d and d.state_time == upload2.state_time:
+                break
+        self.assertEqual(
+            upload2.state_time,
+            cached_zk.getMostRecentImageUpload(image, provider).state_time)
+
+        self.zk.deleteUpload(image, bnum, provider, unum2)
+        for _ in iterate_timeout(10, Exception, "image cache updated"):
+            d = cached_zk.getMostRecentImageUpload(image, provider)
+            if d.state_time == upload1.state_time:
+                break
+
+    def test_getAllImageUploads(self):
+        # Make sure reads are pipelined in several batches
+        self.zk.bulk_read_depth = 2
+        expected = []
+        for image in ("ubuntu-trusty", "ubuntu-xenial"):
+            build = zk.ImageBuild()
+            build.state = zk.READY
+            bnum = self.zk.storeBuild(image, build)
+            for provider in ("rax", "ovh"):
+                upload = zk.ImageUpload()
+                upload.state = zk.READY
+                upload.external_id = "%s-%s" % (image, provider)
+                unum = self.zk.storeImageUpload(image, bnum, provider, upload)
+                expected.append((image, bnum, provider, unum,
+                                 upload.external_id))
+        # A missing build does not disturb the listing
+        self.zk.client.create(self.zk._imageBuildsPath("empty"),
+                              makepath=True)
+
+        uploads = self.zk.getAllImageUploads()
+        self.assertEqual(
+            sorted(expected),
+            sorted((u.image_name, u.build_id, u.provider_name, u.id,
+                    u.external_id) for u in uploads))
+        self.assertEqual(
+            ["ubuntu-xenial"],
+            list(set(u.image_name for u in
+                     self.zk.getAllImageUploads(["ubuntu-xenial"]))))
+
     def test_getBuilds_any(self):
         image = "ubuntu-trusty"
         path = self.zk._imageBuildsPath(image)
@@ -435,6 +509,40 @@ class TestZooKeeper(tests.DBTestCase):
         self.assertEqual(1, len(launchers))
         self.assertEqual(launcher.id, launchers[0].id)
 
+    def test_registerLauncher_cached(self):
+        cached_zk = self._cached_zk()
+        for _ in iterate_timeout(10, Exception, "launcher cache initialized"):
+            if cached_zk._launcher_cache_initialized:
+                break
+
+        launcher = zk.Launcher()
+        launcher.id = "launcher-000-001"
+        cached_zk.registerLauncher(launcher)
+        self.assertEqual([launcher.id],
+                         [x.id for x in cached_zk.getRegisteredLaunchers()])
+
+        # An unchanged registration is not written again
+        with mock.patch.object(cached_zk.client, 'exists') as exists:
+            cached_zk.registerLauncher(launcher)
+            self.assertFalse(exists.called)
+
+        launcher.supported_labels = set(['label1'])
+        cached_zk.registerLauncher(launcher)
+        launchers = self.zk.getRegisteredLaunchers()
+        self.assertEqual(set(['label1']), launchers[0].supported_labels)
+        # The changed registration is remembered as written
+        with mock.patch.object(cached_zk.client, 'exists') as exists:
+            cached_zk.registerLauncher(launcher)
+            self.assertFalse(exists.called)
+
+        # A vanished registration is noticed and written again
+        self.zk.client.delete(self.zk._launcherPath(launcher.id))
+        for _ in iterate_timeout(10, Exception, "launcher removed"):
+            if not cached_zk.getRegisteredLaunchers():
+                break
+        cached_zk.registerLauncher(launcher)
+        self.assertEqual(1, len(self.zk.getRegisteredLaunchers()))
+
     def test_getNodeRequests_empty(self):
         self.assertEqual([], self.zk.getNodeRequests())
 
@@ -533,6 +641,76 @@ class TestZooKeeper(tests.DBTestCase):
         node2 = self.zk.getNode(node.id)
         self.assertEqual(node, node2)
 
+    def test_storeNode_check_version(self):
+        node = self._create_node()
+        stale = self.zk.getNode(node.id)
+        node.state = zk.READY
+        self.zk.storeNode(node, check_version=True)
+        self.assertEqual(stale.stat.version + 1, node.stat.version)
+
+        stale.state = zk.USED
+        with testtools.ExpectedException(npe.ZKVersionException):
+            self.zk.storeNode(stale, check_version=True)
+        self.assertEqual(zk.READY, self.zk.getNode(node.id).state)
+
+    def test_modifyNode(self):
+        node = self._create_node()
+        stale = self.zk.getNode(node.id)
+        node.state = zk.READY
+        self.zk.storeNode(node)
+
+        def modify(n):
+            if n.state != zk.READY:
+                return False
+            n.state = zk.DELETING
+            return True
+
+        # The stale copy conflicts, so the node is read again
+        stored = self.zk.modifyNode(stale, modify)
+        self.assertEqual(zk.DELETING, stored.state)
+        self.assertEqual(zk.BUILDING, stale.state)
+        self.assertEqual(zk.DELETING, self.zk.getNode(node.id).state)
+
+        # The modification is declined for the current state
+        self.assertIsNone(self.zk.modifyNode(node, modify))
+
+    def test_operation_stats(self):
+        node = self._create_node()
+        self.zk.getNode(node.id)
+        self.zk.lockNode(node)
+        self.zk.unlockNode(node)
+
+        methods = self.zk.stats.getStats()['methods']
+        self.assertEqual(1, methods['storeNode']['calls'])
+        self.assertEqual(1, methods['storeNode']['ops'])
+        self.assertEqual(len(node.serialize()),
+                         methods['storeNode']['bytes_written'])
+        self.assertEqual(1, methods['getNode']['ops'])
+        self.assertEqual(len(node.serialize()),
+                         methods['getNode']['bytes_read'])
+        # Reading the node after locking it is accounted to lockNode
+        self.assertNotIn('updateNode', methods)
+        self.assertGreater(methods['lockNode']['ops'], 1)
+        self.assertEqual(1, methods['lockNode']['latency']['count'])
+
+    def test_storeNode_buckets(self):
+        flat = self._create_node()
+        self.zk.setNodeBuckets(4)
+        bucketed = [self._create_node() for x in range(5)]
+        self.assertEqual(['00', '01', '02', '03', '00'],
+                         [n.id[:2] for n in bucketed])
+        for node in bucketed:
+            self.assertEqual(12, len(node.id))
+            self.assertIsNotNone(self.zk.client.exists(
+                '%s/b%s/%s' % (self.zk.NODE_ROOT, node.id[:2], node.id)))
+            self.assertEqual(node, self.zk.getNode(node.id))
+
+        self.assertEqual(sorted([flat.id] + [n.id for n in bucketed]),
+                         sorted(self.zk.getNodes()))
+        self.zk.lockNode(bucketed[0])
+        self.assertTrue(self.zk.isNodeLocked(bucketed[0], cached=False))
+        self.zk.unlockNode(bucketed[0])
+
     def _create_node_request(self):
         req = zk.NodeRequest()
         req.state = zk.REQUESTED
@@ -556,6 +734,17 @@ class TestZooKeeper(tests.DBTestCase):
         req2 = self.zk.getNodeRequest(req.id)
         self.assertEqual(req, req2)
 
+    def test_storeNodeRequest_check_version(self):
+        req = self._create_node_request()
+        stale = self.zk.getNodeRequest(req.id)
+        req.state = zk.PENDING
+        self.zk.storeNodeRequest(req, check_version=True)
+
+        stale.state = zk.FAILED
+        with testtools.ExpectedException(npe.ZKVersionException):
+            self.zk.storeNodeRequest(stale, check_version=True)
+        self.assertEqual(zk.PENDING, self.zk.getNodeRequest(req.id).state)
+
     def test_deleteNodeRequest(self):
         req = self._create_node_request()
         self.zk.deleteNodeRequest(req)
@@ -570,6 +759,73 @@ class TestZooKeeper(tests.DBTestCase):
             self.zk.client.exists(self.zk._nodePath(n1.id))
         )
 
+    def test_deleteNode_locked(self):
+        n1 = self._create_node()
+        self.zk.lockNode(n1)
+        self.zk.deleteNode(n1)
+        self.assertEqual(zk.DELETED, n1.state)
+        self.assertIsNone(
+            self.zk.client.exists(self.zk._nodePath(n1.id))
+        )
+
+    def test_transaction_lockNewNode(self):
+        n1 = self._create_node()
+        n1.state = zk.READY
+        txn = self.zk.transaction()
+        txn.lockNewNode(n1)
+        txn.storeNode(n1)
+        txn.commit()
+        self.assertIsNotNone(n1.lock)
+        self.assertEqual(zk.READY, self.zk.getNode(n1.id).state)
+
+        n2 = self.zk.getNode(n1.id)
+        with testtools.ExpectedException(npe.ZKLockException):
+            self.zk.lockNode(n2, blocking=False)
+        self.zk.unlockNode(n1)
+        self.assertIsNone(n1.lock)
+        self.zk.lockNode(n2, blocking=False)
+        self.zk.unlockNode(n2)
+
+    def test_transaction_failure(self):
+        n1 = self._create_node()
+        # Creates the lock directory
+        self.zk.lockNode(n1)
+        self.zk.unlockNode(n1)
+
+        n1.state = zk.READY
+        txn = self.zk.transaction()
+        txn.storeNode(n1)
+        txn.lockNewNode(n1)
+        with testtools.ExpectedException(npe.ZKTransactionException):
+            txn.commit()
+        self.assertIsNone(n1.lock)
+        self.assertEqual(zk.BUILDING, self.zk.getNode(n1.id).state)
+
+    def test_transaction_complete_request(self):
+        req = self._create_node_request()
+        self.zk.lockNodeRequest(req)
+        n1 = self._create_node()
+        self.zk.lockNode(n1)
+
+        req.state = zk.FULFILLED
+        req.nodes.append(n1.id)
+        txn = self.zk.transaction()
+        txn.unlockNode(n1)
+        txn.storeNodeRequest(req)
+        txn.unlockNodeRequest(req)
+        txn.commit()
+        self.assertIsNone(n1.lock)
+        self.assertIsNone(req.lock)
+
+        req2 = self.zk.getNodeRequest(req.id)
+        self.assertEqual(zk.FULFILLED, req2.state)
+        self.assertEqual([n1.id], req2.nodes)
+        self.zk.lockNodeRequest(req2, blocking=False)
+        self.zk.unlockNodeRequest(req2)
+        n2 = self.zk.getNode(n1.id)
+        self.zk.lockNode(n2, blocking=False)
+        self.zk.unlockNode(n2)
+
     def test_getReadyNodesOfTypes(self):
         n1 = self._create_node()
         n1.type = 'label1'
@@ -691,7 +947,7 @@ class TestZooKeeper(tests.DBTestCase):
 
         # Test modification of existing node set
         n1.state = zk.HOLD
-        n1.label = "oompaloompa"
+        n1.type = "oompaloompa"
         self.zk.storeNode(n1)
 
         # uncached
@@ -705,6 +961,101 @@ class TestZooKeeper(tests.DBTestCase):
             if n1 == next(b2):
                 break
 
+    def _cached_zk(self):
+        cached_zk = zk.ZooKeeper(enable_cache=True)
+        host = zk.ZooKeeperConnectionConfig(
+            self.zookeeper_host, self.zookeeper_port, self.zookeeper_chroot
+        )
+        cached_zk.connect([host])
+        self.addCleanup(cached_zk.disconnect)
+        return cached_zk
+
+    def test_cached_ids_iteration(self):
+        n1 = self._create_node()
+        n2 = self._create_node()
+        r1 = self._create_node_request()
+
+        cached_zk = self._cached_zk()
+        for _ in iterate_timeout(10, Exception, "node cache initialized"):
+            if (cached_zk._node_cache_initialized and
+                    cached_zk._request_cache_initialized):
+                break
+
+        self.assertEqual(sorted([n1.id, n2.id]),
+                         cached_zk.getNodes(cached=True))
+        self.assertEqual([n1.id, n2.id],
+                         [n.id for n in cached_zk.nodeIterator(
+                             cached_ids=True)])
+        self.assertEqual([r1.id], cached_zk.getNodeRequests(cached=True))
+        self.assertEqual([r1.id],
+                         [r.id for r in cached_zk.nodeRequestIterator(
+                             cached_ids=True)])
+
+        self.zk.deleteNode(n1)
+        for _ in iterate_timeout(10, Exception, "node removed from cache"):
+            if cached_zk.getNodes(cached=True) == [n2.id]:
+                break
+        self.assertEqual(0, cached_zk.node_cache_fallbacks)
+        self.assertEqual(0, cached_zk.request_cache_fallbacks)
+
+    def test_cached_ids_fallback(self):
+        n1 = self._create_node()
+        cached_zk = self._cached_zk()
+        # Pretend the cache has not finished its initial sync yet
+        cached_zk._node_cache_initialized = False
+        self.assertEqual([n1.id], cached_zk.getNodes(cached=True))
+        self.assertEqual(1, cached_zk.node_cache_fallbacks)
+        self.assertEqual([n1.id], cached_zk.getNodes())
+        self.assertEqual(1, cached_zk.node_cache_fallbacks)
+
+    def test_cache_snapshot(self):
+        n1 = self._create_node()
+        n2 = self._create_node()
+        req = self._create_node_request()
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            'snapshot.json')
+
+        cached_zk = self._cached_zk()
+        self.assertTrue(cached_zk.waitForCacheInitialization(10))
+        self.assertTrue(cached_zk.saveCacheSnapshot(path))
+        self.zk.deleteNode(n2)
+        n1.state = zk.READY
+        self.zk.storeNode(n1)
+
+        warm_zk = zk.ZooKeeper(enable_cache=True)
+        self.assertTrue(warm_zk.loadCacheSnapshot(path))
+        self.assertEqual(req, warm_zk.getNodeRequest(req.id, cached=True))
+        host = zk.ZooKeeperConnectionConfig(
+            self.zookeeper_host, self.zookeeper_port, self.zookeeper_chroot
+        )
+        warm_zk.connect([host])
+        self.addCleanup(warm_zk.disconnect)
+        self.assertTrue(warm_zk.waitForCacheInitialization(10))
+        self.assertEqual(zk.READY, warm_zk.getNode(n1.id, cached=True).state)
+        self.assertIsNone(warm_zk._cached_nodes.get(n2.id))
+        self.assertEqual(req, warm_zk.getNodeRequest(req.id, cached=True))
+
+    def test_isNodeLocked(self):
+        n1 = self._create_node()
+        n2 = self._create_node()
+        cached_zk = self._cached_zk()
+        self.assertFalse(self.zk.isNodeLocked(n1))
+
+        self.zk.lockNode(n1)
+        self.assertTrue(self.zk.isNodeLocked(n1))
+        self.assertEqual({n1.id: True, n2.id: False},
+                         self.zk.getNodeLockStates([n1.id, n2.id]))
+        for _ in iterate_timeout(10, Exception, "cached lock state"):
+            if cached_zk.isNodeLocked(n1):
+                break
+        self.assertFalse(cached_zk.isNodeLocked(n2))
+
+        self.zk.unlockNode(n1)
+        self.assertFalse(self.zk.isNodeLocked(n1))
+        for _ in iterate_timeout(10, Exception, "cached lock state"):
+            if not cached_zk.isNodeLocked(n1):
+                break
+
 
 class TestZKModel(tests.BaseTestCase):
 
@@ -950,3 +1301,931 @@ class TestZKModel(tests.BaseTestCase):
         d = n.toDict()
         self.assertEqual(d["connection_port"], 22022,
                          "Custom ssh port not set")
+
+    def test_Node_interned(self):
+        d = {'provider': ''.join(['provider', '1']),
+             'type': [''.join(['label', '1'])]}
+        n1 = zk.Node.fromDict(json.loads(json.dumps(d)), '0000000001')
+        n2 = zk.Node.fromDict(json.loads(json.dumps(d)), '0000000002')
+        self.assertIs(n1.provider, n2.provider)
+        self.assertIs(n1.type[0], n2.type[0])
+
+    def test_models_have_slots(self):
+        for obj in (zk.Node(), zk.NodeRequest(), zk.ImageBuild(),
+                    zk.ImageUpload()):
+            self.assertFalse(hasattr(obj, '__dict__'))
+            with testtools.ExpectedException(AttributeError):
+                obj.not_an_attribute = True
+
+
+class TestZKNodeCache(tests.BaseTestCase):
+    '''
+    Test the node cache maintenance by feeding it TreeCache events.
+    '''
+
+    def setUp(self):
+        super(TestZKNodeCache, self).setUp()
+        self.zk = zk.ZooKeeper()
+        self.zk.verify_node_index = True
+
+    def _event(self, event_type, node, version=0):
+        path = self.zk._nodePath(node.id)
+        stat = ZnodeStat(0, 0, 0, 0, version, 0, 0, 0, 0, 0, 0)
+        data = node.serialize() if event_type != TreeEvent.NODE_REMOVED \
+            else None
+        self.zk._nodeCacheListener(
+            TreeEvent.make(event_type, NodeData.make(path, data, stat)))
+
+    def _node(self, node_id, state=zk.READY, label='label1',
+              provider='provider1', pool='pool1'):
+        node = zk.Node(node_id)
+        node.state = state
+        node.type = label
+        node.provider = provider
+        node.pool = pool
+        return node
+
+    def _initialize(self, *nodes):
+        for node in nodes:
+            self._event(TreeEvent.NODE_ADDED, node)
+        self.zk._nodeCacheListener(TreeEvent.make(TreeEvent.INITIALIZED, None))
+
+    def _lockEvent(self, event_type, node_id, contender):
+        path = '%s/lock/%s' % (self.zk._nodePath(node_id), contender)
+        stat = ZnodeStat(0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+        self.zk._nodeCacheListener(
+            TreeEvent.make(event_type, NodeData.make(path, b'', stat)))
+
+    def test_lock_tracking(self):
+        n1 = self._node('0000000001')
+        self._initialize(n1)
+        # The lock directory itself does not lock the node
+        self.zk._nodeCacheListener(TreeEvent.make(
+            TreeEvent.NODE_ADDED, NodeData.make(
+                self.zk._nodeLockPath(n1.id), b'',
+                ZnodeStat(0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0))))
+        self.assertFalse(self.zk.isNodeLocked(n1))
+
+        self._lockEvent(TreeEvent.NODE_ADDED, n1.id, 'a__lock__0000000000')
+        self._lockEvent(TreeEvent.NODE_ADDED, n1.id, 'b__lock__0000000001')
+        self.assertTrue(self.zk.isNodeLocked(n1))
+        self._lockEvent(TreeEvent.NODE_REMOVED, n1.id, 'a__lock__0000000000')
+        self.assertTrue(self.zk.isNodeLocked(n1))
+        self._lockEvent(TreeEvent.NODE_REMOVED, n1.id, 'b__lock__0000000001')
+        self.assertFalse(self.zk.isNodeLocked(n1))
+
+        # Lock events do not touch the node data
+        self.assertEqual(n1, self.zk._cached_nodes[n1.id])
+
+    def test_node_buckets(self):
+        n1 = self._node('0000000001')
+        n2 = self._node('070000000002')
+        self._initialize(n1, n2)
+        # Bucket directories are no nodes
+        self.zk._nodeCacheListener(TreeEvent.make(
+            TreeEvent.NODE_ADDED, NodeData.make(
+                '%s/b07' % self.zk.NODE_ROOT, b'',
+                ZnodeStat(0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0))))
+        self.assertEqual({n1.id, n2.id}, set(self.zk._cached_nodes))
+        self.assertEqual(n2, self.zk._cached_nodes[n2.id])
+
+        self._lockEvent(TreeEvent.NODE_ADDED, n2.id, 'b__lock__0000000000')
+        self.assertTrue(self.zk.isNodeLocked(n2))
+        self.assertFalse(self.zk.isNodeLocked(n1))
+        self._lockEvent(TreeEvent.NODE_REMOVED, n2.id, 'b__lock__0000000000')
+        self.assertFalse(self.zk.isNodeLocked(n2))
+
+        self._event(TreeEvent.NODE_REMOVED, n2)
+        self.assertEqual({n1.id}, set(self.zk._cached_nodes))
+
+    def test_wake_listener(self):
+        woken = []
+        self.zk.addWakeListener(lambda node: woken.append(node.id))
+        n1 = self._node('0000000001', state=zk.BUILDING)
+        self._initialize(n1)
+        self.assertEqual([n1.id], woken)
+
+        self._lockEvent(TreeEvent.NODE_ADDED, n1.id, 'a__lock__0000000000')
+        n1.state = zk.READY
+        self._event(TreeEvent.NODE_UPDATED, n1, version=1)
+        self.assertEqual([n1.id] * 2, woken)
+        # Only the release of the last lock contender is of interest
+        self._lockEvent(TreeEvent.NODE_ADDED, n1.id, 'b__lock__0000000001')
+        self._lockEvent(TreeEvent.NODE_REMOVED, n1.id, 'a__lock__0000000000')
+        self.assertEqual(2, len(woken))
+        self._lockEvent(TreeEvent.NODE_REMOVED, n1.id, 'b__lock__0000000001')
+        self.assertEqual(3, len(woken))
+
+        self._event(TreeEvent.NODE_REMOVED, n1)
+        self.assertEqual([n1.id] * 4, woken)
+
+    def test_lock_tracking_node_removed(self):
+        n1 = self._node('0000000001')
+        self._initialize(n1)
+        self._lockEvent(TreeEvent.NODE_ADDED, n1.id, 'a__lock__0000000000')
+        self._event(TreeEvent.NODE_REMOVED, n1)
+        self.assertEqual({}, self.zk._node_lock_contenders)
+
+    def _countDecodes(self):
+        decode = mock.Mock(side_effect=self.zk._bytesToDict)
+        self.zk._bytesToDict = decode
+        return decode
+
+    def test_lazy_decode(self):
+        n1 = self._node('0000000001')
+        self._initialize(n1)
+        decode = self._countDecodes()
+
+        n1.state = zk.USED
+        self._event(TreeEvent.NODE_UPDATED, n1, version=1)
+        n1.state = zk.DELETING
+        self._event(TreeEvent.NODE_UPDATED, n1, version=2)
+        self.assertEqual(0, decode.call_count)
+
+        # Only the latest data is decoded, once
+        node = self.zk.getNode(n1.id, cached=True)
+        self.assertEqual(zk.DELETING, node.state)
+        self.assertEqual(2, node.stat.version)
+        self.zk.getNode(n1.id, cached=True)
+        self.assertEqual(1, decode.call_count)
+
+    def test_lazy_decode_index(self):
+        n1 = self._node('0000000001')
+        self._initialize(n1)
+        self.assertEqual(1, self.zk.countPoolNodes('provider1', 'pool1'))
+
+        n1.state = zk.BUILDING
+        self._event(TreeEvent.NODE_UPDATED, n1, version=1)
+        self.assertEqual({}, self.zk.getReadyNodesOfTypes(['label1']))
+
+    def test_lazy_decode_identical(self):
+        n1 = self._node('0000000001')
+        self._initialize(n1)
+        decode = self._countDecodes()
+
+        self._event(TreeEvent.NODE_UPDATED, n1, version=1)
+        node = self.zk.getNode(n1.id, cached=True)
+        self.assertEqual(1, node.stat.version)
+        self.assertEqual(0, decode.call_count)
+
+        # Data changed in-place is not assumed to match the last decode
+        node.state = zk.USED
+        self.zk._reindexNode(node)
+        self._event(TreeEvent.NODE_UPDATED, n1, version=2)
+        self.assertEqual(zk.READY,
+                         self.zk.getNode(n1.id, cached=True).state)
+        self.assertEqual(1, decode.call_count)
+
+    def test_lazy_decode_old_version(self):
+        n1 = self._node('0000000001')
+        self._initialize(n1)
+        n1.state = zk.USED
+        self._event(TreeEvent.NODE_UPDATED, n1, version=2)
+        n1.state = zk.HOLD
+        self._event(TreeEvent.NODE_UPDATED, n1, version=1)
+        node = self.zk.getNode(n1.id, cached=True)
+        self.assertEqual(zk.USED, node.state)
+        self.assertEqual(2, node.stat.version)
+
+    def test_lazy_decode_locked(self):
+        n1 = self._node('0000000001')
+        self._initialize(n1)
+        n1.state = zk.USED
+        self._event(TreeEvent.NODE_UPDATED, n1, version=1)
+
+        # The pending data is not applied to a node locked meanwhile
+        node = self.zk._cached_nodes[n1.id]
+        node.lock = mock.Mock()
+        self.assertEqual(zk.READY,
+                         self.zk.getNode(n1.id, cached=True).state)
+        n1.state = zk.HOLD
+        self._event(TreeEvent.NODE_UPDATED, n1, version=2)
+        self.assertEqual(zk.READY,
+                         self.zk.getNode(n1.id, cached=True).state)
+
+    def test_index_not_used_before_initialized(self):
+        self._event(TreeEvent.NODE_ADDED, self._node('0000000001'))
+        self.assertFalse(self.zk._useNodeIndex())
+        self.zk._nodeCacheListener(TreeEvent.make(TreeEvent.INITIALIZED, None))
+        self.assertTrue(self.zk._useNodeIndex())
+        self.assertFalse(self.zk._useNodeIndex(cached=False))
+
+    def test_getReadyNodesOfTypes(self):
+        n1 = self._node('0000000001')
+        n2 = self._node('0000000002', label=['label1', 'label2'])
+        n3 = self._node('0000000003', state=zk.BUILDING)
+        n4 = self._node('0000000004')
+        n4.allocated_to = 'req1'
+        self._initialize(n1, n2, n3, n4)
+
+        r = self.zk.getReadyNodesOfTypes(['label1', 'label2', 'label3'])
+        self.assertEqual(['0000000001', '0000000002'],
+                         [n.id for n in r['label1']])
+        self.assertEqual(['0000000002'], [n.id for n in r['label2']])
+        self.assertNotIn('label3', r)
+        self.assertEqual(0, self.zk.node_index_mismatches)
+
+    def test_index_update_and_remove(self):
+        n1 = self._node('0000000001')
+        n2 = self._node('0000000002')
+        self._initialize(n1, n2)
+
+        n1.state = zk.IN_USE
+        self._event(TreeEvent.NODE_UPDATED, n1, version=1)
+        self._event(TreeEvent.NODE_REMOVED, n2)
+
+        self.assertEqual({}, self.zk.getReadyNodesOfTypes(['label1']))
+        cached = self.zk._cached_nodes['0000000001']
+        self.assertEqual(
+            ['0000000001'],
+            [n.id for n in self.zk._getIndexedNodes(
+                lambda n: True, ('state', zk.IN_USE))])
+        self.assertEqual(set(['0000000001']),
+                         self.zk._node_index.get('pool',
+                                                 ('provider1', 'pool1')))
+        self.assertEqual(zk.IN_USE, cached.state)
+        self.assertEqual(1, len(self.zk._node_index))
+        self.assertEqual(0, self.zk.node_index_mismatches)
+
+    def test_index_locked_node_modified_in_place(self):
+        n1 = self._node('0000000001')
+        self._initialize(n1)
+
+        # The lock holder modifies the cached node in-place; the
+        # listener won't update it but has to reindex it.
+        cached = self.zk._cached_nodes['0000000001']
+        cached.lock = True
+        cached.state = zk.DELETING
+        n1.state = zk.DELETING
+        self._event(TreeEvent.NODE_UPDATED, n1, version=1)
+
+        self.assertEqual(set(['0000000001']),
+                         self.zk._node_index.get('state', zk.DELETING))
+        self.assertEqual({}, self.zk.getReadyNodesOfTypes(['label1']))
+        self.assertEqual(0, self.zk.node_index_mismatches)
+
+    def test_getProviderNodes(self):
+        self._initialize(
+            self._node('0000000001'),
+            self._node('0000000002', pool='pool2'),
+            self._node('0000000003', provider='provider2'))
+
+        self.assertEqual(
+            ['0000000001', '0000000002'],
+            sorted(n.id for n in self.zk.getProviderNodes('provider1')))
+        self.assertEqual(
+            ['0000000002'],
+            [n.id for n in self.zk.getProviderNodes('provider1', 'pool2')])
+        self.assertEqual(1, self.zk.countPoolNodes('provider2', 'pool1'))
+        self.assertEqual(0, self.zk.countPoolNodes('provider2', 'pool2'))
+        self.assertEqual(0, self.zk.node_index_mismatches)
+
+    def test_index_mismatch(self):
+        self._initialize(self._node('0000000001'))
+        self.zk._node_index.remove('0000000001')
+
+        # The self-check detects the stale index, but the result is still
+        # the one of the index.
+        r = self.zk.getReadyNodesOfTypes(['label1'])
+        self.assertEqual([], r.get('label1', []))
+        self.assertEqual(1, self.zk.node_index_mismatches)
+
+
+class TestZKRequestQueue(tests.BaseTestCase):
+    '''
+    Test the node request queue by feeding TreeCache events to the
+    request cache.
+    '''
+
+    def setUp(self):
+        super(TestZKRequestQueue, self).setUp()
+        self.zk = zk.ZooKeeper()
+        self.zk._requestCacheListener(
+            TreeEvent.make(TreeEvent.INITIALIZED, None))
+
+    def _event(self, event_type, req, version=0):
+        path = self.zk._requestPath(req.id)
+        stat = ZnodeStat(0, 0, 0, 0, version, 0, 0, 0, 0, 0, 0)
+        data = req.serialize() if event_type != TreeEvent.NODE_REMOVED \
+            else None
+        self.zk._requestCacheListener(
+            TreeEvent.make(event_type, NodeData.make(path, data, stat)))
+
+    def _request(self, request_id, state=zk.REQUESTED, relative_priority=0):
+        req = zk.NodeRequest(request_id)
+        req.state = state
+        req.relative_priority = relative_priority
+        self._event(TreeEvent.NODE_ADDED, req)
+        return req
+
+    def _queue(self):
+        return [r.id for r in self.zk.nodeRequestQueueIterator()]
+
+    def test_wake_listener(self):
+        woken = []
+        self.zk.addWakeListener(woken.append)
+        r1 = self._request("100-0000000001")
+        self._request("100-0000000002", state=zk.PENDING)
+        self.assertEqual([r1.id], [r.id for r in woken])
+
+        r1.declined_by.append('launcher1')
+        self._event(TreeEvent.NODE_UPDATED, r1, version=1)
+        self.assertEqual(['launcher1'], woken[-1].declined_by)
+        r1.state = zk.PENDING
+        self._event(TreeEvent.NODE_UPDATED, r1, version=2)
+        self.assertEqual(2, len(woken))
+
+        self.zk.removeWakeListener(woken.append)
+        self._request("100-0000000003")
+        self.assertEqual(2, len(woken))
+
+    def test_queue_order(self):
+        self._request("200-0000000001")
+        self._request("100-0000000004", relative_priority=1)
+        self._request("100-0000000003")
+        self._request("100-0000000002", relative_priority=1)
+        self._request("100-0000000005", state=zk.PENDING)
+        self.assertEqual(["100-0000000003", "100-0000000002",
+                          "100-0000000004", "200-0000000001"],
+                         self._queue())
+
+    def test_queue_state_change(self):
+        r1 = self._request("100-0000000001")
+        r2 = self._request("100-0000000002")
+        r3 = self._request("100-0000000003")
+
+        r1.state = zk.PENDING
+        self._event(TreeEvent.NODE_UPDATED, r1, version=1)
+        r3.relative_priority = -1
+        self._event(TreeEvent.NODE_UPDATED, r3, version=1)
+        self.assertEqual(["100-0000000003", "100-0000000002"], self._queue())
+
+        # Data older than what we know is ignored
+        r3.state = zk.FAILED
+        self._event(TreeEvent.NODE_UPDATED, r3, version=0)
+        self.assertEqual(["100-0000000003", "100-0000000002"], self._queue())
+
+        self._event(TreeEvent.NODE_REMOVED, r2)
+        self.assertEqual(["100-0000000003"], self._queue())
+        self.assertEqual(1, len(self.zk._request_queue))
+
+    def test_queue_modified_while_iterating(self):
+        self._request("100-0000000001")
+        r2 = self._request("100-0000000002")
+        self._request("100-0000000003")
+
+        i = self.zk.nodeRequestQueueIterator()
+        self.assertEqual("100-0000000001", next(i).id)
+        r2.state = zk.PENDING
+        self._event(TreeEvent.NODE_UPDATED, r2, version=1)
+        self._request("100-0000000004")
+        self.assertEqual(["100-0000000003", "100-0000000004"],
+                         [r.id for r in i])
+
+
+class TestZKImageCache(tests.BaseTestCase):
+    '''
+    Test the image upload cache by feeding it TreeCache events.
+    '''
+
+    def setUp(self):
+        super(TestZKImageCache, self).setUp()
+        self.zk = zk.ZooKeeper(enable_image_cache=True)
+        self.zk._imageCacheListener(
+            TreeEvent.make(TreeEvent.INITIALIZED, None))
+
+    def _event(self, event_type, path, data=None):
+        stat = ZnodeStat(0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+        self.zk._imageCacheListener(
+            TreeEvent.make(event_type, NodeData.make(path, data, stat)))
+
+    def _upload(self, build_number, upload_number, state=zk.READY,
+                state_time=None, event_type=TreeEvent.NODE_ADDED):
+        upload = zk.ImageUpload(build_number, 'provider1', 'image1',
+                                upload_number)
+        upload.state = state
+        if state_time is not None:
+            upload.state_time = state_time
+        upload.external_id = 'external-%s' % build_number
+        path = "%s/%s" % (self.zk._imageUploadPath(
+            'image1', build_number, 'provider1'), upload_number)
+        self._event(event_type, path, upload.serialize())
+        return path
+
+    def test_most_recent_upload(self):
+        self._upload('0000000001', '0000000001', state_time=1)
+        path = self._upload('0000000002', '0000000001', state_time=2)
+        self._upload('0000000003', '0000000001', state=zk.UPLOADING,
+                     state_time=3)
+        # Lock nodes are not uploads
+        self._event(TreeEvent.NODE_ADDED, "%s/lock" % self.zk._imageUploadPath(
+            'image1', '0000000001', 'provider1'))
+
+        upload = self.zk.getMostRecentImageUpload('image1', 'provider1')
+        self.assertEqual('0000000002', upload.build_id)
+        self.assertEqual('external-0000000002', upload.external_id)
+        upload = self.zk.getMostRecentImageUpload('image1', 'provider1',
+                                                  zk.UPLOADING)
+        self.assertEqual('0000000003', upload.build_id)
+
+        # The most recent upload goes away
+        self._event(TreeEvent.NODE_REMOVED, path)
+        upload = self.zk.getMostRecentImageUpload('image1', 'provider1')
+        self.assertEqual('0000000001', upload.build_id)
+
+    def test_upload_state_change(self):
+        self._upload('0000000001', '0000000001', state_time=1)
+        self._upload('0000000002', '0000000001', state_time=2)
+        self._upload('0000000002', '0000000001', state=zk.DELETING,
+                     state_time=4, event_type=TreeEvent.NODE_UPDATED)
+
+        upload = self.zk.getMostRecentImageUpload('image1', 'provider1')
+        self.assertEqual('0000000001', upload.build_id)
+        upload = self.zk.getMostRecentImageUpload('image1', 'provider1',
+                                                  zk.DELETING)
+        self.assertEqual('0000000002', upload.build_id)
+        self.assertEqual(2, len(self.zk._cached_image_uploads))
+
+
+class TestZKBulkRead(tests.BaseTestCase):
+
+    class FakeAsyncResult(object):
+        def __init__(self, reader, path):
+            self.reader = reader
+            self.path = path
+            reader.outstanding += 1
+            reader.max_outstanding = max(reader.max_outstanding,
+                                         reader.outstanding)
+
+        def get(self):
+            self.reader.outstanding -= 1
+            if self.path == 'missing':
+                raise kze.NoNodeError()
+            return self.path.upper()
+
+    def setUp(self):
+        super(TestZKBulkRead, self).setUp()
+        self.zk = zk.ZooKeeper()
+        self.zk.bulk_read_depth = 3
+        self.outstanding = 0
+        self.max_outstanding = 0
+
+    def _read(self, path):
+        return self.FakeAsyncResult(self, path)
+
+    def test_bulkRead(self):
+        paths = ['a', 'b', 'missing', 'c', 'd', 'e', 'f']
+        self.assertEqual(['A', 'B', None, 'C', 'D', 'E', 'F'],
+                         self.zk._bulkRead(self._read, paths))
+        self.assertEqual(3, self.max_outstanding)
+        self.assertEqual(0, self.outstanding)
+
+
+class TestZKEncoding(tests.BaseTestCase):
+    '''
+    Test the encodings of nodes and node requests.
+    '''
+
+    def setUp(self):
+        super(TestZKEncoding, self).setUp()
+        self.zk = zk.ZooKeeper()
+        self.zk.setEncoding('compact')
+
+    def _node(self):
+        node = zk.Node('0000000001')
+        node.state = zk.READY
+        node.provider = 'provider1'
+        node.pool = 'pool1'
+        node.type = ['label1']
+        node.connection_port = 2222
+        node.host_keys = ['ssh-rsa AAAA']
+        return node
+
+    def test_node_round_trip(self):
+        node = self._node()
+        for name, encoding in zk.ENCODINGS.items():
+            data = encoding.encode(node)
+            d = zk.Node.fromDict(self.zk._bytesToDict(data), node.id)
+            self.assertEqual(node, d, name)
+            self.assertEqual(2222, d.connection_port)
+
+    def test_request_round_trip(self):
+        req = zk.NodeRequest('100-0000000001')
+        req.state = zk.REQUESTED
+        req.node_types = ['label1', 'label2']
+        req.requestor = 'test'
+        for name, encoding in zk.ENCODINGS.items():
+            data = encoding.encode(req)
+            d = zk.NodeRequest.fromDict(self.zk._bytesToDict(data), req.id)
+            self.assertEqual(req, d, name)
+
+    def test_compact_is_smaller(self):
+        node = self._node()
+        data = zk.ENCODINGS['compact'].encode(node)
+        self.assertTrue(data.startswith(zk.CompactEncoding.HEADER))
+        self.assertLess(len(data), len(node.serialize()))
+        self.assertNotIn(b'ssh_port', data)
+
+    def test_legacy_json(self):
+        node = self._node()
+        d = zk.Node.fromDict(self.zk._bytesToDict(node.serialize()), node.id)
+        self.assertEqual(node, d)
+
+    def test_unknown_version(self):
+        data = zk.CompactEncoding.MAGIC + bytes([99]) + b'{}'
+        self.assertRaises(npe.ZKException, self.zk._bytesToDict, data)
+
+    def test_other_objects_use_json(self):
+        launcher = zk.Launcher()
+        launcher.id = 'launcher1'
+        self.assertEqual(launcher.serialize(),
+                         zk.ENCODINGS['compact'].encode(launcher))
+
+    def test_node_cache_listener(self):
+        node = self._node()
+        stat = ZnodeStat(0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+        self.zk._nodeCacheListener(TreeEvent.make(
+            TreeEvent.NODE_ADDED,
+            NodeData.make(self.zk._nodePath(node.id),
+                          self.zk.encoding.encode(node), stat)))
+        self.assertEqual(node, self.zk._cached_nodes[node.id])
+
+
+class TestZKVersionedStore(tests.BaseTestCase):
+    '''
+    Test version-checked stores against a mocked ZooKeeper client.
+    '''
+
+    def setUp(self):
+        super(TestZKVersionedStore, self).setUp()
+        self.zk = zk.ZooKeeper(enable_cache=False)
+        self.zk.client = mock.Mock()
+
+    def _stat(self, version):
+        return ZnodeStat(0, 0, 0, 0, version, 0, 0, 0, 0, 0, 0)
+
+    def _node(self, version):
+        node = zk.Node('0000000001')
+        node.state = zk.READY
+        node.stat = self._stat(version)
+        return node
+
+    def test_storeNode(self):
+        node = self._node(3)
+        self.zk.client.set.return_value = self._stat(4)
+        self.zk.storeNode(node)
+        self.assertEqual(-1, self.zk.client.set.call_args[1]['version'])
+        self.zk.storeNode(node, check_version=True)
+        self.assertEqual(4, self.zk.client.set.call_args[1]['version'])
+        self.assertEqual(4, node.stat.version)
+
+    def test_storeNode_conflict(self):
+        self.zk.client.set.side_effect = kze.BadVersionError()
+        self.assertRaises(npe.ZKVersionException, self.zk.storeNode,
+                          self._node(3), check_version=True)
+
+    def test_modifyNode_retry(self):
+        node = self._node(3)
+        fresh = self._node(5)
+        fresh.state = zk.USED
+        self.zk.getNode = mock.Mock(return_value=fresh)
+        self.zk.client.set.side_effect = [kze.BadVersionError(),
+                                          self._stat(6)]
+        seen = []
+
+        def modify(n):
+            seen.append(n.state)
+            n.allocated_to = None
+            return True
+
+        stored = self.zk.modifyNode(node, modify)
+        self.assertEqual([zk.READY, zk.USED], seen)
+        self.assertEqual(6, stored.stat.version)
+        self.assertEqual(
+            [3, 5],
+            [c[1]['version'] for c in self.zk.client.set.call_args_list])
+
+    def test_modifyNode_declined(self):
+        self.assertIsNone(self.zk.modifyNode(self._node(3),
+                                             lambda n: False))
+        self.zk.client.set.assert_not_called()
+
+    def test_modifyNode_gone(self):
+        self.zk.client.set.side_effect = kze.NoNodeError()
+        self.assertIsNone(self.zk.modifyNode(self._node(3),
+                                             lambda n: True))
+
+    def test_modifyNode_attempts(self):
+        self.zk.getNode = mock.Mock(return_value=self._node(5))
+        self.zk.client.set.side_effect = kze.BadVersionError()
+        self.assertRaises(npe.ZKVersionException, self.zk.modifyNode,
+                          self._node(3), lambda n: True, attempts=2)
+        self.assertEqual(2, self.zk.client.set.call_count)
+
+
+class TestZKNodeBuckets(tests.BaseTestCase):
+    '''
+    Test the node bucket layout against a mocked ZooKeeper client.
+    '''
+
+    def setUp(self):
+        super(TestZKNodeBuckets, self).setUp()
+        self.zk = zk.ZooKeeper(enable_cache=False)
+        self.zk.client = mock.Mock()
+
+    def test_paths(self):
+        self.assertEqual('/nodepool/nodes/0000000001',
+                         self.zk._nodePath('0000000001'))
+        self.assertEqual('/nodepool/nodes/b07/070000000001',
+                         self.zk._nodePath('070000000001'))
+        self.assertEqual('/nodepool/nodes/b07/070000000001/lock',
+                         self.zk._nodeLockPath('070000000001'))
+        self.assertIsNone(self.zk._nodeBucket('0000000001'))
+        self.assertEqual('07', self.zk._nodeBucket('070000000001'))
+
+    def test_newNodePath(self):
+        self.assertEqual('/nodepool/nodes/', self.zk._newNodePath())
+        self.zk.client.ensure_path.assert_not_called()
+
+        self.zk.setNodeBuckets(3)
+        self.assertEqual(
+            ['/nodepool/nodes/b00/00', '/nodepool/nodes/b01/01',
+             '/nodepool/nodes/b02/02', '/nodepool/nodes/b00/00'],
+            [self.zk._newNodePath() for x in range(4)])
+        # Each bucket directory is only ensured once
+        self.assertEqual(3, self.zk.client.ensure_path.call_count)
+
+    def test_setNodeBuckets(self):
+        self.assertRaises(ValueError, self.zk.setNodeBuckets, -1)
+        self.assertRaises(ValueError, self.zk.setNodeBuckets,
+                          zk.ZooKeeper.MAX_NODE_BUCKETS + 1)
+        self.zk.setNodeBuckets(zk.ZooKeeper.MAX_NODE_BUCKETS)
+        self.assertEqual(zk.ZooKeeper.MAX_NODE_BUCKETS, self.zk.node_buckets)
+
+    def test_getNodes(self):
+        self.zk.client.get_children.return_value = [
+            '0000000001', 'b00', 'b01']
+        self.zk._bulkRead = mock.Mock(return_value=[
+            ['000000000002', '000000000004'], ['010000000003']])
+        self.assertEqual(
+            ['0000000001', '000000000002', '000000000004', '010000000003'],
+            self.zk.getNodes())
+        self.assertEqual(
+            ['/nodepool/nodes/b00', '/nodepool/nodes/b01'],
+            self.zk._bulkRead.call_args[0][1])
+
+
+class TestZKStats(tests.BaseTestCase):
+    '''
+    Test the ZooKeeper usage statistics against a mocked ZooKeeper client.
+    '''
+
+    def setUp(self):
+        super(TestZKStats, self).setUp()
+        self.zk = zk.ZooKeeper()
+        self.client = mock.Mock()
+        self.zk.client = zk.InstrumentedClient(self.client, self.zk.stats)
+
+    def _methods(self):
+        return self.zk.stats.getStats()['methods']
+
+    def test_histogram(self):
+        hist = zk.LatencyHistogram()
+        for value in (0.0005, 0.003, 0.003, 0.04, 10):
+            hist.add(value)
+        self.assertEqual(5, hist.count)
+        self.assertEqual(10, hist.max)
+        self.assertEqual(1, hist.counts[0])
+        self.assertEqual(1, hist.counts[-1])
+        self.assertEqual(0.005, zk.LatencyHistogram.percentile(
+            hist.counts, 50))
+        self.assertEqual(5.0, zk.LatencyHistogram.percentile(
+            hist.counts, 100))
+        self.assertIsNone(zk.LatencyHistogram.percentile(
+            [0] * len(hist.counts), 50))
+
+    def test_method_ops(self):
+        self.client.get.return_value = (b'{"state": "ready"}', None)
+        self.zk.getNode('0000000001')
+        self.client.get_children.return_value = ['0000000001']
+        self.zk.getNodes()
+        # Operations outside of instrumented methods
+        self.zk.client.create('/foo', b'bar')
+
+        methods = self._methods()
+        self.assertEqual(1, methods['getNode']['calls'])
+        self.assertEqual(1, methods['getNode']['ops'])
+        self.assertEqual(18, methods['getNode']['bytes_read'])
+        self.assertEqual(10, methods['getNodes']['bytes_read'])
+        self.assertEqual(1, methods['getNode']['latency']['count'])
+        self.assertEqual(0, methods['other']['calls'])
+        self.assertEqual(1, methods['other']['ops'])
+        self.assertEqual(3, methods['other']['bytes_written'])
+
+    def test_async_ops(self):
+        def get_async(path):
+            result = mock.Mock()
+            result.successful.return_value = True
+            result.value = (b'data', None)
+            result.rawlink.side_effect = lambda callback: callback(result)
+            return result
+
+        self.client.get_async.side_effect = get_async
+        self.zk._bulkGet(['/a', '/b'])
+        other = self._methods()['other']
+        self.assertEqual(2, other['ops'])
+        self.assertEqual(8, other['bytes_read'])
+
+    def test_transaction(self):
+        self.client.transaction.return_value.commit.return_value = []
+        txn = self.zk.client.transaction()
+        txn.create('/foo', b'bar')
+        txn.set_data('/baz', b'quux')
+        txn.delete('/foo')
+        txn.commit()
+        other = self._methods()['other']
+        self.assertEqual(1, other['ops'])
+        self.assertEqual(7, other['bytes_written'])
+
+    def test_cache_stats(self):
+        self.client.get.side_effect = kze.NoNodeError()
+        self.zk.getNode('0000000001', cached=True)
+        self.zk._nodeCacheListener(TreeEvent.make(TreeEvent.INITIALIZED,
+                                                  None))
+        self.zk.getNode('0000000001', cached=True)
+        node = zk.Node('0000000002')
+        node.state = zk.READY
+        self.zk._nodeCacheListener(TreeEvent.make(
+            TreeEvent.NODE_ADDED, NodeData.make(
+                self.zk._nodePath(node.id), node.serialize(),
+                ZnodeStat(0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0))))
+        self.zk.getNode(node.id, cached=True)
+        self.zk.getNodeRequest('0000000001', cached=True)
+
+        caches = self.zk.stats.getStats()['caches']
+        self.assertEqual({'hit': 1, 'miss': 1, 'fallback': 1},
+                         caches['nodes'])
+        self.assertEqual({'hit': 0, 'miss': 0, 'fallback': 1},
+                         caches['requests'])
+
+    def test_reportStats(self):
+        statsd = mock.Mock()
+        pipeline = statsd.pipeline.return_value
+        self.zk.stats.recordCall('getNode', 0.003)
+        self.zk.stats.recordOp('getNode', bytes_read=10)
+        self.zk.stats.recordCache('nodes', 'hit')
+        self.zk.stats.reportStats(statsd)
+        pipeline.incr.assert_has_calls([
+            mock.call('nodepool.zk.method.getNode.calls', 1),
+            mock.call('nodepool.zk.method.getNode.ops', 1),
+            mock.call('nodepool.zk.method.getNode.bytes_read', 10),
+            mock.call('nodepool.zk.cache.nodes.hit', 1),
+        ], any_order=True)
+        pipeline.timing.assert_any_call(
+            'nodepool.zk.method.getNode.latency.p99', 5)
+
+        # Only the changes since the last report are sent
+        pipeline.reset_mock()
+        self.zk.stats.recordCall('getNode', 0.3)
+        self.zk.stats.reportStats(statsd)
+        pipeline.incr.assert_called_once_with(
+            'nodepool.zk.method.getNode.calls', 1)
+        pipeline.timing.assert_any_call(
+            'nodepool.zk.method.getNode.latency.p50', 500)
+
+
+class TestZKCacheSnapshot(tests.BaseTestCase):
+    '''
+    Test saving and loading cache snapshots by feeding the caches events.
+    '''
+
+    def setUp(self):
+        super(TestZKCacheSnapshot, self).setUp()
+        self.path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                 'snapshot.json')
+        self.zk = zk.ZooKeeper()
+        self.zxid = 0
+
+    def _event(self, zk_conn, event_type, obj, czxid=None, version=0):
+        if isinstance(obj, zk.Node):
+            path = zk_conn._nodePath(obj.id)
+            listener = zk_conn._nodeCacheListener
+        else:
+            path = zk_conn._requestPath(obj.id)
+            listener = zk_conn._requestCacheListener
+        self.zxid += 1
+        if czxid is None:
+            czxid = self.zxid
+        stat = ZnodeStat(czxid, self.zxid, 0, 0, version, 0, 0, 0, 0, 0, 0)
+        listener(TreeEvent.make(event_type,
+                                NodeData.make(path, obj.serialize(), stat)))
+        return stat
+
+    def _initialize(self, zk_conn):
+        for listener in (zk_conn._nodeCacheListener,
+                         zk_conn._requestCacheListener):
+            listener(TreeEvent.make(TreeEvent.INITIALIZED, None))
+
+    def _node(self, node_id, state=zk.READY):
+        node = zk.Node(node_id)
+        node.state = state
+        node.provider = 'provider1'
+        node.pool = 'pool1'
+        node.type = ['label1']
+        return node
+
+    def _request(self, request_id):
+        req = zk.NodeRequest(request_id)
+        req.state = zk.REQUESTED
+        req.node_types = ['label1']
+        return req
+
+    def _snapshot(self):
+        self.nodes = [self._node('0000000001'), self._node('0000000002'),
+                      self._node('0000000003')]
+        self.req = self._request('100-0000000001')
+        self.stats = {}
+        for obj in self.nodes + [self.req]:
+            self.stats[obj.id] = self._event(self.zk, TreeEvent.NODE_ADDED,
+                                             obj)
+        self.assertFalse(self.zk.saveCacheSnapshot(self.path))
+        self._initialize(self.zk)
+        self.assertTrue(self.zk.saveCacheSnapshot(self.path))
+
+    def test_load(self):
+        self._snapshot()
+        warm_zk = zk.ZooKeeper()
+        self.assertTrue(warm_zk.loadCacheSnapshot(self.path))
+        for node in self.nodes:
+            self.assertEqual(node, warm_zk.getNode(node.id, cached=True))
+            self.assertEqual(self.stats[node.id],
+                             warm_zk.getNode(node.id, cached=True).stat)
+        self.assertEqual(self.req,
+                         warm_zk.getNodeRequest(self.req.id, cached=True))
+        self.assertEqual(1, len(warm_zk._request_queue))
+        self.assertFalse(warm_zk.waitForCacheInitialization(0))
+
+    def test_reconcile(self):
+        self._snapshot()
+        warm_zk = zk.ZooKeeper()
+        warm_zk.loadCacheSnapshot(self.path)
+        decode = mock.Mock(side_effect=warm_zk._bytesToDict)
+        warm_zk._bytesToDict = decode
+
+        # Unchanged znodes are not decoded again
+        n1, n2, n3 = self.nodes
+        stat = self.stats[n1.id]
+        warm_zk._nodeCacheListener(TreeEvent.make(
+            TreeEvent.NODE_ADDED, NodeData.make(
+                warm_zk._nodePath(n1.id), n1.serialize(), stat)))
+        self.assertEqual(0, decode.call_count)
+        stat = self.stats[self.req.id]
+        warm_zk._requestCacheListener(TreeEvent.make(
+            TreeEvent.NODE_ADDED, NodeData.make(
+                warm_zk._requestPath(self.req.id), self.req.serialize(),
+                stat)))
+        self.assertEqual(0, decode.call_count)
+
+        # Changed znodes are
+        n2.state = zk.USED
+        self._event(warm_zk, TreeEvent.NODE_ADDED, n2,
+                    czxid=self.stats[n2.id].czxid, version=1)
+        self.assertEqual(zk.USED, warm_zk.getNode(n2.id, cached=True).state)
+
+        # Deleted znodes are dropped with the initialization
+        self._initialize(warm_zk)
+        self.assertTrue(warm_zk.waitForCacheInitialization(0))
+        self.assertEqual([n1.id, n2.id], sorted(warm_zk._cached_nodes))
+        self.assertEqual([n1.id, n2.id],
+                         [n.id for n in warm_zk.getProviderNodes(
+                             'provider1')])
+
+    def test_recreated(self):
+        self._snapshot()
+        warm_zk = zk.ZooKeeper()
+        warm_zk.loadCacheSnapshot(self.path)
+        n1 = self.nodes[0]
+        n1.state = zk.HOLD
+        # A new znode with the same name starts over at version 0
+        self._event(warm_zk, TreeEvent.NODE_ADDED, n1)
+        self.assertEqual(zk.HOLD, warm_zk.getNode(n1.id, cached=True).state)
+
+    def test_locked_not_saved(self):
+        n1 = self._node('0000000001')
+        self._event(self.zk, TreeEvent.NODE_ADDED, n1)
+        self._initialize(self.zk)
+        self.zk._cached_nodes[n1.id].lock = mock.Mock()
+        self.zk.saveCacheSnapshot(self.path)
+        warm_zk = zk.ZooKeeper()
+        warm_zk.loadCacheSnapshot(self.path)
+        self.assertEqual({}, warm_zk._cached_nodes)
+
+    def test_too_old(self):
+        self._snapshot()
+        warm_zk = zk.ZooKeeper()
+        warm_zk.cache_snapshot_max_age = 0
+        self.assertFalse(warm_zk.loadCacheSnapshot(self.path))
+        self.assertEqual({}, warm_zk._cached_nodes)
+
+    def test_missing(self):
+        self.assertFalse(self.zk.loadCacheSnapshot(self.path))
@@ -12,17 +12,26 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+from collections import deque
 from contextlib import contextmanager
 from copy import copy
 import abc
+import bisect
+import functools
+import hashlib
+import itertools
 import json
 import logging
+import os
+import sys
+import threading
 import time
 from kazoo.client import KazooClient, KazooState
 from kazoo import exceptions as kze
 from kazoo.handlers.threading import KazooTimeoutError
+from kazoo.protocol.states import ZnodeStat
 from kazoo.recipe.lock import Lock
-from kazoo.recipe.cache import TreeCache, TreeEvent
+from kazoo.recipe.cache import NodeData, TreeCache, TreeEvent
 from kazoo.recipe.election import Election
 
 from nodepool import exceptions as npe
@@ -71,6 +80,24 @@ def as_list(item):
     return [item]
 
 
+def intern_str(value):
+    '''
+    Intern a string which is likely to be repeated across many objects.
+
+    Anything other than a plain string is returned unchanged.
+    '''
+    if type(value) is str:
+        return sys.intern(value)
+    return value
+
+
+def intern_list(values):
+    '''
+    Return a copy of a list with its strings interned.
+    '''
+    return [intern_str(v) for v in values]
+
+
 class ZooKeeperConnectionConfig(object):
     '''
     Represents the connection parameters for a ZooKeeper server.
@@ -143,6 +170,7 @@ class Serializable(abc.ABC):
     '''
     Abstract base class for objects that will be stored in ZooKeeper.
     '''
+    __slots__ = ()
 
     @abc.abstractmethod
     def toDict(self):
@@ -209,6 +237,12 @@ class Launcher(Serializable):
 
 class BaseModel(Serializable):
     VALID_STATES = set([])
+    # Keys of the dictionary representation which are only kept for
+    # backwards compatibility and are derived from other keys.
+    LEGACY_KEYS = ()
+    # The models are kept in large numbers in the caches, so avoid having
+    # a __dict__ per object.
+    __slots__ = ('_id', '_state', 'state_time', 'stat')
 
     def __init__(self, o_id):
         if o_id:
@@ -259,7 +293,7 @@ class BaseModel(Serializable):
         assumes self has already been instantiated.
         '''
         if 'state' in d:
-            self.state = d['state']
+            self.state = intern_str(d['state'])
         if 'state_time' in d:
             self.state_time = d['state_time']
 
@@ -276,6 +310,7 @@ class ImageBuild(BaseModel):
     similar).
     '''
     VALID_STATES = set([BUILDING, READY, DELETING, FAILED])
+    __slots__ = ('_formats', 'builder', 'builder_id', 'username')
 
     def __init__(self, build_id=None):
         super(ImageBuild, self).__init__(build_id)
@@ -329,9 +364,9 @@ class ImageBuild(BaseModel):
         '''
         o = ImageBuild(o_id)
         super(ImageBuild, o).fromDict(d)
-        o.builder = d.get('builder')
-        o.builder_id = d.get('builder_id')
-        o.username = d.get('username', 'zuul')
+        o.builder = intern_str(d.get('builder'))
+        o.builder_id = intern_str(d.get('builder_id'))
+        o.username = intern_str(d.get('username', 'zuul'))
         # Only attempt the split on non-empty string
         if d.get('formats', ''):
             o.formats = d.get('formats', '').split(',')
@@ -343,6 +378,8 @@ class ImageUpload(BaseModel):
     Class representing a provider image upload within the ZooKeeper cluster.
     '''
     VALID_STATES = set([UPLOADING, READY, DELETING, FAILED])
+    __slots__ = ('build_id', 'provider_name', 'image_name', 'format',
+                 'username', 'external_id', 'external_name')
 
     def __init__(self, build_id=None, provider_name=None, image_name=None,
                  upload_id=None, username=None):
@@ -398,12 +435,13 @@ class ImageUpload(BaseModel):
 
         :returns: An initialized ImageUpload object.
         '''
-        o = ImageUpload(build_id, provider_name, image_name, upload_id)
+        o = ImageUpload(build_id, intern_str(provider_name),
+                        intern_str(image_name), upload_id)
         super(ImageUpload, o).fromDict(d)
         o.external_id = d.get('external_id')
         o.external_name = d.get('external_name')
-        o.format = d.get('format')
-        o.username = d.get('username', 'zuul')
+        o.format = intern_str(d.get('format'))
+        o.username = intern_str(d.get('username', 'zuul'))
         return o
 
 
@@ -433,6 +471,8 @@ class NodeRequest(BaseModel):
     Class representing a node request.
     '''
     VALID_STATES = set([REQUESTED, PENDING, FULFILLED, FAILED])
+    __slots__ = ('lock', 'declined_by', 'node_types', 'nodes', 'reuse',
+                 'requestor', 'provider', 'relative_priority')
 
     def __init__(self, id=None):
         super(NodeRequest, self).__init__(id)
@@ -495,12 +535,12 @@ class NodeRequest(BaseModel):
 
     def updateFromDict(self, d):
         super().fromDict(d)
-        self.declined_by = d.get('declined_by', [])
-        self.node_types = d.get('node_types', [])
+        self.declined_by = intern_list(d.get('declined_by', []))
+        self.node_types = intern_list(d.get('node_types', []))
         self.nodes = d.get('nodes', [])
         self.reuse = d.get('reuse', True)
-        self.requestor = d.get('requestor')
-        self.provider = d.get('provider')
+        self.requestor = intern_str(d.get('requestor'))
+        self.provider = intern_str(d.get('provider'))
         self.relative_priority = d.get('relative_priority', 0)
 
 
@@ -508,9 +548,17 @@ class Node(BaseModel):
     '''
     Class representing a launched node.
     '''
+    LEGACY_KEYS = ('ssh_port',)
     VALID_STATES = set([BUILDING, TESTING, READY, IN_USE, USED,
                         HOLD, DELETING, FAILED, INIT, ABORTED,
                         DELETED])
+    __slots__ = ('lock', 'cloud', 'provider', 'pool', '__type',
+                 'allocated_to', 'az', 'region', 'public_ipv4',
+                 'private_ipv4', 'public_ipv6', 'host_id', 'interface_ip',
+                 'connection_port', 'image_id', 'launcher', 'created_time',
+                 'external_id', 'hostname', 'comment', 'hold_job',
+                 'username', 'connection_type', 'host_keys',
+                 'hold_expiration', 'resources', 'attributes')
 
     def __init__(self, id=None):
         super(Node, self).__init__(id)
@@ -652,28 +700,28 @@ class Node(BaseModel):
         :param dict d: The dictionary
         '''
         super().fromDict(d)
-        self.cloud = d.get('cloud')
-        self.provider = d.get('provider')
-        self.pool = d.get('pool')
-        self.type = d.get('type')
+        self.cloud = intern_str(d.get('cloud'))
+        self.provider = intern_str(d.get('provider'))
+        self.pool = intern_str(d.get('pool'))
+        self.type = intern_list(as_list(d.get('type')))
         self.allocated_to = d.get('allocated_to')
-        self.az = d.get('az')
-        self.region = d.get('region')
+        self.az = intern_str(d.get('az'))
+        self.region = intern_str(d.get('region'))
         self.public_ipv4 = d.get('public_ipv4')
         self.private_ipv4 = d.get('private_ipv4')
         self.public_ipv6 = d.get('public_ipv6')
         self.host_id = d.get('host_id')
         self.interface_ip = d.get('interface_ip')
         self.connection_port = d.get('connection_port', d.get('ssh_port', 22))
-        self.image_id = d.get('image_id')
-        self.launcher = d.get('launcher')
+        self.image_id = intern_str(d.get('image_id'))
+        self.launcher = intern_str(d.get('launcher'))
         self.created_time = d.get('created_time')
         self.external_id = d.get('external_id')
         self.hostname = d.get('hostname')
         self.comment = d.get('comment')
         self.hold_job = d.get('hold_job')
-        self.username = d.get('username', 'zuul')
-        self.connection_type = d.get('connection_type')
+        self.username = intern_str(d.get('username', 'zuul'))
+        self.connection_type = intern_str(d.get('connection_type'))
         self.host_keys = d.get('host_keys', [])
         hold_expiration = d.get('hold_expiration')
         if hold_expiration is not None:
@@ -692,6 +740,817 @@ class Node(BaseModel):
         self.attributes = d.get('attributes')
 
 
+class NodeIndex(object):
+    '''
+    Secondary indexes over the cached nodes.
+
+    Each index maps a key derived from a node attribute to the set of IDs
+    of the nodes currently having that value, so that lookups cost
+    O(result size) instead of O(all nodes). The keys a node was last
+    indexed under are remembered so that a changed node can be moved
+    between index buckets without scanning.
+
+    This class is not thread safe; the caller is expected to serialize
+    access to it.
+    '''
+
+    # Index name -> function returning the keys a node is indexed under.
+    KEYS = {
+        'state': lambda n: (n.state,),
+        'pool': lambda n: ((n.provider, n.pool),),
+        'label': lambda n: tuple(n.type),
+        'allocated_to': lambda n: (n.allocated_to,) if n.allocated_to else (),
+        'hostname': lambda n: (n.hostname,) if n.hostname else (),
+    }
+
+    def __init__(self):
+        self._indexes = dict((name, {}) for name in self.KEYS)
+        self._node_keys = {}
+
+    def __len__(self):
+        return len(self._node_keys)
+
+    def update(self, node):
+        '''
+        Add a node to the indexes or move it to its current keys.
+
+        :param Node node: The node to (re)index.
+        '''
+        old_keys = self._node_keys.get(node.id, {})
+        new_keys = {}
+        for name, get_keys in self.KEYS.items():
+            keys = frozenset(get_keys(node))
+            new_keys[name] = keys
+            old = old_keys.get(name, frozenset())
+            if keys == old:
+                continue
+            index = self._indexes[name]
+            for key in old - keys:
+                self._discard(index, key, node.id)
+            for key in keys - old:
+                index.setdefault(key, set()).add(node.id)
+        self._node_keys[node.id] = new_keys
+
+    def remove(self, node_id):
+        '''
+        Remove a node from all indexes.
+
+        :param str node_id: The ID of the node to remove.
+        '''
+        old_keys = self._node_keys.pop(node_id, {})
+        for name, keys in old_keys.items():
+            index = self._indexes[name]
+            for key in keys:
+                self._discard(index, key, node_id)
+
+    def get(self, name, key):
+        '''
+        Get the IDs of the nodes indexed under a key.
+
+        :param str name: The index name (one of KEYS).
+        :param key: The key to look up.
+
+        :returns: A set of node IDs. Must not be modified by the caller.
+        '''
+        return self._indexes[name].get(key, frozenset())
+
+    def keys(self, name):
+        '''
+        Get all keys currently present in an index.
+
+        :param str name: The index name (one of KEYS).
+        '''
+        return list(self._indexes[name].keys())
+
+    def _discard(self, index, key, node_id):
+        ids = index.get(key)
+        if ids is None:
+            return
+        ids.discard(node_id)
+        if not ids:
+            del index[key]
+
+
+class NodeRequestQueue(object):
+    '''
+    The node requests in REQUESTED state, sorted by priority.
+
+    Requests are sorted by queue priority, then, for all requests at the
+    same priority, by the relative_priority field, then finally by the
+    submission order. The queue is kept sorted on every update so that it
+    can be iterated in order without sorting all requests every time.
+
+    This class is not thread safe; the caller is expected to serialize
+    access to it.
+    '''
+
+    def __init__(self):
+        self._queue = []
+        # Request ID -> (sort key, znode version)
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._queue)
+
+    @staticmethod
+    def sortKey(request_id, relative_priority):
+        priority, _, sequence = request_id.partition('-')
+        return (priority, relative_priority, sequence, request_id)
+
+    def update(self, request_id, state, relative_priority, version):
+        '''
+        Add, move or remove a request according to its current data.
+
+        :param str request_id: The request ID.
+        :param str state: The current request state.
+        :param int relative_priority: The current relative priority.
+        :param int version: The znode version of the data.
+        '''
+        entry = self._entries.get(request_id)
+        if entry is not None:
+            if version < entry[1]:
+                # Don't update to older data
+                return
+            if state == REQUESTED and entry[0][1] == relative_priority:
+                self._entries[request_id] = (entry[0], version)
+                return
+            self.remove(request_id)
+        if state != REQUESTED:
+            return
+        key = self.sortKey(request_id, relative_priority)
+        bisect.insort(self._queue, key)
+        self._entries[request_id] = (key, version)
+
+    def remove(self, request_id):
+        '''
+        Remove a request from the queue.
+
+        :param str request_id: The request ID.
+        '''
+        entry = self._entries.pop(request_id, None)
+        if entry is None:
+            return
+        i = bisect.bisect_left(self._queue, entry[0])
+        if i < len(self._queue) and self._queue[i] == entry[0]:
+            del self._queue[i]
+
+    def next(self, key=None):
+        '''
+        Get the key of the request following a given key.
+
+        Since the key of the last returned request is used as a cursor,
+        the queue may be modified between calls.
+
+        :param tuple key: The previous key, or None to get the first one.
+
+        :returns: The next sort key (whose last item is the request ID),
+            or None if there are no more requests.
+        '''
+        if key is None:
+            i = 0
+        else:
+            i = bisect.bisect_right(self._queue, key)
+        if i < len(self._queue):
+            return self._queue[i]
+        return None
+
+
+class JsonEncoding(object):
+    '''
+    The default encoding of objects stored in ZooKeeper: their full JSON
+    representation.
+    '''
+
+    name = 'json'
+
+    def encode(self, obj):
+        '''
+        Encode an object for storing it in ZooKeeper.
+
+        :param Serializable obj: The object to encode.
+        :returns: The encoded bytes.
+        '''
+        return obj.serialize()
+
+
+class CompactEncoding(JsonEncoding):
+    '''
+    A compact encoding for nodes and node requests.
+
+    The data starts with a header made of a NUL byte (which never starts
+    legacy JSON data) and the format version. It is followed by JSON
+    without whitespace, leaving out keys which are only written for older
+    readers and all values which equal the default the object would be
+    initialized with when the key is missing. Other objects are encoded
+    as JSON.
+
+    .. note:: Zuul only understands the JSON encoding.
+    '''
+
+    name = 'compact'
+    MAGIC = b'\x00'
+    VERSION = 1
+    HEADER = MAGIC + bytes([VERSION])
+
+    def __init__(self):
+        self._defaults = {}
+
+    def _getDefaults(self, cls):
+        defaults = self._defaults.get(cls)
+        if defaults is None:
+            defaults = cls.fromDict({}).toDict()
+            for key in cls.LEGACY_KEYS:
+                defaults.pop(key, None)
+            self._defaults[cls] = defaults
+        return defaults
+
+    def encode(self, obj):
+        if not isinstance(obj, (Node, NodeRequest)):
+            return obj.serialize()
+        # Legacy keys are not part of the defaults, so they are left out
+        defaults = self._getDefaults(type(obj))
+        d = dict((k, v) for k, v in obj.toDict().items()
+                 if k in defaults and defaults[k] != v)
+        return self.HEADER + json.dumps(
+            d, separators=(',', ':')).encode('utf8')
+
+    @classmethod
+    def decode(cls, data):
+        '''
+        Decode compact data to a dictionary.
+
+        :param bytes data: The encoded data, including the header.
+        '''
+        version = data[len(cls.MAGIC)]
+        if version != cls.VERSION:
+            raise npe.ZKException(
+                "Unsupported compact encoding version %s" % version)
+        return json.loads(data[len(cls.HEADER):].decode('utf8'))
+
+
+ENCODINGS = {
+    JsonEncoding.name: JsonEncoding(),
+    CompactEncoding.name: CompactEncoding(),
+}
+
+
+class LatencyHistogram(object):
+    '''
+    A histogram of latencies with fixed, roughly exponential buckets.
+    '''
+
+    # Upper bounds of the buckets in seconds, the last bucket is unbounded
+    BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+               1.0, 2.0, 5.0)
+
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        '''
+        Add a latency.
+
+        :param float value: The latency in seconds.
+        '''
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    @classmethod
+    def percentile(cls, counts, percent):
+        '''
+        Estimate a percentile from bucket counts.
+
+        :param list counts: The count of each bucket.
+        :param float percent: The percentile (0-100).
+
+        :returns: The upper bound of the bucket containing the percentile
+            (or of the last bounded bucket), or None without any latencies.
+        '''
+        total = sum(counts)
+        if not total:
+            return None
+        threshold = total * percent / 100.0
+        seen = 0
+        for bound, count in zip(cls.BUCKETS, counts):
+            seen += count
+            if seen >= threshold:
+                return bound
+        return cls.BUCKETS[-1]
+
+    def toDict(self):
+        return {
+            'buckets': list(zip(self.BUCKETS + (None,), self.counts)),
+            'count': self.count,
+            'total': self.total,
+            'max': self.max,
+        }
+
+
+class MethodStats(object):
+    '''
+    ZooKeeper usage statistics of one ZooKeeper method.
+    '''
+
+    __slots__ = ('calls', 'ops', 'bytes_read', 'bytes_written', 'latency')
+
+    def __init__(self):
+        self.calls = 0
+        self.ops = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.latency = LatencyHistogram()
+
+    def toDict(self):
+        return {
+            'calls': self.calls,
+            'ops': self.ops,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'latency': self.latency.toDict(),
+        }
+
+
+class ZooKeeperStats(object):
+    '''
+    Statistics about the ZooKeeper usage of a ZooKeeper object.
+
+    ZooKeeper operations are attributed to the outermost instrumented
+    ZooKeeper method running in the same thread, or to "other" (e.g., for
+    the operations of the tree caches).
+    '''
+
+    CACHE_RESULTS = ('hit', 'miss', 'fallback')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # Method name -> MethodStats
+        self.methods = {}
+        # Cache name -> result -> count
+        self.caches = {}
+        # Totals at the time stats were last reported to statsd
+        self._reported_methods = {}
+        self._reported_caches = {}
+
+    def _methodStats(self, name):
+        stats = self.methods.get(name)
+        if stats is None:
+            stats = self.methods.setdefault(name, MethodStats())
+        return stats
+
+    def currentMethod(self):
+        '''
+        Get the name of the instrumented method running in this thread.
+        '''
+        return getattr(self._local, 'method', None)
+
+    def recordCall(self, name, duration):
+        '''
+        Record a completed call of an instrumented method.
+
+        :param str name: The method name.
+        :param float duration: The duration of the call in seconds.
+        '''
+        with self._lock:
+            stats = self._methodStats(name)
+            stats.calls += 1
+            stats.latency.add(duration)
+
+    def recordOp(self, name, bytes_read=0, bytes_written=0):
+        '''
+        Record a ZooKeeper operation.
+
+        :param str name: The method name the operation is attributed to,
+            or None for "other".
+        :param int bytes_read: The size of the data read.
+        :param int bytes_written: The size of the data written.
+        '''
+        with self._lock:
+            stats = self._methodStats(name or 'other')
+            stats.ops += 1
+            stats.bytes_read += bytes_read
+            stats.bytes_written += bytes_written
+
+    def recordCache(self, cache, result):
+        '''
+        Record a cached read.
+
+        :param str cache: The cache name (e.g. "nodes").
+        :param str result: One of CACHE_RESULTS. A "miss" is a read which
+            was not found in the cache and went to ZooKeeper, a "fallback"
+            one which went to ZooKeeper since the cache is not initialized.
+        '''
+        with self._lock:
+            counts = self.caches.get(cache)
+            if counts is None:
+                counts = self.caches.setdefault(
+                    cache, dict((r, 0) for r in self.CACHE_RESULTS))
+            counts[result] += 1
+
+    def getStats(self):
+        '''
+        Get a snapshot of the statistics.
+
+        :returns: A dict with a "methods" dict mapping method names to
+            their statistics and a "caches" dict mapping cache names to
+            their hit, miss and fallback counts.
+        '''
+        with self._lock:
+            return {
+                'methods': dict((name, stats.toDict())
+                                for name, stats in self.methods.items()),
+                'caches': dict((name, dict(counts))
+                               for name, counts in self.caches.items()),
+            }
+
+    def reportStats(self, statsd, prefix='nodepool.zk'):
+        '''
+        Report the statistics gathered since the last report to statsd.
+
+        Counts are reported as counters and the latency percentiles of the
+        calls since the last report as timers (in milliseconds).
+
+        :param statsd: The statsd client.
+        :param str prefix: The prefix of the statsd keys.
+        '''
+        with self._lock:
+            methods = dict((name, (stats.calls, stats.ops, stats.bytes_read,
+                                   stats.bytes_written,
+                                   list(stats.latency.counts)))
+                           for name, stats in self.methods.items())
+            caches = dict((name, dict(counts))
+                          for name, counts in self.caches.items())
+
+        pipeline = statsd.pipeline()
+        for name, totals in methods.items():
+            last = self._reported_methods.get(
+                name, (0, 0, 0, 0, [0] * len(totals[4])))
+            key = '%s.method.%s' % (prefix, name)
+            for subkey, total, last_total in zip(
+                    ('calls', 'ops', 'bytes_read', 'bytes_written'),
+                    totals, last):
+                if total > last_total:
+                    pipeline.incr('%s.%s' % (key, subkey), total - last_total)
+            counts = [a - b for a, b in zip(totals[4], last[4])]
+            for percent in (50, 95, 99):
+                value = LatencyHistogram.percentile(counts, percent)
+                if value is not None:
+                    pipeline.timing('%s.latency.p%s' % (key, percent),
+                                    int(value * 1000))
+        for name, counts in caches.items():
+            last = self._reported_caches.get(name, {})
+            for result, count in counts.items():
+                if count > last.get(result, 0):
+                    pipeline.incr('%s.cache.%s.%s' % (prefix, name, result),
+                                  count - last.get(result, 0))
+        pipeline.send()
+        self._reported_methods = methods
+        self._reported_caches = caches
+
+
+def instrumented(func):
+    '''
+    Decorator recording the calls of a method in the ZooKeeperStats of its
+    object (its ``stats`` attribute).
+
+    Calls made from within another instrumented method are only accounted
+    to the outermost one.
+    '''
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        stats = self.stats
+        local = stats._local
+        if getattr(local, 'method', None) is not None:
+            return func(self, *args, **kwargs)
+        local.method = name
+        start = time.monotonic()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            local.method = None
+            stats.recordCall(name, time.monotonic() - start)
+    return wrapper
+
+
+def _dataSize(data):
+    if isinstance(data, (bytes, bytearray)):
+        return len(data)
+    return 0
+
+
+def _resultSize(result):
+    # Size of the result of a get (data, stat) or get_children (names)
+    if isinstance(result, tuple) and result:
+        return _dataSize(result[0])
+    if isinstance(result, list):
+        return sum(len(name) for name in result)
+    return 0
+
+
+class InstrumentedTransaction(object):
+    '''
+    A proxy of a kazoo transaction recording its commit as one operation.
+    '''
+
+    def __init__(self, transaction, stats):
+        self._transaction = transaction
+        self._stats = stats
+        self._bytes_written = 0
+
+    def __getattr__(self, name):
+        return getattr(self._transaction, name)
+
+    def create(self, path, value=b"", *args, **kwargs):
+        self._bytes_written += _dataSize(value)
+        return self._transaction.create(path, value, *args, **kwargs)
+
+    def set_data(self, path, value, *args, **kwargs):
+        self._bytes_written += _dataSize(value)
+        return self._transaction.set_data(path, value, *args, **kwargs)
+
+    def commit(self):
+        try:
+            return self._transaction.commit()
+        finally:
+            self._stats.recordOp(self._stats.currentMethod(),
+                                 bytes_written=self._bytes_written)
+
+
+class InstrumentedClient(object):
+    '''
+    A proxy of a KazooClient recording the ZooKeeper operations made
+    through it in a ZooKeeperStats object.
+
+    Anything but the operations is passed through to the client.
+    '''
+
+    READ_OPS = ('get', 'get_children', 'exists')
+    WRITE_OPS = ('create', 'set')
+    OTHER_OPS = ('delete', 'ensure_path')
+
+    def __init__(self, client, stats):
+        self._client = client
+        self._stats = stats
+        for op in self.READ_OPS + self.WRITE_OPS + self.OTHER_OPS:
+            setattr(self, op, self._instrument(op))
+            setattr(self, op + '_async', self._instrumentAsync(op))
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def _writeSize(self, op, args, kwargs):
+        if op not in self.WRITE_OPS:
+            return 0
+        if len(args) > 1:
+            return _dataSize(args[1])
+        return _dataSize(kwargs.get('value', b""))
+
+    def _instrument(self, op):
+        method = getattr(self._client, op)
+        stats = self._stats
+
+        def wrapper(*args, **kwargs):
+            written = self._writeSize(op, args, kwargs)
+            name = stats.currentMethod()
+            result = None
+            try:
+                result = method(*args, **kwargs)
+                return result
+            finally:
+                stats.recordOp(name, _resultSize(result), written)
+        return wrapper
+
+    def _instrumentAsync(self, op):
+        method = getattr(self._client, op + '_async')
+        stats = self._stats
+
+        def wrapper(*args, **kwargs):
+            written = self._writeSize(op, args, kwargs)
+            name = stats.currentMethod()
+
+            def completed(async_result):
+                read = 0
+                if async_result.successful():
+                    read = _resultSize(async_result.value)
+                stats.recordOp(name, read, written)
+
+            async_result = method(*args, **kwargs)
+            async_result.rawlink(completed)
+            return async_result
+        return wrapper
+
+    def transaction(self):
+        return InstrumentedTransaction(self._client.transaction(),
+                                       self._stats)
+
+
+class ZooKeeperTransaction(object):
+    '''
+    A set of ZooKeeper writes committed as one atomic multi-op.
+
+    Operations are queued by the methods of this class and sent to
+    ZooKeeper by commit(). Either all of them are applied, or none of them
+    is. The model objects involved are only updated (e.g., their lock
+    attribute) once the transaction succeeded.
+
+    Use ZooKeeper.transaction() to get a new transaction.
+    '''
+
+    def __init__(self, zk):
+        self.zk = zk
+        self.stats = zk.stats
+        self._transaction = zk.client.transaction()
+        # One callable (or None) per queued operation which is called with
+        # the result of that operation after a successful commit.
+        self._callbacks = []
+
+    def storeNode(self, node, check_version=False):
+        '''
+        Queue an update of an existing node.
+
+        :param Node node: The Node object to store.
+        :param bool check_version: If True, the transaction fails if the
+            node was modified since it was read.
+        '''
+        if not node.id:
+            raise npe.ZKException("Cannot store a new node %s in a "
+                                  "transaction" % node)
+
+        def stored(stat):
+            node.stat = stat
+            self.zk._reindexNode(node)
+
+        version = -1
+        if check_version and node.stat is not None:
+            version = node.stat.version
+        self._transaction.set_data(self.zk._nodePath(node.id),
+                                   self.zk.encoding.encode(node), version)
+        self._callbacks.append(stored)
+
+    def createNode(self, node):
+        '''
+        Queue creating a new node.
+
+        The node is created in the layout configured for new nodes. Its ID
+        is set once the transaction succeeded.
+
+        :param Node node: The Node object to create.
+        '''
+        if node.id:
+            raise npe.ZKException("Node %s already exists" % node)
+
+        def created(path):
+            node.id = path.rsplit('/', 1)[1]
+
+        self._transaction.create(self.zk._newNodePath(),
+                                 self.zk.encoding.encode(node),
+                                 sequence=True)
+        self._callbacks.append(created)
+
+    def lockNewNode(self, node):
+        '''
+        Queue locking a node which has never been locked before.
+
+        This creates the lock directory along with our lock contender, so
+        the transaction fails if anyone else ever attempted to lock the node.
+
+        :param Node node: The Node object to lock.
+        '''
+        lock = Lock(self.zk.client, self.zk._nodeLockPath(node.id))
+
+        def locked(path):
+            # Set up the lock as if it had been acquired by the recipe
+            lock.node = path.rsplit('/', 1)[1]
+            lock.create_tried = True
+            lock.assured_path = True
+            lock.is_acquired = True
+            node.lock = lock
+
+        self._transaction.create(lock.path)
+        self._callbacks.append(None)
+        self._transaction.create(lock.create_path, lock.data,
+                                 ephemeral=True, sequence=True)
+        self._callbacks.append(locked)
+
+    def unlockNode(self, node):
+        '''
+        Queue unlocking a node.
+
+        :param Node node: The locked Node object to unlock.
+
+        :raises: ZKLockException if the node is not currently locked.
+        '''
+        if node.lock is None or not node.lock.is_acquired:
+            raise npe.ZKLockException("Node %s does not hold a lock" % node)
+        self._unlock(node)
+
+    def storeNodeRequest(self, request, check_version=False):
+        '''
+        Queue an update of an existing node request.
+
+        The transaction fails if the request does not exist anymore.
+
+        :param NodeRequest request: The node request to store.
+        :param bool check_version: If True, the transaction fails if the
+            request was modified since it was read.
+        '''
+        if not request.id:
+            raise npe.ZKException("Cannot store a new request %s in a "
+                                  "transaction" % request)
+
+        def stored(stat):
+            request.stat = stat
+
+        version = -1
+        if check_version and request.stat is not None:
+            version = request.stat.version
+        self._transaction.set_data(self.zk._requestPath(request.id),
+                                   self.zk.encoding.encode(request), version)
+        self._callbacks.append(stored)
+
+    def unlockNodeRequest(self, request):
+        '''
+        Queue unlocking a node request.
+
+        :param NodeRequest request: The locked request to unlock.
+
+        :raises: ZKLockException if the request is not currently locked.
+        '''
+        if request.lock is None or not request.lock.is_acquired:
+            raise npe.ZKLockException(
+                "Request %s does not hold a lock" % request)
+        self._unlock(request)
+
+    def deleteNode(self, node, check_version=False):
+        '''
+        Queue deleting a node along with its lock.
+
+        This reads the lock contenders of the node in order to delete them.
+        The transaction fails if the node gained any other children since.
+
+        :param Node node: The Node object to delete.
+        :param bool check_version: If True, the transaction fails if the
+            node was modified since it was read.
+        '''
+        path = self.zk._nodePath(node.id)
+        for child in self.zk.client.get_children(path):
+            child_path = "%s/%s" % (path, child)
+            for grandchild in self.zk.client.get_children(child_path):
+                self._transaction.delete("%s/%s" % (child_path, grandchild))
+                self._callbacks.append(None)
+            self._transaction.delete(child_path)
+            self._callbacks.append(None)
+
+        def deleted(result):
+            node.state = DELETED
+
+        version = -1
+        if check_version and node.stat is not None:
+            version = node.stat.version
+        self._transaction.delete(path, version)
+        self._callbacks.append(deleted)
+
+    @instrumented
+    def commit(self):
+        '''
+        Commit all queued operations.
+
+        :raises: ZKTransactionException if the transaction failed, in which
+            case none of the operations were applied.
+        '''
+        results = self._transaction.commit()
+        errors = [r for r in results if isinstance(r, Exception) and
+                  not isinstance(r, kze.RolledBackError)]
+        if errors:
+            raise npe.ZKTransactionException(
+                "Transaction failed: %s" % ", ".join(
+                    e.__class__.__name__ for e in errors))
+        for callback, result in zip(self._callbacks, results):
+            if callback:
+                callback(result)
+
+    def _unlock(self, obj):
+        lock = obj.lock
+
+        def unlocked(result):
+            lock.is_acquired = False
+            lock.node = None
+            obj.lock = None
+
+        self._transaction.delete("%s/%s" % (lock.path, lock.node))
+        self._callbacks.append(unlocked)
+
+
 class ZooKeeper(object):
     '''
     Class implementing the ZooKeeper interface.
@@ -717,77 +1576,371 @@ class ZooKeeper(object):
     REQUEST_LOCK_ROOT = "/nodepool/requests-lock"
     ELECTION_ROOT = "/nodepool/elections"
 
+    CACHE_SNAPSHOT_VERSION = 1
+
+    # With node buckets enabled, nodes are created below bucket directories
+    # of NODE_ROOT (e.g., /nodepool/nodes/b07/070000000042). The ID of such
+    # a node is its bucket number followed by its sequence number, so the
+    # path of any node can be derived from its ID.
+    NODE_BUCKET_PREFIX = "b"
+    MAX_NODE_BUCKETS = 100
+    SEQUENCE_LENGTH = 10
+
     # Log zookeeper retry every 10 seconds
     retry_log_rate = 10
 
-    def __init__(self, enable_cache=True):
+    # Maximum number of outstanding requests of a bulk read
+    bulk_read_depth = 64
+
+    # Cross-check every node index lookup against a full scan of the node
+    # cache. This is expensive and only meant to be enabled by tests.
+    verify_node_index = False
+
+    # Cache snapshots older than this (in seconds) are not loaded
+    cache_snapshot_max_age = 3600
+
+    def __init__(self, enable_cache=True, enable_image_cache=False):
         '''
         Initialize the ZooKeeper object.
+
+        :param bool enable_cache: Whether to cache nodes and node requests.
+        :param bool enable_image_cache: Whether to cache image uploads.
         '''
         self.client = None
         self._became_lost = False
         self._last_retry_log = 0
         self._node_cache = None
         self._request_cache = None
+        self._image_cache = None
+        self._image_cache_initialized = False
+        # (image, build, provider, upload) -> ImageUpload
+        self._cached_image_uploads = {}
+        # (image, provider, state) -> {(build, upload): ImageUpload}
+        self._image_upload_states = {}
+        # (image, provider, state) -> most recent ImageUpload
+        self._latest_image_uploads = {}
+        self._image_cache_lock = threading.Lock()
+        self.enable_image_cache = enable_image_cache
+        self._launcher_cache = None
+        self._launcher_cache_initialized = False
+        self._cached_launchers = {}
+        # Launcher ID -> data we last registered it with
+        self._registered_launchers = {}
+        self.encoding = ENCODINGS[JsonEncoding.name]
+        self.node_buckets = 0
+        self._node_bucket_counter = itertools.count()
+        self._node_bucket_paths = set()
         self._cached_nodes = {}
         self._cached_node_requests = {}
+        self._node_cache_initialized = False
+        self._request_cache_initialized = False
+        self._node_index = NodeIndex()
+        self._node_index_lock = threading.Lock()
+        self.node_index_mismatches = 0
+        # Node ID -> set of lock contender znode names
+        self._node_lock_contenders = {}
+        # Node/request ID -> (czxid, mzxid) of the snapshot entries which
+        # were not confirmed by the caches yet
+        self._snapshot_nodes = {}
+        self._snapshot_requests = {}
+        self._cache_initialized_event = threading.Event()
+        # Node ID -> (data, stat, digest) received but not decoded yet
+        self._pending_nodes = {}
+        # Node ID -> digest of the data the cached node was decoded from
+        self._cached_node_digests = {}
+        self._request_queue = NodeRequestQueue()
+        self._request_queue_lock = threading.Lock()
+        # Number of times a cached listing was requested but had to be
+        # read from ZooKeeper because the cache was not initialized yet.
+        self.node_cache_fallbacks = 0
+        self.request_cache_fallbacks = 0
+        self.stats = ZooKeeperStats()
         self.enable_cache = enable_cache
 
-        self.node_stats_event = None
+        self.node_stats_event = None
+        self._wake_listeners = []
+
+    # =======================================================================
+    # Private Methods
+    # =======================================================================
+
+    def _electionPath(self, election):
+        return "%s/%s" % (self.ELECTION_ROOT, election)
+
+    def _imagePath(self, image):
+        return "%s/%s" % (self.IMAGE_ROOT, image)
+
+    def _imageBuildRequestPath(self, image):
+        return "%s/request-build" % self._imagePath(image)
+
+    def _imageBuildsPath(self, image):
+        return "%s/builds" % self._imagePath(image)
+
+    def _imageBuildLockPath(self, image):
+        return "%s/lock" % self._imageBuildsPath(image)
+
+    def _imageBuildNumberLockPath(self, image, build_number):
+        return "%s/%s/lock" % (self._imageBuildsPath(image),
+                               build_number)
+
+    def _imageProviderPath(self, image, build_number):
+        return "%s/%s/providers" % (self._imageBuildsPath(image),
+                                    build_number)
+
+    def _imageUploadPath(self, image, build_number, provider):
+        return "%s/%s/providers/%s/images" % (self._imageBuildsPath(image),
+                                              build_number,
+                                              provider)
+
+    def _imageUploadLockPath(self, image, build_number, provider):
+        return "%s/lock" % self._imageUploadPath(image, build_number,
+                                                 provider)
+
+    def _launcherPath(self, launcher):
+        return "%s/%s" % (self.LAUNCHER_ROOT, launcher)
+
+    def _nodeBucketPath(self, bucket):
+        return "%s/%s%s" % (self.NODE_ROOT, self.NODE_BUCKET_PREFIX, bucket)
+
+    def _nodeBucket(self, node):
+        if len(node) > self.SEQUENCE_LENGTH:
+            return node[:-self.SEQUENCE_LENGTH]
+        return None
+
+    def _nodePath(self, node):
+        bucket = self._nodeBucket(node)
+        if bucket is None:
+            return "%s/%s" % (self.NODE_ROOT, node)
+        return "%s/%s" % (self._nodeBucketPath(bucket), node)
+
+    def _nodeLockPath(self, node):
+        return "%s/lock" % self._nodePath(node)
+
+    def _newNodePath(self):
+        '''
+        Get the path prefix to create a new sequential node znode with.
+
+        Without node buckets, this is NODE_ROOT. Otherwise the buckets are
+        used in turn and the bucket directory is created if needed.
+        '''
+        if not self.node_buckets:
+            return "%s/" % self.NODE_ROOT
+        bucket = "%02d" % (next(self._node_bucket_counter) %
+                           self.node_buckets)
+        bucket_path = self._nodeBucketPath(bucket)
+        if bucket_path not in self._node_bucket_paths:
+            self.client.ensure_path(bucket_path)
+            self._node_bucket_paths.add(bucket_path)
+        return "%s/%s" % (bucket_path, bucket)
+
+    def _isNodeBucket(self, name):
+        return name.startswith(self.NODE_BUCKET_PREFIX)
+
+    def _requestPath(self, request):
+        return "%s/%s" % (self.REQUEST_ROOT, request)
+
+    def _requestLockPath(self, request):
+        return "%s/%s" % (self.REQUEST_LOCK_ROOT, request)
+
+    def _useNodeIndex(self, cached=True):
+        '''
+        Whether node queries can be answered from the node indexes.
+
+        The indexes are only complete once the node cache finished its
+        initial sync, until then callers need to fall back to a scan.
+        '''
+        if not (cached and self.enable_cache):
+            return False
+        if not self._node_cache_initialized:
+            self.stats.recordCache('nodes', 'fallback')
+            return False
+        self.stats.recordCache('nodes', 'hit')
+        return True
+
+    def _recordCachedRead(self, cache, found, initialized):
+        if not self.enable_cache:
+            return
+        if found:
+            result = 'hit'
+        elif initialized:
+            result = 'miss'
+        else:
+            result = 'fallback'
+        self.stats.recordCache(cache, result)
+
+    def _reindexNode(self, node):
+        '''
+        Update the node indexes for a node modified in-place.
+
+        Only the cached instance of a node is indexed, so this is a no-op
+        for any other copy of the node.
+        '''
+        with self._node_index_lock:
+            if node.id and self._cached_nodes.get(node.id) is node:
+                self._node_index.update(node)
+                # It may not match the data we last decoded anymore
+                self._cached_node_digests.pop(node.id, None)
+
+    @staticmethod
+    def _nodeDigest(data):
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    def _applyPendingNode(self, node_id):
+        '''
+        Decode the latest data received for a cached node, if any.
+
+        Must be called with the node index lock held.
+        '''
+        pending = self._pending_nodes.pop(node_id, None)
+        if pending is None:
+            return
+        data, stat, digest = pending
+        node = self._cached_nodes.get(node_id)
+        # The node may have been locked (and refreshed) or stored since
+        if node is None or node.lock or stat.version <= node.stat.version:
+            return
+        node.updateFromDict(self._bytesToDict(data))
+        node.stat = stat
+        self._cached_node_digests[node_id] = digest
+        self._node_index.update(node)
+
+    def _getCachedNode(self, node_id):
+        '''
+        Get a node from the cache, decoding its latest data if needed.
+        '''
+        if node_id in self._pending_nodes:
+            with self._node_index_lock:
+                self._applyPendingNode(node_id)
+        return self._cached_nodes.get(node_id)
+
+    def _getIndexedNodes(self, predicate, *lookups):
+        '''
+        Get cached nodes using the node indexes.
+
+        The candidates are the nodes present under all of the given index
+        keys. Since cached nodes may be modified in-place before being
+        reindexed, the candidates are filtered again with the predicate.
+
+        :param predicate: A callable taking a Node and returning True if
+            the node should be included in the result.
+        :param lookups: (index name, key) tuples to intersect.
+
+        :returns: A list of Node objects, sorted by node ID.
+        '''
+        with self._node_index_lock:
+            # The indexes only cover decoded data
+            for node_id in list(self._pending_nodes):
+                self._applyPendingNode(node_id)
+            ids = None
+            for name, key in lookups:
+                found = self._node_index.get(name, key)
+                ids = set(found) if ids is None else ids & found
+                if not ids:
+                    break
+            nodes = [self._cached_nodes.get(i) for i in sorted(ids or ())]
+            nodes = [n for n in nodes if n is not None and predicate(n)]
+            if self.verify_node_index:
+                nodes = self._verifyIndexedNodes(nodes, predicate, lookups)
+        return nodes
+
+    def _verifyIndexedNodes(self, nodes, predicate, lookups):
+        '''
+        Compare an index lookup result against a full scan of the cache.
+
+        Must be called with the node index lock held.
+
+        :returns: The result of the index lookup, so that the callers
+            keep exercising the index.
+        '''
+        expected = sorted((n for n in self._cached_nodes.values()
+                           if predicate(n)), key=lambda n: n.id)
+        indexed_ids = [n.id for n in nodes]
+        expected_ids = [n.id for n in expected]
+        if indexed_ids != expected_ids:
+            self.node_index_mismatches += 1
+            self.log.error("Node index mismatch for %s: indexed %s, "
+                           "expected %s", lookups, indexed_ids, expected_ids)
+        return nodes
+
+    def _bulkRead(self, method, paths):
+        '''
+        Pipeline asynchronous reads of many znodes.
+
+        At most bulk_read_depth requests are outstanding at any time.
 
-    # =======================================================================
-    # Private Methods
-    # =======================================================================
+        :param method: The asynchronous client method to call per path.
+        :param list paths: The znode paths to read.
 
-    def _electionPath(self, election):
-        return "%s/%s" % (self.ELECTION_ROOT, election)
+        :returns: A list with the result of each read, in the order of the
+            given paths. The result is None for paths which do not exist.
+        '''
+        results = [None] * len(paths)
+        pending = deque()
 
-    def _imagePath(self, image):
-        return "%s/%s" % (self.IMAGE_ROOT, image)
+        def collect():
+            i, async_result = pending.popleft()
+            try:
+                results[i] = async_result.get()
+            except kze.NoNodeError:
+                pass
 
-    def _imageBuildRequestPath(self, image):
-        return "%s/request-build" % self._imagePath(image)
+        for i, path in enumerate(paths):
+            pending.append((i, method(path)))
+            if len(pending) >= self.bulk_read_depth:
+                collect()
+        while pending:
+            collect()
+        return results
 
-    def _imageBuildsPath(self, image):
-        return "%s/builds" % self._imagePath(image)
+    def _bulkGet(self, paths):
+        '''
+        Get the data of many znodes.
 
-    def _imageBuildLockPath(self, image):
-        return "%s/lock" % self._imageBuildsPath(image)
+        :returns: A list of (data, stat) tuples (or None if the znode does
+            not exist), in the order of the given paths.
+        '''
+        return self._bulkRead(self.client.get_async, paths)
 
-    def _imageBuildNumberLockPath(self, image, build_number):
-        return "%s/%s/lock" % (self._imageBuildsPath(image),
-                               build_number)
+    def _bulkGetChildren(self, paths):
+        '''
+        Get the children of many znodes.
 
-    def _imageProviderPath(self, image, build_number):
-        return "%s/%s/providers" % (self._imageBuildsPath(image),
-                                    build_number)
+        Lock znodes are left out of the result.
 
-    def _imageUploadPath(self, image, build_number, provider):
-        return "%s/%s/providers/%s/images" % (self._imageBuildsPath(image),
-                                              build_number,
-                                              provider)
+        :returns: A list of lists of child names, in the order of the given
+            paths. The list is empty if the znode does not exist.
+        '''
+        return [[c for c in children or [] if c != 'lock'] for children in
+                self._bulkRead(self.client.get_children_async, paths)]
 
-    def _imageUploadLockPath(self, image, build_number, provider):
-        return "%s/lock" % self._imageUploadPath(image, build_number,
-                                                 provider)
+    def _bytesToDict(self, data):
+        if data.startswith(CompactEncoding.MAGIC):
+            return CompactEncoding.decode(data)
+        return json.loads(data.decode('utf8'))
 
-    def _launcherPath(self, launcher):
-        return "%s/%s" % (self.LAUNCHER_ROOT, launcher)
+    def setEncoding(self, name):
+        '''
+        Set the encoding used to write nodes and node requests.
 
-    def _nodePath(self, node):
-        return "%s/%s" % (self.NODE_ROOT, node)
+        Data is always read in any supported encoding.
 
-    def _nodeLockPath(self, node):
-        return "%s/%s/lock" % (self.NODE_ROOT, node)
+        :param str name: The encoding name (one of ENCODINGS).
+        '''
+        self.encoding = ENCODINGS[name]
 
-    def _requestPath(self, request):
-        return "%s/%s" % (self.REQUEST_ROOT, request)
+    def setNodeBuckets(self, count):
+        '''
+        Set the number of buckets new nodes are spread across.
 
-    def _requestLockPath(self, request):
-        return "%s/%s" % (self.REQUEST_LOCK_ROOT, request)
+        Nodes are always read from both the flat and the bucketed layout.
 
-    def _bytesToDict(self, data):
-        return json.loads(data.decode('utf8'))
+        :param int count: The number of node buckets, or 0 to create nodes
+            directly below NODE_ROOT.
+        '''
+        if not 0 <= count <= self.MAX_NODE_BUCKETS:
+            raise ValueError("Number of node buckets must be between 0 "
+                             "and %s" % self.MAX_NODE_BUCKETS)
+        self.node_buckets = count
 
     def _getImageBuildLock(self, image, blocking=True, timeout=None):
         lock_path = self._imageBuildLockPath(image)
@@ -859,6 +2012,8 @@ class ZooKeeper(object):
         if state == KazooState.LOST:
             self.log.debug("ZooKeeper connection: LOST")
             self._became_lost = True
+            # Our ephemeral launcher registrations are gone with the session
+            self._registered_launchers.clear()
         elif state == KazooState.SUSPENDED:
             self.log.debug("ZooKeeper connection: SUSPENDED")
         else:
@@ -917,7 +2072,8 @@ class ZooKeeper(object):
         '''
         if self.client is None:
             hosts = buildZooKeeperHosts(host_list)
-            self.client = KazooClient(hosts=hosts, read_only=read_only)
+            self.client = InstrumentedClient(
+                KazooClient(hosts=hosts, read_only=read_only), self.stats)
             self.client.add_listener(self._connection_listener)
             # Manually retry initial connection attempt
             while True:
@@ -938,6 +2094,18 @@ class ZooKeeper(object):
                 self._request_cache.listen(self.requestCacheListener)
                 self._request_cache.start()
 
+                self._launcher_cache = TreeCache(self.client,
+                                                 self.LAUNCHER_ROOT)
+                self._launcher_cache.listen_fault(self.cacheFaultListener)
+                self._launcher_cache.listen(self.launcherCacheListener)
+                self._launcher_cache.start()
+
+            if self.enable_image_cache:
+                self._image_cache = TreeCache(self.client, self.IMAGE_ROOT)
+                self._image_cache.listen_fault(self.cacheFaultListener)
+                self._image_cache.listen(self.imageCacheListener)
+                self._image_cache.start()
+
     def disconnect(self):
         '''
         Close the ZooKeeper cluster connection.
@@ -949,10 +2117,24 @@ class ZooKeeper(object):
         if self._node_cache is not None:
             self._node_cache.close()
             self._node_cache = None
+            self._node_cache_initialized = False
+            self._cache_initialized_event.clear()
+            self._node_lock_contenders = {}
 
         if self._request_cache is not None:
             self._request_cache.close()
             self._request_cache = None
+            self._request_cache_initialized = False
+
+        if self._launcher_cache is not None:
+            self._launcher_cache.close()
+            self._launcher_cache = None
+            self._launcher_cache_initialized = False
+
+        if self._image_cache is not None:
+            self._image_cache.close()
+            self._image_cache = None
+            self._image_cache_initialized = False
 
         if self.client is not None and self.client.connected:
             self.client.stop()
@@ -971,6 +2153,115 @@ class ZooKeeper(object):
             hosts = buildZooKeeperHosts(host_list)
             self.client.set_hosts(hosts=hosts)
 
+    def _checkCacheInitialized(self):
+        if self._node_cache_initialized and self._request_cache_initialized:
+            self._cache_initialized_event.set()
+
+    def waitForCacheInitialization(self, timeout=None):
+        '''
+        Wait for the node and node request caches to finish their initial
+        sync.
+
+        :param float timeout: Seconds to wait at most, or None to wait
+            forever.
+
+        :returns: True if the caches are initialized (or disabled).
+        '''
+        if not self.enable_cache:
+            return True
+        return self._cache_initialized_event.wait(timeout)
+
+    def saveCacheSnapshot(self, path):
+        '''
+        Write the cached nodes and node requests to a local file.
+
+        Nothing is written unless the caches are initialized. Nodes and
+        requests locked by us are left out since they may have been
+        modified in-place.
+
+        :param str path: The snapshot file.
+
+        :returns: True if the snapshot was written.
+        '''
+        if not (self.enable_cache and self._cache_initialized_event.is_set()):
+            return False
+
+        def entries(objs):
+            return dict((o.id, {'stat': list(o.stat), 'data': o.toDict()})
+                        for o in objs if not o.lock and o.stat)
+
+        with self._node_index_lock:
+            for node_id in list(self._pending_nodes):
+                self._applyPendingNode(node_id)
+            nodes = entries(list(self._cached_nodes.values()))
+        requests = entries(list(self._cached_node_requests.values()))
+
+        snapshot = {
+            'version': self.CACHE_SNAPSHOT_VERSION,
+            'time': time.time(),
+            'nodes': nodes,
+            'requests': requests,
+        }
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, path)
+        self.log.info("Saved %s nodes and %s requests to cache snapshot %s",
+                      len(nodes), len(requests), path)
+        return True
+
+    def loadCacheSnapshot(self, path):
+        '''
+        Populate the node and node request caches from a local snapshot.
+
+        This must be called before connect(). Cached reads are served from
+        the snapshot until the caches have synced. Entries whose znode has
+        the same czxid and mzxid are kept without decoding the data again,
+        changed ones are replaced and the ones whose znode is gone are
+        dropped once the caches are initialized.
+
+        Snapshots older than cache_snapshot_max_age seconds are ignored.
+
+        :param str path: The snapshot file.
+
+        :returns: True if the snapshot was loaded.
+        '''
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return False
+        except Exception:
+            self.log.exception("Unable to read cache snapshot %s:", path)
+            return False
+
+        if snapshot.get('version') != self.CACHE_SNAPSHOT_VERSION:
+            self.log.warning("Ignoring cache snapshot %s with version %s",
+                             path, snapshot.get('version'))
+            return False
+        age = time.time() - snapshot.get('time', 0)
+        if age > self.cache_snapshot_max_age:
+            self.log.info("Ignoring cache snapshot %s from %d seconds ago",
+                          path, age)
+            return False
+
+        for root, listener, unconfirmed, key in (
+                (self.NODE_ROOT, self._nodeCacheListener,
+                 self._snapshot_nodes, 'nodes'),
+                (self.REQUEST_ROOT, self._requestCacheListener,
+                 self._snapshot_requests, 'requests')):
+            for znode_id, entry in snapshot.get(key, {}).items():
+                stat = ZnodeStat(*entry['stat'])
+                data = json.dumps(entry['data']).encode('utf8')
+                listener(TreeEvent.make(TreeEvent.NODE_ADDED, NodeData.make(
+                    '%s/%s' % (root, znode_id), data, stat)))
+                unconfirmed[znode_id] = (stat.czxid, stat.mzxid)
+
+        self.log.info("Loaded %s nodes and %s requests from cache snapshot "
+                      "%s", len(self._snapshot_nodes),
+                      len(self._snapshot_requests), path)
+        return True
+
     @contextmanager
     def imageBuildLock(self, image, blocking=True, timeout=None):
         '''
@@ -1055,6 +2346,7 @@ class ZooKeeper(object):
             if lock:
                 lock.release()
 
+    @instrumented
     def getImageNames(self):
         '''
         Retrieve the image names in Zookeeper.
@@ -1069,6 +2361,7 @@ class ZooKeeper(object):
             return []
         return sorted(images)
 
+    @instrumented
     def getBuildNumbers(self, image):
         '''
         Retrieve the builds available for an image.
@@ -1086,6 +2379,7 @@ class ZooKeeper(object):
         builds = [x for x in builds if x != 'lock']
         return builds
 
+    @instrumented
     def getBuildProviders(self, image, build_number):
         '''
         Retrieve the providers which have uploads for an image build.
@@ -1105,6 +2399,7 @@ class ZooKeeper(object):
 
         return sorted(providers)
 
+    @instrumented
     def getImageUploadNumbers(self, image, build_number, provider):
         '''
         Retrieve upload numbers for a provider and image build.
@@ -1126,6 +2421,7 @@ class ZooKeeper(object):
         uploads = [x for x in uploads if x != 'lock']
         return uploads
 
+    @instrumented
     def getBuild(self, image, build_number):
         '''
         Retrieve the image build data.
@@ -1146,6 +2442,7 @@ class ZooKeeper(object):
         d.stat = stat
         return d
 
+    @instrumented
     def getBuilds(self, image, states=None):
         '''
         Retrieve all image build data matching any given states.
@@ -1164,11 +2461,18 @@ class ZooKeeper(object):
         except kze.NoNodeError:
             return []
 
+        # skip the build lock node
+        builds = [b for b in builds if b != 'lock']
+        paths = ["%s/%s" % (path, b) for b in builds]
+
         matches = []
-        for build in builds:
-            if build == 'lock':   # skip the build lock node
-                continue
-            data = self.getBuild(image, build)
+        for build, result in zip(builds, self._bulkGet(paths)):
+            if result is None:
+                data = None
+            else:
+                data = ImageBuild.fromDict(self._bytesToDict(result[0]),
+                                           build)
+                data.stat = result[1]
             if states is None:
                 matches.append(data)
             elif data and data.state in states:
@@ -1176,6 +2480,7 @@ class ZooKeeper(object):
 
         return matches
 
+    @instrumented
     def getMostRecentBuilds(self, count, image, state=None):
         '''
         Retrieve the most recent image build data with the given state.
@@ -1202,6 +2507,7 @@ class ZooKeeper(object):
         builds.sort(key=lambda x: x.state_time, reverse=True)
         return builds[:count]
 
+    @instrumented
     def storeBuild(self, image, build_data, build_number=None):
         '''
         Store the image build data.
@@ -1239,6 +2545,7 @@ class ZooKeeper(object):
 
         return build_number
 
+    @instrumented
     def getImageUpload(self, image, build_number, provider, upload_number):
         '''
         Retrieve the image upload data.
@@ -1268,6 +2575,7 @@ class ZooKeeper(object):
         d.stat = stat
         return d
 
+    @instrumented
     def getUploads(self, image, build_number, provider, states=None):
         '''
         Retrieve all image upload data matching any given states.
@@ -1288,13 +2596,17 @@ class ZooKeeper(object):
         except kze.NoNodeError:
             return []
 
+        uploads = [u for u in uploads if u != 'lock']
+        paths = ["%s/%s" % (path, u) for u in uploads]
+
         matches = []
-        for upload in uploads:
-            if upload == 'lock':
-                continue
-            data = self.getImageUpload(image, build_number, provider, upload)
-            if not data:
+        for upload, result in zip(uploads, self._bulkGet(paths)):
+            if result is None:
                 continue
+            data = ImageUpload.fromDict(self._bytesToDict(result[0]),
+                                        build_number, provider, image,
+                                        upload)
+            data.stat = result[1]
             if states is None:
                 matches.append(data)
             elif data.state in states:
@@ -1302,6 +2614,54 @@ class ZooKeeper(object):
 
         return matches
 
+    @instrumented
+    def getAllImageUploads(self, images=None):
+        '''
+        Retrieve the data of all image uploads.
+
+        The whole image tree is read level by level, pipelining the reads
+        of each level.
+
+        :param list images: The image names to get uploads for. Defaults to
+            all images.
+
+        :returns: A list of ImageUpload objects.
+        '''
+        if images is None:
+            images = self.getImageNames()
+
+        builds = []
+        for image, build_numbers in zip(images, self._bulkGetChildren(
+                [self._imageBuildsPath(i) for i in images])):
+            builds.extend((image, b) for b in build_numbers)
+
+        providers = []
+        for (image, build), provider_names in zip(
+                builds, self._bulkGetChildren(
+                    [self._imageProviderPath(i, b) for i, b in builds])):
+            providers.extend((image, build, p) for p in sorted(provider_names))
+
+        uploads = []
+        for (image, build, provider), upload_numbers in zip(
+                providers, self._bulkGetChildren(
+                    [self._imageUploadPath(*p) for p in providers])):
+            uploads.extend((image, build, provider, u)
+                           for u in upload_numbers)
+
+        paths = ["%s/%s" % (self._imageUploadPath(i, b, p), u)
+                 for i, b, p, u in uploads]
+        objs = []
+        for (image, build, provider, upload), result in zip(
+                uploads, self._bulkGet(paths)):
+            if result is None:
+                continue
+            data = ImageUpload.fromDict(self._bytesToDict(result[0]),
+                                        build, provider, image, upload)
+            data.stat = result[1]
+            objs.append(data)
+        return objs
+
+    @instrumented
     def getMostRecentBuildImageUploads(self, count, image, build_number,
                                        provider, state=None):
         '''
@@ -1330,41 +2690,54 @@ class ZooKeeper(object):
         uploads.sort(key=lambda x: x.state_time, reverse=True)
         return uploads[:count]
 
+    @instrumented
     def getMostRecentImageUpload(self, image, provider,
-                                 state=READY):
+                                 state=READY, cached=True):
         '''
         Retrieve the most recent image upload data with the given state.
 
         :param str image: The image name.
         :param str provider: The provider name owning the image.
         :param str state: The image upload state to match on.
+        :param bool cached: True if the data should be taken from the image
+            cache, if enabled and initialized.
 
         :returns: An ImageUpload object matching the given state, or
             None if there is no recent upload.
         '''
-
+        if cached and self._image_cache_initialized:
+            upload = self._latest_image_uploads.get((image, provider, state))
+            # A miss is double-checked against ZooKeeper since the cache
+            # might not have seen a just finished upload yet.
+            if upload is not None:
+                return upload
+
+        builds = self.getBuildNumbers(image)
+        uploads = []
+        for build_number, upload_numbers in zip(builds, self._bulkGetChildren(
+                [self._imageUploadPath(image, b, provider) for b in builds])):
+            uploads.extend((build_number, u) for u in upload_numbers)
+
+        paths = ["%s/%s" % (self._imageUploadPath(image, b, provider), u)
+                 for b, u in uploads]
         recent_data = None
-        for build_number in self.getBuildNumbers(image):
-            path = self._imageUploadPath(image, build_number, provider)
-
-            try:
-                uploads = self.client.get_children(path)
-            except kze.NoNodeError:
-                uploads = []
-
-            for upload in uploads:
-                if upload == 'lock':   # skip the upload lock node
-                    continue
-                data = self.getImageUpload(
-                    image, build_number, provider, upload)
-                if not data or data.state != state:
-                    continue
-                elif (recent_data is None or
-                      recent_data.state_time < data.state_time):
-                    recent_data = data
+        for (build_number, upload), result in zip(uploads,
+                                                  self._bulkGet(paths)):
+            if result is None:
+                continue
+            data = ImageUpload.fromDict(self._bytesToDict(result[0]),
+                                        build_number, provider, image,
+                                        upload)
+            data.stat = result[1]
+            if data.state != state:
+                continue
+            elif (recent_data is None or
+                  recent_data.state_time < data.state_time):
+                recent_data = data
 
         return recent_data
 
+    @instrumented
     def storeImageUpload(self, image, build_number, provider, image_data,
                          upload_number=None):
         '''
@@ -1415,6 +2788,7 @@ class ZooKeeper(object):
 
         return upload_number
 
+    @instrumented
     def hasBuildRequest(self, image):
         '''
         Check if an image has a pending build request.
@@ -1428,6 +2802,7 @@ class ZooKeeper(object):
             return True
         return False
 
+    @instrumented
     def submitBuildRequest(self, image):
         '''
         Submit a request for a new image build.
@@ -1437,6 +2812,7 @@ class ZooKeeper(object):
         path = self._imageBuildRequestPath(image)
         self.client.ensure_path(path)
 
+    @instrumented
     def removeBuildRequest(self, image):
         '''
         Remove an image build request.
@@ -1449,6 +2825,7 @@ class ZooKeeper(object):
         except kze.NoNodeError:
             pass
 
+    @instrumented
     def deleteBuild(self, image, build_number):
         '''
         Delete an image build from ZooKeeper.
@@ -1478,6 +2855,7 @@ class ZooKeeper(object):
 
         return True
 
+    @instrumented
     def deleteUpload(self, image, build_number, provider, upload_number):
         '''
         Delete an image upload from ZooKeeper.
@@ -1494,59 +2872,97 @@ class ZooKeeper(object):
         except kze.NoNodeError:
             pass
 
+    @instrumented
     def registerLauncher(self, launcher):
         '''
         Register an active node launcher.
 
         The launcher is automatically de-registered once it terminates or
         otherwise disconnects from ZooKeeper. It will need to re-register
-        after a lost connection. This method is safe to call multiple times.
+        after a lost connection. This method is safe to call multiple times
+        and only writes to ZooKeeper if the registration changed since the
+        last call.
 
         :param Launcher launcher: Object describing the launcher.
         '''
+        data = launcher.serialize()
+        if (self._registered_launchers.get(launcher.id) == data and
+                (not self.enable_cache or
+                 launcher.id in self._cached_launchers)):
+            # Nothing changed and the registration still exists
+            return
+
         path = self._launcherPath(launcher.id)
 
         if self.client.exists(path):
-            data, _ = self.client.get(path)
-            obj = Launcher.fromDict(self._bytesToDict(data))
+            current, _ = self.client.get(path)
+            obj = Launcher.fromDict(self._bytesToDict(current))
             if obj != launcher:
-                self.client.set(path, launcher.serialize())
+                self.client.set(path, data)
                 self.log.debug("Updated registration for launcher %s",
                                launcher.id)
         else:
-            self.client.create(path, value=launcher.serialize(),
+            self.client.create(path, value=data,
                                makepath=True, ephemeral=True)
             self.log.debug("Registered launcher %s", launcher.id)
 
-    def getRegisteredLaunchers(self):
+        self._registered_launchers[launcher.id] = data
+        if self.enable_cache:
+            # Don't wait for the launcher cache to see our own registration
+            self._cached_launchers[launcher.id] = Launcher.fromDict(
+                launcher.toDict())
+
+    @instrumented
+    def getRegisteredLaunchers(self, cached=True):
         '''
         Get a list of all launchers that have registered with ZooKeeper.
 
+        :param bool cached: True if the launchers should be taken from the
+            launcher cache, if enabled and initialized.
+
         :returns: A list of Launcher objects, or empty list if none are found.
         '''
+        if cached and self.enable_cache:
+            if self._launcher_cache_initialized:
+                self.stats.recordCache('launchers', 'hit')
+                return list(self._cached_launchers.values())
+            self.stats.recordCache('launchers', 'fallback')
+
         try:
             launcher_ids = self.client.get_children(self.LAUNCHER_ROOT)
         except kze.NoNodeError:
             return []
 
         objs = []
-        for launcher in launcher_ids:
-            path = self._launcherPath(launcher)
-            try:
-                data, _ = self.client.get(path)
-            except kze.NoNodeError:
+        for result in self._bulkGet(
+                [self._launcherPath(x) for x in launcher_ids]):
+            if result is None:
                 # launcher disappeared
                 continue
-
-            objs.append(Launcher.fromDict(self._bytesToDict(data)))
+            objs.append(Launcher.fromDict(self._bytesToDict(result[0])))
         return objs
 
-    def getNodeRequests(self):
+    @instrumented
+    def getNodeRequests(self, cached=False):
         '''
         Get the current list of all node requests in priority sorted order.
 
+        :param bool cached: True if the list should be taken from the
+            request cache. While the cache is still initializing this falls
+            back to querying ZooKeeper.
+
         :returns: A list of request nodes.
         '''
+        if cached and self.enable_cache:
+            if self._request_cache_initialized:
+                self.stats.recordCache('requests', 'hit')
+                requests = self._request_cache.get_children(self.REQUEST_ROOT)
+                return sorted(requests or ())
+            self.request_cache_fallbacks += 1
+            self.stats.recordCache('requests', 'fallback')
+            self.log.debug("Request cache not initialized, listing "
+                           "requests from ZooKeeper")
+
         try:
             requests = self.client.get_children(self.REQUEST_ROOT)
         except kze.NoNodeError:
@@ -1554,6 +2970,7 @@ class ZooKeeper(object):
 
         return sorted(requests)
 
+    @instrumented
     def getNodeRequestLockIDs(self):
         '''
         Get the current list of all node request lock ids.
@@ -1564,6 +2981,7 @@ class ZooKeeper(object):
             return []
         return lock_ids
 
+    @instrumented
     def getNodeRequestLockStats(self, lock_id):
         '''
         Get the data for a specific node request lock.
@@ -1585,6 +3003,7 @@ class ZooKeeper(object):
         d.stat = stat
         return d
 
+    @instrumented
     def deleteNodeRequestLock(self, lock_id):
         '''
         Delete the znode for a node request lock id.
@@ -1597,6 +3016,7 @@ class ZooKeeper(object):
         except kze.NoNodeError:
             pass
 
+    @instrumented
     def getNodeRequest(self, request, cached=False):
         '''
         Get the data for a specific node request.
@@ -1608,6 +3028,8 @@ class ZooKeeper(object):
         '''
         if cached:
             d = self._cached_node_requests.get(request)
+            self._recordCachedRead('requests', d,
+                                   self._request_cache_initialized)
             if d:
                 return d
 
@@ -1626,6 +3048,7 @@ class ZooKeeper(object):
         d.stat = stat
         return d
 
+    @instrumented
     def updateNodeRequest(self, request):
         '''
         Update the data of a node request object in-place
@@ -1644,32 +3067,57 @@ class ZooKeeper(object):
         request.updateFromDict(d)
         request.stat = stat
 
-    def storeNodeRequest(self, request, priority="100"):
+    def _setVersioned(self, path, data, obj, check_version):
+        '''
+        Set the data of an existing znode, optionally only if it still has
+        the version we last saw.
+
+        :returns: The stat of the updated znode.
+        :raises: ZKVersionException if the znode was modified since.
+        '''
+        version = -1
+        if check_version and obj.stat is not None:
+            version = obj.stat.version
+        try:
+            return self.client.set(path, data, version=version)
+        except kze.BadVersionError:
+            raise npe.ZKVersionException(
+                "%s was modified since version %s" % (path, version))
+
+    @instrumented
+    def storeNodeRequest(self, request, priority="100", check_version=False):
         '''
         Store a new or existing node request.
 
         :param NodeRequest request: The node request to update.
         :param str priority: Priority of a new request. Ignored on updates.
+        :param bool check_version: If True, only update an existing request
+            if it was not modified since it was read.
+
+        :raises: ZKVersionException if check_version is True and the
+            request was modified in the meantime.
         '''
         if not request.id:
             path = "%s/%s-" % (self.REQUEST_ROOT, priority)
             path = self.client.create(
                 path,
-                value=request.serialize(),
+                value=self.encoding.encode(request),
                 ephemeral=True,
                 sequence=True,
                 makepath=True)
             request.id = path.split("/")[-1]
 
-        # Validate it still exists before updating
         else:
-            if not self.getNodeRequest(request.id):
+            path = self._requestPath(request.id)
+            try:
+                request.stat = self._setVersioned(
+                    path, self.encoding.encode(request), request,
+                    check_version)
+            except kze.NoNodeError:
                 raise Exception(
                     "Attempt to update non-existing request %s" % request)
 
-            path = self._requestPath(request.id)
-            self.client.set(path, request.serialize())
-
+    @instrumented
     def deleteNodeRequest(self, request):
         '''
         Delete a node request.
@@ -1685,6 +3133,7 @@ class ZooKeeper(object):
         except kze.NoNodeError:
             pass
 
+    @instrumented
     def lockNodeRequest(self, request, blocking=True, timeout=None):
         '''
         Lock a node request.
@@ -1725,6 +3174,7 @@ class ZooKeeper(object):
         # Do an in-place update of the node request so we have the latest data
         self.updateNodeRequest(request)
 
+    @instrumented
     def unlockNodeRequest(self, request):
         '''
         Unlock a node request.
@@ -1741,6 +3191,7 @@ class ZooKeeper(object):
         request.lock.release()
         request.lock = None
 
+    @instrumented
     def lockNode(self, node, blocking=True, timeout=None):
         '''
         Lock a node.
@@ -1781,6 +3232,7 @@ class ZooKeeper(object):
         # Do an in-place update of the node so we have the latest data.
         self.updateNode(node)
 
+    @instrumented
     def unlockNode(self, node):
         '''
         Unlock a node.
@@ -1796,17 +3248,48 @@ class ZooKeeper(object):
         node.lock.release()
         node.lock = None
 
-    def getNodes(self):
+    @instrumented
+    def getNodes(self, cached=False):
         '''
         Get the current list of all nodes.
 
+        :param bool cached: True if the list should be taken from the node
+            cache. While the cache is still initializing this falls back to
+            querying ZooKeeper.
+
         :returns: A list of nodes.
         '''
+        if cached and self.enable_cache:
+            if self._node_cache_initialized:
+                self.stats.recordCache('nodes', 'hit')
+                nodes = []
+                children = self._node_cache.get_children(self.NODE_ROOT)
+                for child in children or ():
+                    if self._isNodeBucket(child):
+                        nodes.extend(self._node_cache.get_children(
+                            "%s/%s" % (self.NODE_ROOT, child)) or ())
+                    else:
+                        nodes.append(child)
+                return sorted(nodes)
+            self.node_cache_fallbacks += 1
+            self.stats.recordCache('nodes', 'fallback')
+            self.log.debug("Node cache not initialized, listing nodes "
+                           "from ZooKeeper")
+
         try:
-            return self.client.get_children(self.NODE_ROOT)
+            children = self.client.get_children(self.NODE_ROOT)
         except kze.NoNodeError:
             return []
-
+        buckets = [c for c in children if self._isNodeBucket(c)]
+        if not buckets:
+            return children
+        nodes = [c for c in children if not self._isNodeBucket(c)]
+        for bucket_nodes in self._bulkGetChildren(
+                ["%s/%s" % (self.NODE_ROOT, b) for b in buckets]):
+            nodes.extend(bucket_nodes)
+        return nodes
+
+    @instrumented
     def getNode(self, node, cached=False):
         '''
         Get the data for a specific node.
@@ -1817,7 +3300,8 @@ class ZooKeeper(object):
         :returns: The node data, or None if the node was not found.
         '''
         if cached:
-            d = self._cached_nodes.get(node)
+            d = self._getCachedNode(node)
+            self._recordCachedRead('nodes', d, self._node_cache_initialized)
             if d:
                 return d
 
@@ -1840,6 +3324,7 @@ class ZooKeeper(object):
         d.stat = stat
         return d
 
+    @instrumented
     def updateNode(self, node):
         '''
         Update the data of a node object in-place
@@ -1858,8 +3343,10 @@ class ZooKeeper(object):
 
         node.updateFromDict(d)
         node.stat = stat
+        self._reindexNode(node)
 
-    def storeNode(self, node):
+    @instrumented
+    def storeNode(self, node, check_version=False):
         '''
         Store an new or existing node.
 
@@ -1868,9 +3355,14 @@ class ZooKeeper(object):
         update.
 
         :param Node node: The Node object to store.
+        :param bool check_version: If True, only update an existing node if
+            it was not modified since it was read.
+
+        :raises: ZKVersionException if check_version is True and the node
+            was modified in the meantime.
         '''
         if not node.id:
-            node_path = "%s/" % self.NODE_ROOT
+            node_path = self._newNodePath()
 
             # We expect a new node to always have a state already set, so
             # use that state_time for created_time for consistency. But have
@@ -1882,14 +3374,60 @@ class ZooKeeper(object):
 
             path = self.client.create(
                 node_path,
-                value=node.serialize(),
+                value=self.encoding.encode(node),
                 sequence=True,
                 makepath=True)
             node.id = path.split("/")[-1]
         else:
             path = self._nodePath(node.id)
-            self.client.set(path, node.serialize())
+            node.stat = self._setVersioned(
+                path, self.encoding.encode(node), node, check_version)
+            self._reindexNode(node)
+
+    @instrumented
+    def modifyNode(self, node, modify, attempts=5):
+        '''
+        Modify a node without locking it.
+
+        A copy of the node is passed to ``modify``, which changes it in
+        place and returns True if it should be stored. The copy is stored
+        only if the node was not modified since it was read. Otherwise, the
+        node is read again and ``modify`` is called with the fresh data.
+
+        This is meant for simple field updates. A holder of the node lock
+        which stores the node without checking its version overwrites the
+        change.
+
+        :param Node node: The node to modify. It is not changed itself.
+        :param modify: A callable taking the Node copy.
+        :param int attempts: The number of attempts before giving up.
+
+        :returns: The stored copy, or None if ``modify`` returned False or
+            the node no longer exists.
+        :raises: ZKVersionException if every attempt conflicted.
+        '''
+        current = node
+        for attempt in range(attempts):
+            if current is None or current.stat is None:
+                current = self.getNode(node.id)
+                if current is None:
+                    return None
+            modified = Node.fromDict(current.toDict(), current.id)
+            modified.stat = current.stat
+            if not modify(modified):
+                return None
+            try:
+                self.storeNode(modified, check_version=True)
+            except npe.ZKVersionException:
+                current = None
+                continue
+            except kze.NoNodeError:
+                return None
+            return modified
+        raise npe.ZKVersionException(
+            "Unable to modify node %s after %s attempts" % (node.id, attempts))
 
+    @instrumented
     def deleteRawNode(self, node_id):
         '''
         Delete a znode for a Node.
@@ -1904,6 +3442,7 @@ class ZooKeeper(object):
         except kze.NoNodeError:
             pass
 
+    @instrumented
     def deleteNode(self, node):
         '''
         Delete a node.
@@ -1913,15 +3452,35 @@ class ZooKeeper(object):
         if not node.id:
             return
 
+        # Delete the node and its lock at once if nobody else is contending
+        # for the lock.
+        try:
+            txn = self.transaction()
+            txn.deleteNode(node)
+            txn.commit()
+            return
+        except npe.ZKTransactionException:
+            self.log.debug("Unable to delete node %s in a transaction",
+                           node.id)
+
         path = self._nodePath(node.id)
 
         # Set the node state to deleted before we start deleting
         # anything so that we can detect a race condition where the
         # lock is removed before the node deletion occurs.
         node.state = DELETED
-        self.client.set(path, node.serialize())
+        self.client.set(path, self.encoding.encode(node))
         self.deleteRawNode(node.id)
 
+    def transaction(self):
+        '''
+        Start a new transaction.
+
+        :returns: A ZooKeeperTransaction object.
+        '''
+        return ZooKeeperTransaction(self)
+
+    @instrumented
     def getReadyNodesOfTypes(self, labels, cached=True):
         '''
         Query ZooKeeper for unused/ready nodes.
@@ -1934,6 +3493,16 @@ class ZooKeeper(object):
             those labels.
         '''
         ret = {}
+        if self._useNodeIndex(cached):
+            for label in labels:
+                nodes = self._getIndexedNodes(
+                    lambda n: (n.state == READY and not n.allocated_to and
+                               label in n.type),
+                    ('state', READY), ('label', label))
+                if nodes:
+                    ret[label] = nodes
+            return ret
+
         for node in self.nodeIterator(cached=cached):
             if node.state != READY or node.allocated_to:
                 continue
@@ -1944,6 +3513,7 @@ class ZooKeeper(object):
                     ret[label].append(node)
         return ret
 
+    @instrumented
     def deleteOldestUnusedNode(self, provider_name, pool_name):
         '''
         Deletes the oldest unused (READY+unlocked) node for a provider's pool.
@@ -1967,18 +3537,17 @@ class ZooKeeper(object):
         MAX_DELETE_AGE = 5 * 60
 
         candidates = []
-        for node in self.nodeIterator():
-            if node.provider == provider_name and node.pool == pool_name:
-                # A READY node that has been allocated will not be considered
-                # a candidate at this point. If allocated_to gets reset during
-                # the cleanup phase b/c the request disappears, then it can
-                # become a candidate.
-                if node.state == READY and not node.allocated_to:
-                    candidates.append(node)
-                elif (node.state == DELETING and
-                      (time.time() - node.state_time / 1000) < MAX_DELETE_AGE
-                ):
-                    return False
+        for node in self.getProviderNodes(provider_name, pool_name):
+            # A READY node that has been allocated will not be considered
+            # a candidate at this point. If allocated_to gets reset during
+            # the cleanup phase b/c the request disappears, then it can
+            # become a candidate.
+            if node.state == READY and not node.allocated_to:
+                candidates.append(node)
+            elif (node.state == DELETING and
+                  (time.time() - node.state_time / 1000) < MAX_DELETE_AGE
+            ):
+                return False
 
         candidates.sort(key=lambda n: n.state_time)
         for node in candidates:
@@ -2010,13 +3579,49 @@ class ZooKeeper(object):
 
         return False
 
-    def nodeIterator(self, cached=True):
+    def isNodeLocked(self, node, cached=True):
+        '''
+        Check whether a node is locked, without trying to lock it.
+
+        A node counts as locked if there is any contender for its lock.
+
+        :param Node node: The node to check.
+        :param bool cached: True if the lock state should be taken from the
+            cache, if it is initialized.
+        '''
+        return self.getNodeLockStates([node.id], cached=cached)[node.id]
+
+    @instrumented
+    def getNodeLockStates(self, node_ids, cached=True):
+        '''
+        Check whether nodes are locked, without trying to lock them.
+
+        :param list node_ids: The IDs of the nodes to check.
+        :param bool cached: True if the lock states should be taken from the
+            cache, if it is initialized.
+
+        :returns: A dict mapping each node ID to True if it is locked.
+        '''
+        if cached and self.enable_cache:
+            if self._node_cache_initialized:
+                self.stats.recordCache('node-locks', 'hit')
+                return dict((node_id, bool(self._node_lock_contenders.get(
+                    node_id))) for node_id in node_ids)
+            self.stats.recordCache('node-locks', 'fallback')
+        results = self._bulkRead(self.client.get_children_async,
+                                 [self._nodeLockPath(x) for x in node_ids])
+        return dict((node_id, bool(children))
+                    for node_id, children in zip(node_ids, results))
+
+    def nodeIterator(self, cached=True, cached_ids=False):
         '''
         Utility generator method for iterating through all nodes.
 
         :param bool cached: True if the data should be taken from the cache.
+        :param bool cached_ids: True if the node IDs should be taken from the
+            cache as well.
         '''
-        for node_id in self.getNodes():
+        for node_id in self.getNodes(cached=cached_ids):
             node = self.getNode(node_id, cached=cached)
             if node:
                 yield node
@@ -2025,16 +3630,54 @@ class ZooKeeper(object):
         '''
         Utility generator method for iterating through all nodes request locks.
         '''
-        for lock_id in self.getNodeRequestLockIDs():
-            lock_stats = self.getNodeRequestLockStats(lock_id)
-            if lock_stats:
-                yield lock_stats
+        lock_ids = self.getNodeRequestLockIDs()
+        for lock_id, result in zip(lock_ids, self._bulkGet(
+                [self._requestLockPath(x) for x in lock_ids])):
+            if result is None:
+                continue
+            lock_stats = NodeRequestLockStats(lock_id)
+            lock_stats.stat = result[1]
+            yield lock_stats
+
+    def nodeRequestQueueIterator(self):
+        '''
+        Utility generator method for iterating through all node requests
+        in REQUESTED state, in the order they should be handled.
+
+        The requests are taken from the request cache and must be locked
+        and checked again before being acted upon. Requests changing state
+        while iterating are skipped.
+        '''
+        if not (self.enable_cache and self._request_cache_initialized):
+            self.request_cache_fallbacks += 1
+            self.stats.recordCache('requests', 'fallback')
+            requests = [r for r in self.nodeRequestIterator()
+                        if r.state == REQUESTED]
+            requests.sort(key=lambda r: NodeRequestQueue.sortKey(
+                r.id, r.relative_priority))
+            for req in requests:
+                yield req
+            return
+
+        key = None
+        while True:
+            with self._request_queue_lock:
+                key = self._request_queue.next(key)
+            if key is None:
+                return
+            req = self._cached_node_requests.get(key[-1])
+            if req and req.state == REQUESTED:
+                yield req
 
-    def nodeRequestIterator(self, cached=True):
+    def nodeRequestIterator(self, cached=True, cached_ids=False):
         '''
         Utility generator method for iterating through all nodes requests.
+
+        :param bool cached: True if the data should be taken from the cache.
+        :param bool cached_ids: True if the request IDs should be taken from
+            the cache as well.
         '''
-        for req_id in self.getNodeRequests():
+        for req_id in self.getNodeRequests(cached=cached_ids):
             req = self.getNodeRequest(req_id, cached=cached)
             if req:
                 yield req
@@ -2046,12 +3689,9 @@ class ZooKeeper(object):
         :param str provider_name: The provider name.
         :param str pool_name: The pool name.
         '''
-        count = 0
-        for node in self.nodeIterator():
-            if node.provider == provider_name and node.pool == pool_name:
-                count = count + 1
-        return count
+        return len(self.getProviderNodes(provider_name, pool_name))
 
+    @instrumented
     def getProviderBuilds(self, provider_name):
         '''
         Get all builds for a provider for each image.
@@ -2072,19 +3712,34 @@ class ZooKeeper(object):
                         provider_builds[image].append(build)
         return provider_builds
 
-    def getProviderNodes(self, provider_name):
+    @instrumented
+    def getProviderNodes(self, provider_name, pool_name=None):
         '''
         Get all nodes for a provider.
 
         :param str provider_name: The provider name.
+        :param str pool_name: If given, only return nodes of this pool.
         :returns: A list of Node objects.
         '''
+        if not self._useNodeIndex():
+            return [n for n in self.nodeIterator()
+                    if n.provider == provider_name and
+                    (pool_name is None or n.pool == pool_name)]
+
+        if pool_name is not None:
+            pools = [(provider_name, pool_name)]
+        else:
+            with self._node_index_lock:
+                pools = [k for k in self._node_index.keys('pool')
+                         if k[0] == provider_name]
         provider_nodes = []
-        for node in self.nodeIterator():
-            if node.provider == provider_name:
-                provider_nodes.append(node)
+        for pool in pools:
+            provider_nodes.extend(self._getIndexedNodes(
+                lambda n, pool=pool: (n.provider, n.pool) == pool,
+                ('pool', pool)))
         return provider_nodes
 
+    @instrumented
     def removeProviderBuilds(self, provider_name, provider_builds):
         '''
         Remove ZooKeeper build data for a provider.
@@ -2101,6 +3756,7 @@ class ZooKeeper(object):
                 except kze.NoNodeError:
                     pass
 
+    @instrumented
     def removeProviderNodes(self, provider_name, provider_nodes):
         '''
         Remove ZooKeeper node data for a provider.
@@ -2121,14 +3777,29 @@ class ZooKeeper(object):
                                event)
 
     def _nodeCacheListener(self, event):
+        if event.event_type == TreeEvent.INITIALIZED:
+            # Nodes from the snapshot which were not seen are gone
+            for node_id in list(self._snapshot_nodes):
+                self._removeCachedNode(node_id)
+            self._snapshot_nodes.clear()
+            # From now on the node indexes are complete
+            self._node_cache_initialized = True
+            self._checkCacheInitialized()
+            return
+
         if hasattr(event.event_data, 'path'):
             # Ignore root node
             path = event.event_data.path
             if path == self.NODE_ROOT:
                 return
 
-            # Ignore lock nodes
+            # Track the lock contenders of each node
             if '/lock' in path:
+                self._nodeLockEvent(event)
+                return
+
+            # Ignore node bucket directories
+            if self._isNodeBucket(path.rsplit('/', 1)[1]):
                 return
 
         # Ignore any non-node related events such as connection events here
@@ -2140,45 +3811,157 @@ class ZooKeeper(object):
         path = event.event_data.path
         node_id = path.rsplit('/', 1)[1]
 
+        if self._confirmSnapshot(self._snapshot_nodes, node_id, event,
+                                 self._removeCachedNode):
+            return
+
         if event.event_type in (TreeEvent.NODE_ADDED, TreeEvent.NODE_UPDATED):
             # Nodes with empty data are invalid so skip add or update these.
             if not event.event_data.data:
                 return
 
-            # Perform an in-place update of the already cached node if possible
-            d = self._bytesToDict(event.event_data.data)
+            data = event.event_data.data
+            stat = event.event_data.stat
+            digest = self._nodeDigest(data)
             old_node = self._cached_nodes.get(node_id)
             if old_node:
-                if event.event_data.stat.version <= old_node.stat.version:
-                    # Don't update to older data
-                    return
-                if old_node.lock:
-                    # Don't update a locked node
+                with self._node_index_lock:
+                    pending = self._pending_nodes.get(node_id)
+                    latest = pending[1] if pending else old_node.stat
+                    version = latest.version
+                    if stat.version <= version or old_node.lock:
+                        # Don't update to older data or a locked node, but
+                        # reindex it below since it might have been
+                        # modified in-place by the holder of its lock.
+                        stale = True
+                    elif digest == self._cached_node_digests.get(node_id):
+                        # The data did not change since we decoded it
+                        self._pending_nodes.pop(node_id, None)
+                        old_node.stat = stat
+                        stale = False
+                    else:
+                        # Decode the data once somebody needs the node
+                        self._pending_nodes[node_id] = (data, stat, digest)
+                        stale = False
+                if stale:
+                    self._reindexNode(old_node)
+                    self._notifyWakeListeners(old_node)
                     return
-                old_node.updateFromDict(d)
-                old_node.stat = event.event_data.stat
+                self._notifyWakeListeners(old_node)
             else:
-                node = Node.fromDict(d, node_id)
-                node.stat = event.event_data.stat
-                self._cached_nodes[node_id] = node
+                node = Node.fromDict(self._bytesToDict(data), node_id)
+                node.stat = stat
+                with self._node_index_lock:
+                    self._cached_nodes[node_id] = node
+                    self._cached_node_digests[node_id] = digest
+                    self._node_index.update(node)
+                self._notifyWakeListeners(node)
 
             # set the stats event so the stats reporting thread can act upon it
             if self.node_stats_event is not None:
                 self.node_stats_event.set()
         elif event.event_type == TreeEvent.NODE_REMOVED:
+            old_node = self._cached_nodes.get(node_id)
+            self._removeCachedNode(node_id)
+            if old_node:
+                self._notifyWakeListeners(old_node)
+
+            # set the stats event so the stats reporting thread can act upon it
+            if self.node_stats_event is not None:
+                self.node_stats_event.set()
+
+    def _removeCachedNode(self, node_id):
+        self._node_lock_contenders.pop(node_id, None)
+        with self._node_index_lock:
             try:
                 del self._cached_nodes[node_id]
             except KeyError:
                 # If it's already gone, don't care
                 pass
+            self._pending_nodes.pop(node_id, None)
+            self._cached_node_digests.pop(node_id, None)
+            self._node_index.remove(node_id)
 
-            # set the stats event so the stats reporting thread can act upon it
-            if self.node_stats_event is not None:
-                self.node_stats_event.set()
+    def _confirmSnapshot(self, snapshot, znode_id, event, remove):
+        '''
+        Check a cache event against the znodes loaded from a snapshot.
+
+        :param dict snapshot: The unconfirmed snapshot entries, mapping
+            znode IDs to their (czxid, mzxid).
+        :param str znode_id: The ID of the znode of the event.
+        :param TreeEvent event: The cache event.
+        :param remove: A callable removing the znode from the cache.
+
+        :returns: True if the event is about an unchanged snapshot entry
+            and needs no further processing.
+        '''
+        if not snapshot:
+            return False
+        zxids = snapshot.pop(znode_id, None)
+        if zxids is None or event.event_type != TreeEvent.NODE_ADDED:
+            return False
+        stat = event.event_data.stat
+        if zxids == (stat.czxid, stat.mzxid):
+            return True
+        if zxids[0] != stat.czxid:
+            # The znode was recreated, so its version started over
+            remove(znode_id)
+        return False
+
+    def _nodeLockEvent(self, event):
+        # Only the contenders below the lock directory are of interest
+        parts = event.event_data.path[len(self.NODE_ROOT) + 1:].split('/')
+        if parts and self._isNodeBucket(parts[0]):
+            parts = parts[1:]
+        if len(parts) != 3 or parts[1] != 'lock':
+            return
+        node_id, _, contender = parts
+
+        if event.event_type == TreeEvent.NODE_ADDED:
+            self._node_lock_contenders.setdefault(node_id, set()).add(
+                contender)
+        elif event.event_type == TreeEvent.NODE_REMOVED:
+            contenders = self._node_lock_contenders.get(node_id)
+            if contenders is not None:
+                contenders.discard(contender)
+                if not contenders:
+                    del self._node_lock_contenders[node_id]
+                    node = self._cached_nodes.get(node_id)
+                    if node:
+                        self._notifyWakeListeners(node)
 
     def setNodeStatsEvent(self, event):
         self.node_stats_event = event
 
+    def addWakeListener(self, listener):
+        '''
+        Register a callable to be notified about cache changes which may
+        allow launchers to make progress.
+
+        The listener is called from the cache threads with the affected
+        object and must return quickly. It is called with a NodeRequest
+        when a request in REQUESTED state was added or updated, and with
+        a Node when a node was added, updated, unlocked or removed. Only
+        the ID, provider and pool of the node are guaranteed to be current.
+
+        :param listener: A callable taking a Node or NodeRequest.
+        '''
+        self._wake_listeners = self._wake_listeners + [listener]
+
+    def removeWakeListener(self, listener):
+        '''
+        Unregister a callable registered with addWakeListener().
+        '''
+        self._wake_listeners = [
+            x for x in self._wake_listeners if x != listener]
+
+    def _notifyWakeListeners(self, obj):
+        for listener in self._wake_listeners:
+            try:
+                listener(obj)
+            except Exception:
+                self.log.exception("Exception in wake listener for %s", obj)
+
     def requestCacheListener(self, event):
         try:
             self._requestCacheListener(event)
@@ -2188,6 +3971,15 @@ class ZooKeeper(object):
                 event)
 
     def _requestCacheListener(self, event):
+        if event.event_type == TreeEvent.INITIALIZED:
+            # Requests from the snapshot which were not seen are gone
+            for request_id in list(self._snapshot_requests):
+                self._removeCachedRequest(request_id)
+            self._snapshot_requests.clear()
+            self._request_cache_initialized = True
+            self._checkCacheInitialized()
+            return
+
         if hasattr(event.event_data, 'path'):
             # Ignore root node
             path = event.event_data.path
@@ -2207,6 +3999,10 @@ class ZooKeeper(object):
         path = event.event_data.path
         request_id = path.rsplit('/', 1)[1]
 
+        if self._confirmSnapshot(self._snapshot_requests, request_id, event,
+                                 self._removeCachedRequest):
+            return
+
         if event.event_type in (TreeEvent.NODE_ADDED, TreeEvent.NODE_UPDATED):
             # Requests with empty data are invalid so skip add or update these.
             if not event.event_data.data:
@@ -2214,6 +4010,14 @@ class ZooKeeper(object):
 
             # Perform an in-place update of the cached request if possible
             d = self._bytesToDict(event.event_data.data)
+
+            # The request queue follows the data from the event rather
+            # than the cached request which is not updated while locked.
+            with self._request_queue_lock:
+                self._request_queue.update(
+                    request_id, d.get('state'),
+                    d.get('relative_priority', 0),
+                    event.event_data.stat.version)
             old_request = self._cached_node_requests.get(request_id)
             if old_request:
                 if event.event_data.stat.version <= old_request.stat.version:
@@ -2224,17 +4028,128 @@ class ZooKeeper(object):
                     return
                 old_request.updateFromDict(d)
                 old_request.stat = event.event_data.stat
+                request = old_request
             else:
                 request = NodeRequest.fromDict(d, request_id)
                 request.stat = event.event_data.stat
                 self._cached_node_requests[request_id] = request
 
+            if request.state == REQUESTED:
+                self._notifyWakeListeners(request)
+
         elif event.event_type == TreeEvent.NODE_REMOVED:
-            try:
-                del self._cached_node_requests[request_id]
-            except KeyError:
-                # If it's already gone, don't care
-                pass
+            self._removeCachedRequest(request_id)
+
+    def _removeCachedRequest(self, request_id):
+        with self._request_queue_lock:
+            self._request_queue.remove(request_id)
+        try:
+            del self._cached_node_requests[request_id]
+        except KeyError:
+            # If it's already gone, don't care
+            pass
+
+    def launcherCacheListener(self, event):
+        try:
+            self._launcherCacheListener(event)
+        except Exception:
+            self.log.exception(
+                "Exception in launcher cache update for event: %s",
+                event)
+
+    def _launcherCacheListener(self, event):
+        if event.event_type == TreeEvent.INITIALIZED:
+            self._launcher_cache_initialized = True
+            return
+
+        # Ignore any non-node related events such as connection events here
+        if event.event_type not in (TreeEvent.NODE_ADDED,
+                                    TreeEvent.NODE_UPDATED,
+                                    TreeEvent.NODE_REMOVED):
+            return
+
+        path = event.event_data.path
+        if path == self.LAUNCHER_ROOT:
+            return
+        launcher_id = path.rsplit('/', 1)[1]
+
+        if event.event_type == TreeEvent.NODE_REMOVED:
+            self._cached_launchers.pop(launcher_id, None)
+        elif event.event_data.data:
+            self._cached_launchers[launcher_id] = Launcher.fromDict(
+                self._bytesToDict(event.event_data.data))
+
+    def imageCacheListener(self, event):
+        try:
+            self._imageCacheListener(event)
+        except Exception:
+            self.log.exception(
+                "Exception in image cache update for event: %s",
+                event)
+
+    def _imageCacheListener(self, event):
+        if event.event_type == TreeEvent.INITIALIZED:
+            self._image_cache_initialized = True
+            return
+
+        # Ignore any non-node related events such as connection events here
+        if event.event_type not in (TreeEvent.NODE_ADDED,
+                                    TreeEvent.NODE_UPDATED,
+                                    TreeEvent.NODE_REMOVED):
+            return
+
+        # We only cache uploads, which live at
+        # <image>/builds/<build>/providers/<provider>/images/<upload>
+        path = event.event_data.path
+        parts = path[len(self.IMAGE_ROOT) + 1:].split('/')
+        if (len(parts) != 7 or parts[1] != 'builds' or
+                parts[3] != 'providers' or parts[5] != 'images' or
+                parts[6] == 'lock'):
+            return
+        image, _, build_number, _, provider, _, upload_number = parts
+        key = (image, build_number, provider, upload_number)
+
+        upload = None
+        if (event.event_type in (TreeEvent.NODE_ADDED,
+                                 TreeEvent.NODE_UPDATED) and
+                event.event_data.data):
+            upload = ImageUpload.fromDict(
+                self._bytesToDict(event.event_data.data),
+                build_number, provider, image, upload_number)
+            upload.stat = event.event_data.stat
+
+        with self._image_cache_lock:
+            old_upload = self._cached_image_uploads.pop(key, None)
+            if old_upload is not None:
+                self._updateImageUploadState(old_upload, remove=True)
+            if upload is not None:
+                self._cached_image_uploads[key] = upload
+                self._updateImageUploadState(upload)
+
+    def _updateImageUploadState(self, upload, remove=False):
+        '''
+        Add or remove a cached upload to the uploads of its state and
+        update the most recent upload of that state.
+
+        Must be called with the image cache lock held.
+        '''
+        state_key = (upload.image_name, upload.provider_name, upload.state)
+        upload_key = (upload.build_id, upload.id)
+        latest = self._latest_image_uploads.get(state_key)
+        if remove:
+            uploads = self._image_upload_states.get(state_key, {})
+            uploads.pop(upload_key, None)
+            if not uploads:
+                self._image_upload_states.pop(state_key, None)
+                self._latest_image_uploads.pop(state_key, None)
+            elif latest is upload:
+                self._latest_image_uploads[state_key] = max(
+                    uploads.values(), key=lambda u: u.state_time)
+        else:
+            uploads = self._image_upload_states.setdefault(state_key, {})
+            uploads[upload_key] = upload
+            if latest is None or latest.state_time < upload.state_time:
+                self._latest_image_uploads[state_key] = upload
 
     def getStatsElection(self, identifier):
         path = self._electionPath('stats')
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import argparse
+import time
+
+from kazoo.protocol.states import ZnodeStat
+from kazoo.recipe.cache import NodeData
+from kazoo.recipe.cache import TreeEvent
+
+import nodepool.zk
+
+# A script comparing the size of node znodes, the time the node cache
+# listener spends on their events and the time spent decoding them when
+# reading the cached nodes, for each of the encodings.  No ZooKeeper
+# server is needed.
+
+parser = argparse.ArgumentParser(
+    description='Benchmark the ZooKeeper node encodings')
+parser.add_argument('-n', dest='nodes', type=int, default=10000,
+                    help='number of nodes')
+parser.add_argument('-r', dest='rounds', type=int, default=5,
+                    help='number of update rounds')
+args = parser.parse_args()
+
+
+def make_node(i):
+    node = nodepool.zk.Node('%010d' % i)
+    node.state = nodepool.zk.READY
+    node.state_time = time.time()
+    node.created_time = node.state_time
+    node.provider = 'provider%d' % (i % 4)
+    node.pool = 'main'
+    node.cloud = 'cloud'
+    node.region = 'region'
+    node.az = 'az1'
+    node.type = ['label%d' % (i % 10)]
+    node.launcher = 'launcher-%d' % (i % 4)
+    node.external_id = 'a2b8e2f2-0000-4000-8000-%012d' % i
+    node.hostname = 'np%010d' % i
+    node.interface_ip = '203.0.113.%d' % (i % 250)
+    node.public_ipv4 = node.interface_ip
+    node.private_ipv4 = '10.0.0.%d' % (i % 250)
+    node.image_id = 'image-%d' % (i % 10)
+    node.host_keys = ['ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAI%040d' % i]
+    return node
+
+
+nodes = [make_node(i) for i in range(args.nodes)]
+
+print("%-8s %12s %12s %12s %12s" % ('encoding', 'bytes/znode', 'us/event',
+                                    'us/read', 'total MiB'))
+for name, encoding in sorted(nodepool.zk.ENCODINGS.items()):
+    zk = nodepool.zk.ZooKeeper(enable_cache=False)
+    events = []
+    size = 0
+    for version in range(args.rounds):
+        stat = ZnodeStat(0, 0, 0, 0, version, 0, 0, 0, 0, 0, 0)
+        for node in nodes:
+            node.state_time += 1
+            data = encoding.encode(node)
+            size += len(data)
+            event_type = (TreeEvent.NODE_ADDED if version == 0
+                          else TreeEvent.NODE_UPDATED)
+            events.append(TreeEvent.make(event_type, NodeData.make(
+                zk._nodePath(node.id), data, stat)))
+
+    start = time.perf_counter()
+    for event in events:
+        zk._nodeCacheListener(event)
+    elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for node in nodes:
+        zk.getNode(node.id, cached=True)
+    read_elapsed = time.perf_counter() - start
+
+    print("%-8s %12d %12.2f %12.2f %12.2f" % (
+        name, size / len(events), elapsed / len(events) * 1e6,
+        read_elapsed / len(nodes) * 1e6, size / 1024.0 / 1024.0))
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import argparse
+import gc
+import json
+import os
+import time
+
+from kazoo.protocol.states import ZnodeStat
+from kazoo.recipe.cache import NodeData
+from kazoo.recipe.cache import TreeEvent
+
+import nodepool.zk
+
+# A script reporting the resident set size of a launcher node cache
+# filled with synthetic nodes.  No ZooKeeper server is needed.  Run it
+# against different revisions to compare the memory usage of the models.
+
+parser = argparse.ArgumentParser(
+    description='Benchmark the memory usage of the node cache')
+parser.add_argument('-n', dest='nodes', type=int, default=50000,
+                    help='number of nodes')
+args = parser.parse_args()
+
+
+def rss():
+    # Current resident set size in bytes
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def node_data(i):
+    # Build the data from scratch for every node, like JSON decoding of
+    # znodes received from ZooKeeper does.
+    now = time.time()
+    return json.dumps({
+        'state': 'ready',
+        'state_time': now,
+        'created_time': now,
+        'provider': 'provider-%d' % (i % 4),
+        'pool': 'main',
+        'cloud': 'cloud',
+        'region': 'region',
+        'az': 'az%d' % (i % 3),
+        'type': ['label-%d' % (i % 20)],
+        'launcher': 'launcher-%d' % (i % 4),
+        'username': 'zuul',
+        'connection_type': 'ssh',
+        'connection_port': 22,
+        'external_id': 'a2b8e2f2-0000-4000-8000-%012d' % i,
+        'hostname': 'np%010d' % i,
+        'interface_ip': '203.0.113.%d' % (i % 250),
+        'public_ipv4': '203.0.113.%d' % (i % 250),
+        'private_ipv4': '10.0.0.%d' % (i % 250),
+        'image_id': 'image-%d' % (i % 20),
+        'host_keys': [],
+    }).encode('utf8')
+
+
+zk = nodepool.zk.ZooKeeper(enable_cache=False)
+stat = ZnodeStat(0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+
+gc.collect()
+before = rss()
+for i in range(args.nodes):
+    zk._nodeCacheListener(TreeEvent.make(TreeEvent.NODE_ADDED, NodeData.make(
+        zk._nodePath('%010d' % i), node_data(i), stat)))
+gc.collect()
+after = rss()
+
+print("nodes:          %d" % len(zk._cached_nodes))
+print("RSS before:     %.1f MiB" % (before / 1024.0 / 1024.0))
+print("RSS after:      %.1f MiB" % (after / 1024.0 / 1024.0))
+print("bytes per node: %d" % ((after - before) / args.nodes))